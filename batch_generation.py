@@ -0,0 +1,202 @@
+# Copyright 2019 - UMONS
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You should have received a copy of the Apache License Version 2.0 along with this program.
+# If not, see
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Offline generation of a JSONL file of prompts with a pool of worker processes.
+
+    Every line of the input is a JSON object with a `prompt` and optionally an `id` and its own sampling
+    settings (`tokens_to_generate`, `sample`, `temperature`, `top_k`, `top_p`, `repetition_penalty`, `seed`),
+    the command line giving the defaults. The lines are cut in shards of `shard_size` prompts, and each worker
+    process, bound to its own share of the cores (see fine_tuning_openai.py), loads the model once and generates
+    whole shards. Results are appended to `shard-<n>.jsonl.tmp` in the output directory as they are generated, and
+    the file is renamed to `shard-<n>.jsonl` once the shard is complete.
+
+    `manifest.json` lists the complete shards, with the input file and settings of the job. Run again with the
+    same output directory, the job only generates the missing shards. Samples are drawn with a seed given by the
+    line number when a prompt has none, so a resumed job gives the same results as an uninterrupted one.
+"""
+import argparse
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import time
+
+import torch
+from pytorch_pretrained_bert import GPT2LMHeadModel, GPT2Tokenizer, OpenAIGPTLMHeadModel, OpenAIGPTTokenizer
+
+from decoding import decode
+from fine_tuning_openai import bind_to_core_group
+from registry import get_model, get_tokenizer
+from sampling import LogitsSampler
+
+logger = logging.getLogger(__name__)
+
+MODELS = {'gpt2': (GPT2Tokenizer, GPT2LMHeadModel),
+          'openai-gpt': (OpenAIGPTTokenizer, OpenAIGPTLMHeadModel)}
+DEFAULTS = {'tokens_to_generate': 30, 'sample': False, 'temperature': 1., 'top_k': 0, 'top_p': 1.,
+            'repetition_penalty': 1.}
+MANIFEST_NAME = 'manifest.json'
+
+_worker_tokenizer = None
+_worker_model = None
+
+
+def _init_worker(model_type, model_name_or_path, dtype, worker_counter, num_workers):
+    global _worker_tokenizer, _worker_model
+    with worker_counter.get_lock():
+        worker_index = worker_counter.value
+        worker_counter.value += 1
+    bind_to_core_group(worker_index, num_workers)
+    tokenizer_class, model_class = MODELS[model_type]
+    _worker_tokenizer = get_tokenizer(tokenizer_class, model_name_or_path)
+    _worker_model = get_model(model_class, model_name_or_path, dtype=dtype)
+
+
+def generate_record(tokenizer, model, record, defaults, seed):
+    """ Text generated after the prompt of the input line `record`, with its settings or else `defaults`. """
+    settings = dict(defaults, **{key: record[key] for key in DEFAULTS if key in record})
+    sampler = LogitsSampler(settings['temperature'], settings['top_k'], settings['top_p'],
+                            settings['repetition_penalty'], greedy=not settings['sample'])
+    context = tokenizer.convert_tokens_to_ids(tokenizer.tokenize(record['prompt']))
+    if not context:
+        raise ValueError("Empty prompt")
+    if len(context) + settings['tokens_to_generate'] > model.config.n_positions:
+        raise ValueError("Can't get samples longer than window size: %s" % model.config.n_positions)
+    generator = torch.Generator().manual_seed(record.get('seed', seed))
+    return tokenizer.decode(decode(model, context, settings['tokens_to_generate'], sampler, generator).tolist())
+
+
+def _generate_shard(task):
+    """ Generate the (line number, line) of a shard into its output file, returns (shard, prompts, seconds). """
+    shard, lines, output_dir, defaults, seed = task
+    start = time.perf_counter()
+    path = os.path.join(output_dir, 'shard-%05d.jsonl' % shard)
+    with open(path + '.tmp', 'w', encoding='utf_8') as f:
+        for line_number, line in lines:
+            result = {'id': line_number, 'line': line_number}
+            try:
+                record = json.loads(line)
+                if not isinstance(record, dict):
+                    raise ValueError("Expected a JSON object, got %s" % type(record).__name__)
+                result['id'] = record.get('id', line_number)
+                result['text'] = generate_record(_worker_tokenizer, _worker_model, record, defaults,
+                                                 seed + line_number)
+            except (KeyError, TypeError, ValueError) as e:
+                # A bad line or prompt shouldn't stop the job, json.JSONDecodeError is a ValueError
+                logger.warning("Line %d: %r", line_number, e)
+                result['error'] = repr(e)
+            f.write(json.dumps(result) + '\n')
+            f.flush()
+    os.replace(path + '.tmp', path)
+    return shard, len(lines), time.perf_counter() - start
+
+
+def _shards(input_file, shard_size, done):
+    """ (shard, [(line number, line)]) of the shards of `input_file` not in `done`, parsed by the workers. """
+    with open(input_file, encoding='utf_8') as f:
+        lines = ((i, line) for i, line in enumerate(f) if line.strip())
+        for shard in itertools.count():
+            chunk = list(itertools.islice(lines, shard_size))
+            if not chunk:
+                return
+            if shard not in done:
+                yield shard, chunk
+
+
+def _write_manifest(path, manifest):
+    with open(path + '.tmp', 'w', encoding='utf_8') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def run_job(input_file, output_dir, model_type='gpt2', model_name_or_path='gpt2', defaults=None, shard_size=256,
+            num_workers=None, seed=0, dtype=None):
+    """ Generate every prompt of the JSONL file `input_file` into the shard files of `output_dir`, with the
+        sampling settings `defaults` (see DEFAULTS) for the prompts that don't give their own.
+
+        Returns the number of prompts generated by this run. Raises ValueError if `output_dir` holds another job.
+    """
+    defaults = dict(DEFAULTS, **(defaults or {}))
+    if num_workers is None:
+        num_workers = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    stat = os.stat(input_file)
+    job = {'input_file': os.path.abspath(input_file), 'input_size': stat.st_size, 'input_mtime': stat.st_mtime,
+           'model_type': model_type, 'model_name_or_path': model_name_or_path, 'defaults': defaults,
+           'shard_size': shard_size, 'seed': seed, 'dtype': str(dtype)}
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    manifest = {'job': job, 'complete': []}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, encoding='utf_8') as f:
+            manifest = json.load(f)
+        if manifest['job'] != job:
+            raise ValueError("%s holds the results of another job" % output_dir)
+        logger.info("Resuming, %d shards already complete", len(manifest['complete']))
+
+    done = set(manifest['complete'])
+    tasks = ((shard, lines, output_dir, defaults, seed) for shard, lines in _shards(input_file, shard_size, done))
+    n_prompts, start = 0, time.perf_counter()
+    # The workers pick the shards in turn, the manifest is only written here
+    with multiprocessing.Pool(num_workers, initializer=_init_worker,
+                              initargs=(model_type, model_name_or_path, dtype, multiprocessing.Value('i', 0),
+                                        num_workers)) as pool:
+        for shard, n_lines, seconds in pool.imap_unordered(_generate_shard, tasks):
+            manifest['complete'] = sorted(manifest['complete'] + [shard])
+            _write_manifest(manifest_path, manifest)
+            n_prompts += n_lines
+            logger.info("Shard %d complete: %d prompts in %.1fs, %.2f prompts/s overall", shard, n_lines, seconds,
+                        n_prompts / (time.perf_counter() - start))
+    return n_prompts
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_type', type=str, default='gpt2', choices=sorted(MODELS))
+    parser.add_argument('--model_name_or_path', type=str, default='gpt2',
+                        help='pretrained model name or path to local checkpoint')
+    parser.add_argument('--input_file', type=str, required=True,
+                        help='JSONL file of {"prompt": ..., "id": ...} objects, with optional sampling settings.')
+    parser.add_argument('--output_dir', type=str, required=True,
+                        help='Where the shard files and the manifest go, run again with it to resume the job.')
+    parser.add_argument('--shard_size', type=int, default=256, help='Prompts per shard.')
+    parser.add_argument('--num_workers', type=int, default=None,
+                        help='Worker processes, each with its own model and share of the cores. Defaults to one '
+                             'per core.')
+    parser.add_argument("--tokens_to_generate", type=int, default=30)
+    parser.add_argument("--sample", action='store_true', help='Sample the tokens instead of taking the best one.')
+    parser.add_argument("--temperature", type=float, default=1.0)
+    parser.add_argument("--top_k", type=int, default=0)
+    parser.add_argument("--top_p", type=float, default=1.0)
+    parser.add_argument("--repetition_penalty", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=0, help='Seed of the first line, the next lines add their number.')
+    parser.add_argument("--quantize", action='store_true',
+                        help='Run the linear layers in int8 on CPU (see quantization.py to check the accuracy).')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                        datefmt='%m/%d/%Y %H:%M:%S',
+                        level=logging.INFO)
+
+    defaults = {key: getattr(args, key) for key in DEFAULTS}
+    start = time.perf_counter()
+    n_prompts = run_job(args.input_file, args.output_dir, args.model_type, args.model_name_or_path, defaults,
+                        args.shard_size, args.num_workers, args.seed, torch.qint8 if args.quantize else None)
+    logger.info("Generated %d prompts in %.1fs", n_prompts, time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    main()
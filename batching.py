@@ -0,0 +1,226 @@
+# Copyright 2019 - UMONS
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You should have received a copy of the Apache License Version 2.0 along with this program.
+# If not, see
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Continuous batching of many distinct prompts for the GPT and GPT-2 generators.
+
+    Unlike `sample_sequence`, which repeats a single context `batch_size` times, the scheduler packs different
+    prompts (left-padded, with an attention mask) into one batched forward pass. A sequence leaves the batch as
+    soon as it reaches its own target length and a queued prompt takes its slot on the next step.
+"""
+import argparse
+import collections
+
+import torch
+import torch.nn.functional as F
+
+from decoding import model_step, select_past, left_pad_past
+from registry import get_model, get_tokenizer
+from sampling import LogitsSampler
+from tracing import NULL_TRACER
+
+
+class ContinuousBatcher(object):
+    """ Schedules generation requests on a GPT/GPT-2 LM model, `max_batch_size` sequences at a time.
+
+        Every call to `step` runs one decoding step for the active sequences, admits queued prompts in the
+        free slots and returns the list of (request_id, token_ids) that finished during this step. `tracer` (see
+        tracing.py) receives the timings of the phases of every step.
+    """
+
+    def __init__(self, model, max_batch_size=8, temperature=1, top_k=0, sample=True, pad_token=0, tracer=None,
+                 sampler=None):
+        self.model = model
+        self.tracer = tracer or NULL_TRACER
+        self.step_fn = model_step(model)
+        self.device = next(model.parameters()).device
+        self.n_positions = model.config.n_positions
+        self.max_batch_size = max_batch_size
+        self.sampler = sampler or LogitsSampler(temperature, top_k, greedy=not sample)
+        self.pad_token = pad_token
+
+        self.queue = collections.deque()
+        self.next_request_id = 0
+        # State of the active sequences, one row per sequence
+        self.request_ids = []
+        self.targets = []
+        self.counts = []
+        self.past = None
+        self.attention_mask = None  # (batch, cache_length), 0 on the left padding
+        self.lengths = None  # (batch,) number of real tokens in the cache
+        self.last_tokens = None  # (batch, 1) last sampled tokens, not yet in the cache
+        self.output = None  # (batch, max_target) sampled tokens
+
+    def submit(self, context, length, request_id=None):
+        """ Queue the token ids `context` to be continued by `length` tokens, returns the request id. """
+        if not context:
+            raise ValueError("Context should not be empty")
+        if length < 1:
+            raise ValueError("Length should be at least 1")
+        if len(context) + length > self.n_positions:
+            raise ValueError("Can't get samples longer than window size: %s" % self.n_positions)
+        if request_id is None:
+            request_id = self.next_request_id
+            self.next_request_id += 1
+        self.queue.append((request_id, list(context), length))
+        return request_id
+
+    def __len__(self):
+        return len(self.queue) + len(self.request_ids)
+
+    def _select(self, logits):
+        with self.tracer.span('sample'):
+            return self.sampler(logits)
+
+    def _decode(self):
+        attention_mask = torch.cat((self.attention_mask, self.attention_mask.new_ones(len(self.request_ids), 1)), 1)
+        with self.tracer.span('forward'):
+            logits, self.past = self.step_fn(self.model, self.last_tokens, self.past, attention_mask,
+                                             self.lengths.unsqueeze(1))
+        self.attention_mask = attention_mask
+        self.lengths = self.lengths + 1
+        self.last_tokens = self._select(logits[:, -1, :])
+
+    def _prefill(self, requests):
+        """ Encode the prompts of `requests` in one left-padded forward pass. """
+        prompt_length = max(len(context) for _, context, _ in requests)
+        with self.tracer.span('transfer'):
+            input_ids = torch.full((len(requests), prompt_length), self.pad_token, dtype=torch.long,
+                                   device=self.device)
+            attention_mask = torch.zeros((len(requests), prompt_length), dtype=torch.long, device=self.device)
+            for i, (_, context, _) in enumerate(requests):
+                input_ids[i, prompt_length - len(context):] = torch.tensor(context, dtype=torch.long)
+                attention_mask[i, prompt_length - len(context):] = 1
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+        with self.tracer.span('prefill'):
+            logits, past = self.step_fn(self.model, input_ids, None, attention_mask, position_ids)
+        return past, attention_mask, attention_mask.sum(-1), self._select(logits[:, -1, :])
+
+    def _admit(self):
+        requests = []
+        while self.queue and len(self.request_ids) + len(requests) < self.max_batch_size:
+            requests.append(self.queue.popleft())
+        if not requests:
+            return
+        past, attention_mask, lengths, last_tokens = self._prefill(requests)
+        max_target = max(max(length for _, _, length in requests), max(self.targets, default=0))
+        output = torch.full((len(requests), max_target), self.pad_token, dtype=torch.long, device=self.device)
+
+        if self.request_ids:
+            # Right-align the new rows with the active ones before concatenating them
+            cache_length = max(self.attention_mask.size(1), attention_mask.size(1))
+            past = [torch.cat(layers, dim=1) for layers in zip(left_pad_past(self.past, cache_length),
+                                                                left_pad_past(past, cache_length))]
+            attention_mask = torch.cat((F.pad(self.attention_mask, (cache_length - self.attention_mask.size(1), 0)),
+                                        F.pad(attention_mask, (cache_length - attention_mask.size(1), 0))))
+            lengths = torch.cat((self.lengths, lengths))
+            last_tokens = torch.cat((self.last_tokens, last_tokens))
+            output = torch.cat((F.pad(self.output, (0, max_target - self.output.size(1))), output))
+
+        self.past, self.attention_mask, self.lengths, self.last_tokens = past, attention_mask, lengths, last_tokens
+        self.output = output
+        for request_id, _, length in requests:
+            self.request_ids.append(request_id)
+            self.targets.append(length)
+            self.counts.append(0)
+
+    def _retire(self):
+        """ Remove the finished rows from the batch and return their outputs. """
+        finished = [i for i, (count, target) in enumerate(zip(self.counts, self.targets)) if count == target]
+        if not finished:
+            return []
+        results = [(self.request_ids[i], self.output[i, :self.targets[i]].tolist()) for i in finished]
+        keep = [i for i in range(len(self.request_ids)) if i not in finished]
+        self.request_ids = [self.request_ids[i] for i in keep]
+        self.targets = [self.targets[i] for i in keep]
+        self.counts = [self.counts[i] for i in keep]
+        if not keep:
+            self.past = self.attention_mask = self.lengths = self.last_tokens = self.output = None
+            return results
+
+        index = torch.tensor(keep, dtype=torch.long, device=self.device)
+        self.past = select_past(self.past, index)
+        self.attention_mask = self.attention_mask.index_select(0, index)
+        self.lengths = self.lengths.index_select(0, index)
+        self.last_tokens = self.last_tokens.index_select(0, index)
+        self.output = self.output.index_select(0, index)[:, :max(self.targets)]
+        # Drop the cache columns that are now padding for every remaining row
+        padding = self.attention_mask.size(1) - int(self.lengths.max())
+        if padding > 0:
+            self.past = [layer_past[..., padding:, :] for layer_past in self.past]
+            self.attention_mask = self.attention_mask[:, padding:]
+        return results
+
+    def step(self):
+        """ Run one scheduling step, returns the list of (request_id, token_ids) that finished. """
+        with torch.no_grad():
+            if self.request_ids:
+                self._decode()
+            self._admit()
+        if not self.request_ids:
+            # Nothing active nor queued
+            return []
+        # Rows that were just admitted already got their first token from the prefill
+        rows = torch.arange(len(self.request_ids), device=self.device)
+        columns = torch.tensor(self.counts, dtype=torch.long, device=self.device)
+        self.output[rows, columns] = self.last_tokens[:, 0]
+        self.counts = [count + 1 for count in self.counts]
+        batch_size, sequence_length = len(self.request_ids), self.attention_mask.size(1)
+        with self.tracer.span('retire'):
+            finished = self._retire()
+        self.tracer.step(batch_size, sequence_length)
+        return finished
+
+    def run(self):
+        """ Step until every queued request is done, yielding (request_id, token_ids) as they finish. """
+        while len(self):
+            for result in self.step():
+                yield result
+
+
+def main():
+    from pytorch_pretrained_bert import OpenAIGPTLMHeadModel, OpenAIGPTTokenizer
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_name_or_path', type=str, default='openai-gpt',
+                        help='pretrained model name or path to local checkpoint')
+    parser.add_argument("--prompts_file", type=str, required=True,
+                        help='File with one prompt per line.')
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max_batch_size", type=int, default=8)
+    parser.add_argument("--length", type=int, default=40)
+    parser.add_argument("--temperature", type=float, default=1.0)
+    parser.add_argument("--top_k", type=int, default=0)
+    args = parser.parse_args()
+
+    torch.random.manual_seed(args.seed)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    enc = get_tokenizer(OpenAIGPTTokenizer, args.model_name_or_path)
+    model = get_model(OpenAIGPTLMHeadModel, args.model_name_or_path, device=device)
+
+    batcher = ContinuousBatcher(model, max_batch_size=args.max_batch_size,
+                                temperature=args.temperature, top_k=args.top_k)
+    with open(args.prompts_file, encoding='utf_8') as f:
+        prompts = [line.strip() for line in f if line.strip()]
+    for prompt in prompts:
+        batcher.submit(enc.encode(prompt), args.length)
+
+    for request_id, tokens in batcher.run():
+        print("=" * 40 + " SAMPLE " + str(request_id + 1) + " " + "=" * 40)
+        print(prompts[request_id] + " " + enc.decode(tokens))
+    print("=" * 80)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+# Copyright 2019 - UMONS
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You should have received a copy of the Apache License Version 2.0 along with this program.
+# If not, see
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Batched beam search.
+
+    The `num_beams` beams of every prompt are rows of a single batch, so each step is one forward pass whatever
+    the number of prompts and beams. After the best continuations are selected, the rows of the model cache
+    (`past` for GPT and GPT-2, `mems` for Transformer-XL) are gathered to follow their beams instead of being
+    recomputed. Prompts whose search is over leave the batch.
+
+    Hypotheses are ranked by their log-probability divided by length ** `length_penalty`, the length being the
+    number of generated tokens, `eos_token_id` included: above 0 longer hypotheses are favoured, below 0 shorter
+    ones. `eos_token_id` can't be the first generated token. A prompt is done once `num_beams` hypotheses ended
+    with `eos_token_id`, or, without `early_stopping`, once none of its running beams can beat them anymore.
+"""
+import heapq
+
+import torch
+
+from decoding import model_step, select_past
+from tracing import NULL_TRACER
+
+
+class BeamHypotheses(object):
+    """ The `num_beams` best finished hypotheses of a prompt. """
+
+    def __init__(self, num_beams, length_penalty=1.):
+        self.num_beams = num_beams
+        self.length_penalty = length_penalty
+        self.heap = []  # (score, insertion order, tokens), worst first
+
+    def __len__(self):
+        return len(self.heap)
+
+    def score(self, log_prob, length):
+        return log_prob / max(length, 1) ** self.length_penalty
+
+    def add(self, tokens, log_prob, length=None):
+        """ Add the generated `tokens`, of `length` tokens with the end of sequence token if it was dropped. """
+        score = self.score(log_prob, len(tokens) if length is None else length)
+        if len(self.heap) < self.num_beams:
+            heapq.heappush(self.heap, (score, len(self.heap), tokens))
+        elif score > self.heap[0][0]:
+            heapq.heapreplace(self.heap, (score, self.heap[0][1], tokens))
+
+    def is_done(self, best_log_prob, length, early_stopping=True):
+        """ Whether the running beams, the best one having `best_log_prob` at `length`, can't do better. """
+        if len(self.heap) < self.num_beams:
+            return False
+        return early_stopping or self.score(best_log_prob, length) <= self.heap[0][0]
+
+    def best(self):
+        """ List of (tokens, score), best first. """
+        return [(tokens, score) for score, _, tokens in sorted(self.heap, key=lambda item: -item[0])]
+
+
+def banned_ngram_tokens(sequence, n):
+    """ Tokens that would repeat an n-gram of `sequence` if they came next. """
+    if len(sequence) < n:
+        return []
+    prefix = sequence[len(sequence) - n + 1:]
+    return [sequence[i + n - 1] for i in range(len(sequence) - n + 1) if sequence[i:i + n - 1] == prefix]
+
+
+def _add_best_beam(hypotheses, sequences, beam_scores, group, num_beams, context_length):
+    """ Add the best running beam of `group` to its `hypotheses`, when it has no other way to end. """
+    row = group * num_beams + beam_scores.view(-1, num_beams)[group].argmax().item()
+    hypotheses.add(sequences[row][context_length:], beam_scores[row].item())
+
+
+def beam_search(advance, reorder, log_probs, cache, contexts, tokens_to_generate, num_beams=4, length_penalty=1.,
+                no_repeat_ngram_size=0, eos_token_id=None, early_stopping=True, tracer=None):
+    """ Beam search after the token id lists `contexts`, returns a list of (tokens, score), best first, per context.
+        There is at least one per context: the best running beam if none could finish.
+
+        `log_probs` are the (len(contexts) * num_beams, vocab) log-probabilities of the next token after each
+        context, repeated for each of its beams, and `cache` the model cache of these rows.
+        `advance(tokens, cache)` runs the (rows, 1) LongTensor `tokens` through the model and returns the new
+        log-probabilities and cache, `reorder(cache, index)` keeps the rows of `cache` given by `index`.
+        `no_repeat_ngram_size` > 0 forbids the repetition of n-grams of that size, prompt included.
+    """
+    tracer = tracer or NULL_TRACER
+    hypotheses = [BeamHypotheses(num_beams, length_penalty) for _ in contexts]
+    prompts = list(range(len(contexts)))  # Prompt of each group of `num_beams` rows
+    sequences = [list(context) for context in contexts for _ in range(num_beams)]
+    # The beams of a prompt start identical, only the first one is expanded at the first step
+    beam_scores = log_probs.new_zeros((len(contexts), num_beams))
+    beam_scores[:, 1:] = -float('inf')
+    beam_scores = beam_scores.view(-1)
+
+    for step in range(tokens_to_generate):
+        with tracer.span('sample'):
+            if step == 0 and eos_token_id is not None:
+                # A hypothesis made of the end of sequence token alone would be empty
+                log_probs[:, eos_token_id] = -float('inf')
+            if no_repeat_ngram_size > 0:
+                for row, sequence in enumerate(sequences):
+                    banned = banned_ngram_tokens(sequence, no_repeat_ngram_size)
+                    if banned:
+                        log_probs[row, banned] = -float('inf')
+            vocab_size = log_probs.size(-1)
+            scores = (log_probs + beam_scores.unsqueeze(1)).view(len(prompts), -1)
+            # Twice as many candidates as beams, so that enough of them go on after the ones ending with eos
+            top_scores, top_indexes = torch.topk(scores, min(2 * num_beams, scores.size(1)), dim=1)
+            top_scores, top_indexes = top_scores.tolist(), top_indexes.tolist()
+
+        rows, tokens, next_scores, next_prompts = [], [], [], []
+        last_step = step + 1 == tokens_to_generate
+        for group, prompt in enumerate(prompts):
+            context_length = len(contexts[prompt])
+            beams = []
+            for rank, (score, index) in enumerate(zip(top_scores[group], top_indexes[group])):
+                if score == -float('inf'):
+                    break
+                row, token = group * num_beams + index // vocab_size, index % vocab_size
+                if token == eos_token_id:
+                    if rank < num_beams:
+                        # Normalized like the running beams of this step, over the tokens and eos
+                        hypotheses[prompt].add(sequences[row][context_length:], score, step + 1)
+                else:
+                    beams.append((row, token, score))
+                    if len(beams) == num_beams:
+                        break
+            if last_step or not beams:
+                for row, token, score in beams:
+                    hypotheses[prompt].add(sequences[row][context_length:] + [token], score)
+                if not hypotheses[prompt]:
+                    _add_best_beam(hypotheses[prompt], sequences, beam_scores, group, num_beams, context_length)
+                continue
+            if hypotheses[prompt].is_done(top_scores[group][0], step + 1, early_stopping):
+                continue
+            # Fewer possible continuations than beams (small vocabulary, banned n-grams): fill with dead beams
+            beams += [(beams[0][0], beams[0][1], -float('inf'))] * (num_beams - len(beams))
+            next_prompts.append(prompt)
+            for row, token, score in beams:
+                rows.append(row)
+                tokens.append(token)
+                next_scores.append(score)
+
+        tracer.step(len(sequences), max(len(sequence) for sequence in sequences) + 1)
+        if not next_prompts:
+            break
+        sequences = [sequences[row] + [token] for row, token in zip(rows, tokens)]
+        prompts = next_prompts
+        device = log_probs.device
+        beam_scores = torch.tensor(next_scores, dtype=log_probs.dtype, device=device)
+        with tracer.span('reorder'):
+            # Nothing to gather when every beam followed its own row
+            if rows != list(range(len(rows))) or len(rows) != log_probs.size(0):
+                cache = reorder(cache, torch.tensor(rows, dtype=torch.long, device=device))
+        with tracer.span('forward'):
+            log_probs, cache = advance(torch.tensor(tokens, dtype=torch.long, device=device).unsqueeze(1), cache)
+
+    # Nothing to generate
+    for group, prompt in enumerate(prompts):
+        if not hypotheses[prompt]:
+            _add_best_beam(hypotheses[prompt], sequences, beam_scores, group, num_beams, len(contexts[prompt]))
+    return [prompt_hypotheses.best() for prompt_hypotheses in hypotheses]
+
+
+def gpt_beam_search(model, contexts, tokens_to_generate, num_beams=4, length_penalty=1., no_repeat_ngram_size=0,
+                    eos_token_id=None, early_stopping=True, pad_token=0, tracer=None):
+    """ Beam search after the token id lists `contexts` with a GPT or GPT-2 LM model, see `beam_search`.
+
+        The prompts are encoded once, left-padded in a single forward pass, before their cache is repeated for
+        each beam.
+    """
+    step_fn = model_step(model)
+    device = next(model.parameters()).device
+    prompt_length = max(len(context) for context in contexts)
+    if prompt_length + tokens_to_generate > model.config.n_positions:
+        raise ValueError("Can't get samples longer than window size: %s" % model.config.n_positions)
+
+    input_ids = torch.full((len(contexts), prompt_length), pad_token, dtype=torch.long, device=device)
+    attention_mask = torch.zeros((len(contexts), prompt_length), dtype=torch.long, device=device)
+    for i, context in enumerate(contexts):
+        input_ids[i, prompt_length - len(context):] = torch.tensor(context, dtype=torch.long)
+        attention_mask[i, prompt_length - len(context):] = 1
+    position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+
+    def advance(tokens, cache):
+        past, attention_mask, lengths = cache
+        attention_mask = torch.cat((attention_mask, attention_mask.new_ones(attention_mask.size(0), 1)), 1)
+        logits, past = step_fn(model, tokens, past, attention_mask, lengths.unsqueeze(1))
+        return torch.log_softmax(logits[:, -1].float(), dim=-1), (past, attention_mask, lengths + 1)
+
+    def reorder(cache, index):
+        past, attention_mask, lengths = cache
+        return select_past(past, index), attention_mask.index_select(0, index), lengths.index_select(0, index)
+
+    with torch.no_grad():
+        logits, past = step_fn(model, input_ids, None, attention_mask, position_ids)
+        log_probs = torch.log_softmax(logits[:, -1].float(), dim=-1)
+        beams = torch.arange(len(contexts), device=device).repeat_interleave(num_beams)
+        cache = reorder((past, attention_mask, attention_mask.sum(-1)), beams)
+        return beam_search(advance, reorder, log_probs.index_select(0, beams), cache, contexts, tokens_to_generate,
+                           num_beams, length_penalty, no_repeat_ngram_size, eos_token_id, early_stopping, tracer)
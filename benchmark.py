@@ -0,0 +1,607 @@
+# Copyright 2019 - UMONS
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You should have received a copy of the Apache License Version 2.0 along with this program.
+# If not, see
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Offline benchmarks of the four generators, of `sample_sequence` and of the fine-tuning step.
+
+    The models are randomly initialized from the `tiny` and `medium` configurations below and written, with
+    synthetic tokenizers, to a work directory, so nothing is downloaded and the `*_generation` functions run as
+    they would on the pre-trained models. Each generation benchmark reports the time to first token, tokens/s and
+    the p50/p99 latency of the following steps, measured on the decoding loop the generator runs, plus the wall
+    time of the generator itself. Peak RSS is the peak of the whole process so far, so benchmarks are run from the
+    smallest configuration to the largest.
+
+    Results are written as JSON. `--compare` checks them against a previous run and exits with status 1 if a
+    metric regressed by more than `--threshold`.
+
+    `logits_sampler` times the selection of the next token alone, on random logits of the vocabulary size of the
+    configuration: `LogitsSampler` against the former temperature, top-k, softmax and multinomial path.
+    `traced_generation` decodes with the GPT-2 decoder exported by export.py, and reports the same metrics for the
+    eager model with an `eager_` prefix. Both also get the import time, load time and first token latency of a
+    new Python process, and their sum as `cold_start`.
+    `speculative_generation` decodes greedily with GPT-2 and n-gram drafts (see speculative.py), and reports the
+    acceptance rate of the drafts, the tokens per forward pass and the speedup over token by token decoding.
+    `weight_loading` starts `batch_size` processes that each load GPT-2 and run it once, together, from the
+    weight store written by weight_store.py and with `from_pretrained` (`pretrained_` metrics). It reports the
+    median load time, RSS, proportional set size (shared pages split between the processes) and private memory
+    of a process (Linux only).
+"""
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+from pytorch_pretrained_bert import (BertConfig, BertForMaskedLM, BertTokenizer, GPT2Config, GPT2LMHeadModel,
+                                     GPT2Tokenizer, OpenAIAdam, OpenAIGPTConfig, OpenAIGPTDoubleHeadsModel,
+                                     OpenAIGPTLMHeadModel, OpenAIGPTTokenizer, TransfoXLConfig, TransfoXLLMHeadModel,
+                                     TransfoXLTokenizer, CONFIG_NAME, WEIGHTS_NAME)
+from pytorch_pretrained_bert.tokenization_gpt2 import bytes_to_unicode
+
+from bert import bert_generation, fill_masks
+from decoding import TRACED_DECODER_NAME, decode, greedy_tokens
+from export import export_decoder
+from gpt2 import gpt2_generation
+from openai import openai_generation
+from openai_huggingface_example import sample_sequence, top_k_logits
+from registry import get_model, get_tokenizer
+from sampling import LogitsSampler
+from speculative import speculative_decode
+from tracing import Tracer
+from transformer_xl import encode_context, transformer_xl_generation, transformer_xl_steps
+from weight_store import WEIGHT_STORE_INDEX, save_weight_store
+
+logger = logging.getLogger(__name__)
+
+CONFIGS = {'tiny': {'vocab_size': 1000, 'n_positions': 128, 'hidden': 64, 'layers': 2, 'heads': 4},
+           'medium': {'vocab_size': 16384, 'n_positions': 512, 'hidden': 512, 'layers': 8, 'heads': 8}}
+
+BENCHMARKS = ['gpt2_generation', 'openai_generation', 'transformer_xl_generation', 'bert_generation',
+              'sample_sequence', 'fine_tuning_step', 'logits_sampler', 'traced_generation',
+              'speculative_generation', 'weight_loading']
+
+# Metrics compared between runs, the first ones are better higher and the other ones (durations) lower
+HIGHER_IS_BETTER = ('tokens_per_second', 'samples_per_second')
+LOWER_IS_BETTER = ('time_to_first_token', 'latency_p50', 'latency_p99', 'wall_time', 'step_time', 'cold_start',
+                   'load_time', 'pss_mb', 'private_mb')
+
+LETTERS = 'abcdefghijklmnopqrstuvwxyz'
+
+
+def _words(n):
+    """ `n` distinct lower case words, the vocabulary of the word-level tokenizers. """
+    words = []
+    for i in range(n):
+        word = ''
+        while True:
+            word += LETTERS[i % len(LETTERS)]
+            i //= len(LETTERS)
+            if i == 0:
+                break
+        words.append(word + 'x')
+    return words
+
+
+def _save_model(model, directory):
+    torch.save(model.state_dict(), os.path.join(directory, WEIGHTS_NAME))
+    model.config.to_json_file(os.path.join(directory, CONFIG_NAME))
+
+
+def write_gpt2(directory, size):
+    c = CONFIGS[size]
+    # Byte-level symbols only, without merges, padded to the model vocabulary
+    symbols = list(bytes_to_unicode().values())
+    symbols += ['<|%d|>' % i for i in range(c['vocab_size'] - len(symbols))]
+    with open(os.path.join(directory, 'vocab.json'), 'w', encoding='utf_8') as f:
+        json.dump({symbol: i for i, symbol in enumerate(symbols)}, f)
+    with open(os.path.join(directory, 'merges.txt'), 'w', encoding='utf_8') as f:
+        f.write('#version: 0.2\n')
+    config = GPT2Config(vocab_size_or_config_json_file=c['vocab_size'], n_positions=c['n_positions'],
+                        n_ctx=c['n_positions'], n_embd=c['hidden'], n_layer=c['layers'], n_head=c['heads'])
+    _save_model(GPT2LMHeadModel(config), directory)
+
+
+def _openai_config(size):
+    c = CONFIGS[size]
+    return OpenAIGPTConfig(vocab_size_or_config_json_file=c['vocab_size'], n_positions=c['n_positions'],
+                           n_ctx=c['n_positions'], n_embd=c['hidden'], n_layer=c['layers'], n_head=c['heads'])
+
+
+def write_openai(directory, size):
+    c = CONFIGS[size]
+    # Characters, with and without the end of word marker, padded to the model vocabulary
+    chars = LETTERS + '0123456789.,;:!?\'"-()'
+    symbols = list(chars) + [char + '</w>' for char in chars]
+    symbols += ['<%d></w>' % i for i in range(c['vocab_size'] - len(symbols))]
+    with open(os.path.join(directory, 'vocab.json'), 'w', encoding='utf_8') as f:
+        json.dump({symbol: i for i, symbol in enumerate(symbols)}, f)
+    with open(os.path.join(directory, 'merges.txt'), 'w', encoding='utf_8') as f:
+        f.write('#version: 0.2\n')
+    _save_model(OpenAIGPTLMHeadModel(_openai_config(size)), directory)
+
+
+def write_transfo_xl(directory, size):
+    c = CONFIGS[size]
+    symbols = ['<eos>', '<unk>'] + _words(c['vocab_size'] - 2)
+    torch.save({'idx2sym': symbols, 'sym2idx': {symbol: i for i, symbol in enumerate(symbols)}, 'unk_idx': 1},
+               os.path.join(directory, 'vocab.bin'))
+    config = TransfoXLConfig(vocab_size_or_config_json_file=c['vocab_size'],
+                             cutoffs=[c['vocab_size'] // 4, c['vocab_size'] // 2], d_model=c['hidden'],
+                             d_embed=c['hidden'], n_head=c['heads'], d_head=c['hidden'] // c['heads'],
+                             d_inner=4 * c['hidden'], div_val=1, n_layer=c['layers'], tgt_len=c['n_positions'] // 4,
+                             ext_len=0, mem_len=c['n_positions'] // 2, clamp_len=c['n_positions'])
+    _save_model(TransfoXLLMHeadModel(config), directory)
+
+
+def write_bert(directory, size):
+    c = CONFIGS[size]
+    symbols = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + _words(c['vocab_size'] - 5)
+    with open(os.path.join(directory, 'vocab.txt'), 'w', encoding='utf_8') as f:
+        f.write('\n'.join(symbols) + '\n')
+    config = BertConfig(vocab_size_or_config_json_file=c['vocab_size'], hidden_size=c['hidden'],
+                        num_hidden_layers=c['layers'], num_attention_heads=c['heads'],
+                        intermediate_size=4 * c['hidden'], max_position_embeddings=c['n_positions'])
+    _save_model(BertForMaskedLM(config), directory)
+
+
+WRITERS = {'gpt2': write_gpt2, 'openai-gpt': write_openai, 'transfo-xl': write_transfo_xl, 'bert': write_bert}
+
+
+def model_dir(work_dir, kind, size):
+    """ Directory of the random `kind` model of configuration `size`, written on first use. """
+    directory = os.path.join(work_dir, '%s-%s' % (kind, size))
+    if not os.path.exists(os.path.join(directory, WEIGHTS_NAME)):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        WRITERS[kind](directory, size)
+    return directory
+
+
+def _random_text(n_words, vocabulary=None):
+    vocabulary = vocabulary or [''.join(random.choice(LETTERS) for _ in range(4)) for _ in range(50)]
+    return ' '.join(random.choice(vocabulary) for _ in range(n_words))
+
+
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+@contextlib.contextmanager
+def _quiet():
+    """ Swallow what the generators print, and their progress bars. """
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        yield
+
+
+def _step_times(steps):
+    """ Duration of each item of the iterator `steps`, the first one including the setup of the iterator. """
+    times = []
+    start = time.perf_counter()
+    for _ in steps:
+        now = time.perf_counter()
+        times.append(now - start)
+        start = now
+    return times
+
+
+def _once(function, *args):
+    """ Iterator of a single step, calling `function` when it is consumed. """
+    yield function(*args)
+
+
+def _wall_time(function, *args):
+    start = time.perf_counter()
+    with _quiet():
+        function(*args)
+    return time.perf_counter() - start
+
+
+def summarize(runs, tokens_per_step):
+    """ Metrics of repeated runs, each a list of step durations producing `tokens_per_step` tokens per step. """
+    decode_steps = [duration for steps in runs for duration in steps[1:]]
+    return {'time_to_first_token': float(np.median([steps[0] for steps in runs])),
+            'tokens_per_second': float(np.median([tokens_per_step * len(steps) / sum(steps) for steps in runs])),
+            'latency_p50': float(np.percentile(decode_steps, 50)) if decode_steps else None,
+            'latency_p99': float(np.percentile(decode_steps, 99)) if decode_steps else None}
+
+
+def _repeat(run, repeats):
+    """ Results of `repeats` calls to `run`, after one untimed warm-up call. """
+    run()
+    return [run() for _ in range(repeats)]
+
+
+def _single_sequence(batch_size):
+    if batch_size != 1:
+        raise ValueError("The greedy generators decode a single sequence, batch_size should be 1")
+
+
+def bench_gpt2_generation(work_dir, size, batch_size, context_length, tokens, repeats):
+    _single_sequence(batch_size)
+    directory = model_dir(work_dir, 'gpt2', size)
+    tokenizer = get_tokenizer(GPT2Tokenizer, directory)
+    model = get_model(GPT2LMHeadModel, directory)
+    # One byte-level token per character
+    text = ''.join(random.choice(LETTERS) for _ in range(context_length))
+    context = tokenizer.encode(text)
+    runs = _repeat(lambda: _step_times(greedy_tokens(model, context, tokens)), repeats)
+    result = summarize(runs, 1)
+    result['wall_time'] = float(np.median(_repeat(lambda: _wall_time(gpt2_generation, directory, text, tokens),
+                                                  repeats)))
+    return result
+
+
+def bench_openai_generation(work_dir, size, batch_size, context_length, tokens, repeats):
+    _single_sequence(batch_size)
+    directory = model_dir(work_dir, 'openai-gpt', size)
+    tokenizer = get_tokenizer(OpenAIGPTTokenizer, directory)
+    model = get_model(OpenAIGPTLMHeadModel, directory)
+    text = ''.join(random.choice(LETTERS) for _ in range(context_length))
+    context = tokenizer.encode(text)
+    runs = _repeat(lambda: _step_times(greedy_tokens(model, context, tokens)), repeats)
+    result = summarize(runs, 1)
+    result['wall_time'] = float(np.median(_repeat(lambda: _wall_time(openai_generation, directory, text, tokens),
+                                                  repeats)))
+    return result
+
+
+def bench_transformer_xl_generation(work_dir, size, batch_size, context_length, tokens, repeats):
+    directory = model_dir(work_dir, 'transfo-xl', size)
+    tokenizer = get_tokenizer(TransfoXLTokenizer, directory)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model = get_model(TransfoXLLMHeadModel, directory, device=device)
+    vocabulary = tokenizer.idx2sym[2:]
+    texts = [_random_text(context_length - 1, vocabulary) for _ in range(batch_size)]
+    ctx_tensors = [torch.tensor(encode_context(tokenizer, text)) for text in texts]
+    unk_id = tokenizer.convert_tokens_to_ids(['<unk>'])[0]
+    k = min(40, len(vocabulary))
+    runs = _repeat(lambda: _step_times(transformer_xl_steps(model, ctx_tensors, tokens, k, unk_id)), repeats)
+    result = summarize(runs, batch_size)
+    result['wall_time'] = float(np.median(_repeat(
+        lambda: _wall_time(transformer_xl_generation, directory, texts, tokens, k), repeats)))
+    return result
+
+
+def bench_bert_generation(work_dir, size, batch_size, context_length, tokens, repeats):
+    directory = model_dir(work_dir, 'bert', size)
+    tokenizer = get_tokenizer(BertTokenizer, directory)
+    model = get_model(BertForMaskedLM, directory)
+    vocabulary = list(tokenizer.vocab)[5:]
+    sentences = [_random_text(context_length, vocabulary) for _ in range(batch_size)]
+    masks = [[random.randrange(context_length)] for _ in sentences]
+    # A single forward pass fills every mask of the batch
+    runs = _repeat(lambda: _step_times(_once(fill_masks, tokenizer, model, sentences, masks)), repeats)
+    result = summarize(runs, batch_size)
+    mask = sentences[0].split()[0]
+    result['wall_time'] = float(np.median(_repeat(
+        lambda: _wall_time(bert_generation, directory, sentences[0], mask), repeats)))
+    return result
+
+
+def bench_sample_sequence(work_dir, size, batch_size, context_length, tokens, repeats):
+    directory = model_dir(work_dir, 'openai-gpt', size)
+    model = get_model(OpenAIGPTLMHeadModel, directory)
+    device = next(model.parameters()).device
+    context = [random.randrange(model.config.vocab_size) for _ in range(context_length)]
+
+    def run():
+        times = []
+        tracer = Tracer(callbacks=[lambda record: times.append(record['time'])])
+        with _quiet():
+            sample_sequence(model=model, length=tokens, context=context, batch_size=batch_size, top_k=40,
+                            device=device, tracer=tracer)
+        return times
+
+    return summarize(_repeat(run, repeats), batch_size)
+
+
+def bench_fine_tuning_step(work_dir, size, batch_size, context_length, tokens, repeats):
+    """ Forward, backward and `OpenAIAdam` step of `fine_tuning_openai.py` on random batches. """
+    model = OpenAIGPTDoubleHeadsModel(_openai_config(size))
+    model.set_num_special_tokens(2)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model.to(device)
+    model.train()
+    optimizer = OpenAIAdam(model.parameters(), lr=6.25e-5, warmup=0.002, max_grad_norm=1, weight_decay=0.01,
+                           t_total=repeats + 1)
+    input_ids = torch.randint(model.config.vocab_size, (batch_size, 1, context_length), device=device)
+    mc_token_ids = torch.full((batch_size, 1), context_length - 1, dtype=torch.long, device=device)
+    mc_labels = torch.zeros(batch_size, dtype=torch.long, device=device)
+
+    def run():
+        start = time.perf_counter()
+        losses = model(input_ids, mc_token_ids, input_ids, mc_labels)
+        (0.9 * losses[0] + losses[1]).backward()
+        optimizer.step()
+        optimizer.zero_grad()
+        return time.perf_counter() - start
+
+    step_times = _repeat(run, repeats)
+    step_time = float(np.median(step_times))
+    return {'step_time': step_time,
+            'samples_per_second': batch_size / step_time,
+            'tokens_per_second': batch_size * context_length / step_time}
+
+
+def bench_logits_sampler(work_dir, size, batch_size, context_length, tokens, repeats):
+    """ Temperature and top-k sampling of `tokens` steps of (batch_size, vocab_size) logits. """
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    logits = torch.randn((batch_size, CONFIGS[size]['vocab_size']), device=device) * 4
+    sampler = LogitsSampler(temperature=0.8, top_k=40)
+
+    def legacy(logits):
+        filtered = top_k_logits(logits / 0.8, k=40)
+        return torch.multinomial(torch.softmax(filtered, dim=-1), num_samples=1)
+
+    def run(select):
+        # The sampler overwrites its input, copying the logits is part of the timing of both
+        start = time.perf_counter()
+        for _ in range(tokens):
+            token = select(logits.clone())
+        token.tolist()
+        return (time.perf_counter() - start) / tokens
+
+    step_time = float(np.median(_repeat(lambda: run(sampler), repeats)))
+    legacy_step_time = float(np.median(_repeat(lambda: run(legacy), repeats)))
+    return {'step_time': step_time, 'legacy_step_time': legacy_step_time,
+            'speedup': legacy_step_time / step_time, 'tokens_per_second': batch_size / step_time}
+
+
+# Run in a new process: import of the generator, load of the model and first token
+COLD_START = """
+import json, sys, time
+start = time.perf_counter()
+from pytorch_pretrained_bert import GPT2LMHeadModel, GPT2Tokenizer
+from decoding import greedy_tokens
+from registry import get_model, get_tokenizer
+imported = time.perf_counter()
+model = get_model(GPT2LMHeadModel, sys.argv[1])
+context = get_tokenizer(GPT2Tokenizer, sys.argv[1]).encode(sys.argv[2])
+loaded = time.perf_counter()
+next(greedy_tokens(model, context, 1))
+print(json.dumps({'import_time': imported - start, 'load_time': loaded - imported,
+                  'first_token': time.perf_counter() - loaded}))
+"""
+
+
+def _cold_start(directory, text):
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.run([sys.executable, '-c', COLD_START, directory, text], env=env, stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL, check=True, universal_newlines=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def bench_traced_generation(work_dir, size, batch_size, context_length, tokens, repeats):
+    _single_sequence(batch_size)
+    directory = model_dir(work_dir, 'gpt2', size)
+    tokenizer = get_tokenizer(GPT2Tokenizer, directory)
+    traced_directory = directory + '-traced'
+    if not os.path.exists(os.path.join(traced_directory, TRACED_DECODER_NAME)):
+        export_decoder(get_model(GPT2LMHeadModel, directory), traced_directory, tokenizer)
+    text = ''.join(random.choice(LETTERS) for _ in range(context_length))
+    context = tokenizer.encode(text)
+
+    result = {}
+    for prefix, path in (('eager_', directory), ('', traced_directory)):
+        model = get_model(GPT2LMHeadModel, path)
+        metrics = summarize(_repeat(lambda: _step_times(greedy_tokens(model, context, tokens)), repeats), 1)
+        cold = [_cold_start(path, text) for _ in range(repeats)]
+        for key in ('import_time', 'load_time', 'first_token'):
+            metrics[key] = float(np.median([run[key] for run in cold]))
+        metrics['cold_start'] = float(np.median([sum(run.values()) for run in cold]))
+        result.update((prefix + key, value) for key, value in metrics.items())
+    return result
+
+
+def bench_speculative_generation(work_dir, size, batch_size, context_length, tokens, repeats):
+    _single_sequence(batch_size)
+    directory = model_dir(work_dir, 'gpt2', size)
+    tokenizer = get_tokenizer(GPT2Tokenizer, directory)
+    model = get_model(GPT2LMHeadModel, directory)
+    context = tokenizer.encode(''.join(random.choice(LETTERS) for _ in range(context_length)))
+    stats = {}
+
+    def run():
+        start = time.perf_counter()
+        stats.update(speculative_decode(model, context, tokens)[1])
+        return time.perf_counter() - start
+
+    speculative_time = float(np.median(_repeat(run, repeats)))
+    greedy_time = float(np.median(_repeat(lambda: _wall_time(decode, model, context, tokens), repeats)))
+    return {'tokens_per_second': tokens / speculative_time, 'greedy_tokens_per_second': tokens / greedy_time,
+            'speedup': greedy_time / speculative_time, 'acceptance_rate': stats['acceptance_rate'],
+            'tokens_per_pass': stats['tokens_per_pass']}
+
+
+# Run in `n_workers` processes at once: load of the model, then memory use while all of them hold it
+MEMORY_WORKER = """
+import json, os, sys, time
+import torch
+from pytorch_pretrained_bert import GPT2LMHeadModel
+from registry import get_model
+barrier_dir, n_workers = sys.argv[2], int(sys.argv[3])
+
+
+def wait(name):
+    open(os.path.join(barrier_dir, '%s-%d' % (name, os.getpid())), 'w').close()
+    while sum(f.startswith(name) for f in os.listdir(barrier_dir)) < n_workers:
+        time.sleep(0.01)
+
+
+start = time.perf_counter()
+model = get_model(GPT2LMHeadModel, sys.argv[1])
+load_time = time.perf_counter() - start
+with torch.no_grad():
+    model(torch.zeros((1, 8), dtype=torch.long))
+wait('loaded')
+memory = {}
+with open('/proc/self/smaps_rollup') as f:
+    for line in f:
+        fields = line.split()
+        memory[fields[0]] = int(fields[1]) / 1024 if len(fields) == 3 else None
+wait('measured')
+print(json.dumps({'load_time': load_time, 'rss_mb': memory['Rss:'], 'pss_mb': memory['Pss:'],
+                  'private_mb': memory['Private_Clean:'] + memory['Private_Dirty:']}))
+"""
+
+
+def _worker_memory(directory, n_workers):
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+    with tempfile.TemporaryDirectory() as barrier_dir:
+        workers = [subprocess.Popen([sys.executable, '-c', MEMORY_WORKER, directory, barrier_dir, str(n_workers)],
+                                    env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                    universal_newlines=True) for _ in range(n_workers)]
+        results = [json.loads(worker.communicate()[0].splitlines()[-1]) for worker in workers]
+    return {key: float(np.median([result[key] for result in results])) for key in results[0]}
+
+
+def bench_weight_loading(work_dir, size, batch_size, context_length, tokens, repeats):
+    if not os.path.exists('/proc/self/smaps_rollup'):
+        return {}
+    directory = model_dir(work_dir, 'gpt2', size)
+    store_directory = directory + '-store'
+    if not os.path.exists(os.path.join(store_directory, WEIGHT_STORE_INDEX)):
+        save_weight_store(GPT2LMHeadModel.from_pretrained(directory), store_directory,
+                          get_tokenizer(GPT2Tokenizer, directory))
+    result = {}
+    for prefix, path in (('pretrained_', directory), ('', store_directory)):
+        runs = [_worker_memory(path, batch_size) for _ in range(repeats)]
+        result.update((prefix + key, float(np.median([run[key] for run in runs]))) for key in runs[0])
+    return result
+
+
+def run_benchmarks(work_dir, benchmarks, sizes, batch_sizes, context_lengths, tokens, repeats, seed=0):
+    """ Run every benchmark on every configuration, returns the list of results. A benchmark that fails gives a
+        result with its error as `skipped` instead of metrics.
+    """
+    results = []
+    for size in sizes:
+        for name in benchmarks:
+            # The greedy generators decode a single sequence
+            for batch_size in batch_sizes if name not in ('gpt2_generation', 'openai_generation',
+                                                          'traced_generation', 'speculative_generation') else [1]:
+                # The sampler does not see the context, nor does loading the weights
+                for context_length in context_lengths if name not in ('logits_sampler', 'weight_loading') else [None]:
+                    # BERT fills its masks and the fine-tuning step trains in a single pass
+                    generated = tokens if name not in ('bert_generation', 'fine_tuning_step', 'weight_loading') \
+                        else None
+                    if context_length is not None \
+                            and context_length + (generated or 0) > CONFIGS[size]['n_positions']:
+                        logger.warning("Skipping context length %d: longer than the %s model window",
+                                       context_length, size)
+                        continue
+                    random.seed(seed)
+                    torch.manual_seed(seed)
+                    result = {'benchmark': name, 'config': size, 'batch_size': batch_size,
+                              'context_length': context_length, 'tokens': generated}
+                    try:
+                        result.update(globals()['bench_' + name](work_dir, size, batch_size, context_length,
+                                                                 tokens, repeats))
+                    except Exception as e:
+                        # Reported without metrics, so never compared, and the other benchmarks still run
+                        logger.warning("Skipping %s on %s: %r", name, size, e)
+                        result['skipped'] = repr(e)
+                    result['peak_rss_mb'] = _peak_rss_mb()
+                    logger.info("%s", json.dumps(result))
+                    results.append(result)
+    return results
+
+
+def _key(result):
+    return result['benchmark'], result['config'], result['batch_size'], result['context_length'], result['tokens']
+
+
+def compare(baseline, results, threshold=0.1):
+    """ List of (key, metric, baseline value, new value) of the metrics worse than the baseline by `threshold`. """
+    baseline = {_key(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        old = baseline.get(_key(result))
+        if old is None:
+            continue
+        for metric in HIGHER_IS_BETTER + LOWER_IS_BETTER:
+            value = result.get(metric)
+            if value is None or old.get(metric) is None:
+                continue
+            if metric in HIGHER_IS_BETTER:
+                worse = value < old[metric] * (1 - threshold)
+            else:
+                worse = value > old[metric] * (1 + threshold)
+            if worse:
+                regressions.append((_key(result), metric, old[metric], value))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--benchmarks', type=str, nargs='+', default=BENCHMARKS, choices=BENCHMARKS)
+    parser.add_argument('--configs', type=str, nargs='+', default=['tiny', 'medium'], choices=sorted(CONFIGS))
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--context_lengths', type=int, nargs='+', default=[16, 64])
+    parser.add_argument('--tokens_to_generate', type=int, default=32)
+    parser.add_argument('--repeats', type=int, default=3, help='Timed runs of each benchmark, after a warm-up run.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--work_dir', type=str, default=None,
+                        help='Where the random models are written, defaults to a temporary directory.')
+    parser.add_argument('--output', type=str, default='benchmark.json')
+    parser.add_argument('--compare', type=str, default=None, help='Results of a previous run to compare with.')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Relative change of a metric reported as a regression.')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                        datefmt='%m/%d/%Y %H:%M:%S',
+                        level=logging.INFO)
+
+    with contextlib.ExitStack() as stack:
+        work_dir = args.work_dir or stack.enter_context(tempfile.TemporaryDirectory())
+        results = run_benchmarks(work_dir, args.benchmarks, args.configs, args.batch_sizes, args.context_lengths,
+                                 args.tokens_to_generate, args.repeats, args.seed)
+
+    report = {'environment': {'python': platform.python_version(),
+                              'torch': torch.__version__,
+                              'platform': platform.platform(),
+                              'threads': torch.get_num_threads(),
+                              'cuda': torch.cuda.is_available()},
+              'results': results}
+    with open(args.output, 'w', encoding='utf_8') as f:
+        json.dump(report, f, indent=2)
+    logger.info("Results written to %s", args.output)
+
+    if args.compare:
+        with open(args.compare, encoding='utf_8') as f:
+            baseline = json.load(f)['results']
+        regressions = compare(baseline, results, args.threshold)
+        for key, metric, old, new in regressions:
+            print("REGRESSION %s %s: %.6g -> %.6g" % ("/".join(str(k) for k in key), metric, old, new))
+        if regressions:
+            sys.exit(1)
+        print("No regression over %d%%" % (100 * args.threshold))
+
+
+if __name__ == '__main__':
+    main()
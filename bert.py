@@ -17,7 +17,9 @@
 
 import torch
 import argparse
-from pytorch_pretrained_bert import BertTokenizer, BertForMaskedLM
+
+from registry import get_model, get_tokenizer
+from sampling import LogitsSampler
 
 
 def main():
@@ -28,55 +30,199 @@ def main():
                         help='The sentence to use for word suggestion')
     parser.add_argument("--mask", type=str, default="dog",
                         help='The word to mask for suggestion')
+    parser.add_argument("--tokens_to_generate", type=int, default=0,
+                        help='If positive, generate a span of that many tokens after the text instead of a suggestion.')
+    parser.add_argument("--iterations", type=int, default=10,
+                        help='Number of mask-predict iterations, more is slower but better.')
+    parser.add_argument("--n_candidates", type=int, default=4,
+                        help='Number of candidate spans generated together.')
+    parser.add_argument("--quantize", action='store_true',
+                        help='Run the linear layers in int8 on CPU (see quantization.py to check the accuracy).')
     args = parser.parse_args()
 
-    bert_generation(args.model_name_or_path, args.text, args.mask)
-
-
-def bert_generation(model_name_or_path, text, mask):
+    dtype = torch.qint8 if args.quantize else None
+    if args.tokens_to_generate > 0:
+        bert_span_generation(args.model_name_or_path, args.text, args.tokens_to_generate, args.iterations,
+                             args.n_candidates, dtype)
+    else:
+        bert_generation(args.model_name_or_path, args.text, args.mask, dtype)
+
+
+def fill_masks(tokenizer, model, sentences, masks=None, top_k=10, batch_size=64):
+    """ Predict back every masked token of many sentences with `BertForMaskedLM`.
+
+        `masks` gives for each sentence a list of words (every occurrence is masked) or token indexes to mask.
+        `[MASK]` literals in the sentences are always predicted. Sentences are padded and run `batch_size` at a
+        time, and the candidates of all the masks of a batch come from a single `topk`.
+        Returns for each sentence the masked tokenized text and a list of (masked_index, [(token, probability)])
+        with the `top_k` best candidates of each mask, best first.
+        Raises ValueError if a masked word doesn't appear in its sentence or an index is out of range.
+    """
+    if masks is None:
+        masks = [[] for _ in sentences]
+    if len(masks) != len(sentences):
+        raise ValueError("Expected one list of masks per sentence")
+
+    tokenized_texts, masked_indexes = [], []
+    for text, sentence_masks in zip(sentences, masks):
+        tokenized_text = tokenizer.tokenize(text)
+        indexes = set(i for i, token in enumerate(tokenized_text) if token == '[MASK]')
+        for mask in sentence_masks:
+            if isinstance(mask, int):
+                if not 0 <= mask < len(tokenized_text):
+                    raise ValueError("Masked index %d out of range in %r" % (mask, text))
+                indexes.add(mask)
+            else:
+                found = [i for i, token in enumerate(tokenized_text) if token == mask]
+                if not found:
+                    raise ValueError("Masked word %r doesn't appear in %r" % (mask, text))
+                indexes.update(found)
+        for i in indexes:
+            tokenized_text[i] = '[MASK]'
+        tokenized_texts.append(tokenized_text)
+        masked_indexes.append(sorted(indexes))
+
+    device = next(model.parameters()).device
+    results = []
+    for start in range(0, len(tokenized_texts), batch_size):
+        batch_texts = tokenized_texts[start:start + batch_size]
+        batch_indexes = masked_indexes[start:start + batch_size]
+        max_length = max(len(tokenized_text) for tokenized_text in batch_texts)
+
+        # Convert token to vocabulary indices, padded with [PAD] (id 0) and masked out of the attention
+        tokens_tensor = torch.zeros((len(batch_texts), max_length), dtype=torch.long)
+        attention_mask = torch.zeros((len(batch_texts), max_length), dtype=torch.long)
+        for i, tokenized_text in enumerate(batch_texts):
+            tokens_tensor[i, :len(tokenized_text)] = torch.tensor(tokenizer.convert_tokens_to_ids(tokenized_text))
+            attention_mask[i, :len(tokenized_text)] = 1
+        rows = torch.tensor([i for i, indexes in enumerate(batch_indexes) for _ in indexes], dtype=torch.long)
+        columns = torch.tensor([j for indexes in batch_indexes for j in indexes], dtype=torch.long)
+
+        # Predict all tokens, sentence A only (see paper)
+        with torch.no_grad():
+            predictions = model(tokens_tensor.to(device), torch.zeros_like(tokens_tensor).to(device),
+                                attention_mask.to(device))
+            probs = torch.softmax(predictions[rows.to(device), columns.to(device)], dim=-1)
+            top_probs, top_indexes = torch.topk(probs, top_k, dim=-1)
+        top_probs, top_indexes = top_probs.tolist(), top_indexes.tolist()
+
+        n = 0
+        for tokenized_text, indexes in zip(batch_texts, batch_indexes):
+            candidates = []
+            for masked_index in indexes:
+                candidates.append((masked_index, list(zip(tokenizer.convert_ids_to_tokens(top_indexes[n]),
+                                                          top_probs[n]))))
+                n += 1
+            results.append((tokenized_text, candidates))
+    return results
+
+
+def bert_suggestions(tokenizer, model, text, mask, n_options=10):
+    """ Mask the first occurrence of `mask` in `text` and predict it back with `BertForMaskedLM`.
+
+        Returns the masked tokenized text and the `n_options` + 1 best replacement tokens, best first.
+        Raises ValueError if the masked word doesn't appear in the sentence.
+    """
+    masked_index = tokenizer.tokenize(text).index(mask)
+    (tokenized_text, candidates), = fill_masks(tokenizer, model, [text], [[masked_index]], n_options + 1)
+    return tokenized_text, [token for token, _ in dict(candidates)[masked_index]]
+
+
+def bert_generation(model_name_or_path, text, mask, dtype=None):
+    from pytorch_pretrained_bert import BertForMaskedLM, BertTokenizer
+    tokenizer = get_tokenizer(BertTokenizer, model_name_or_path)
+    model = get_model(BertForMaskedLM, model_name_or_path, dtype=dtype)
 
-    tokenizer = BertTokenizer.from_pretrained(model_name_or_path)
-    model = BertForMaskedLM.from_pretrained(model_name_or_path)
-
-    tokenized_text = tokenizer.tokenize(text)
-
-    # Mask a token that we will try to predict back with `BertForMaskedLM`
     try:
-        masked_index = tokenized_text.index(mask)
+        tokenized_text, predicted_tokens = bert_suggestions(tokenizer, model, text, mask)
 
     except ValueError:
         print("Error : Masked word doesn't appear in sentence.")
         return -1
 
-    tokenized_text[masked_index] = '[MASK]'
-
-    # Convert token to vocabulary indices
-    indexed_tokens = tokenizer.convert_tokens_to_ids(tokenized_text)
-    # Define sentence A and B indices associated to 1st and 2nd sentences (see paper)
-    segments_ids = [0] * len(tokenized_text)
-
-    # Convert inputs to PyTorch tensors
-    tokens_tensor = torch.tensor([indexed_tokens])
-    segments_tensors = torch.tensor([segments_ids])
-
-    model.eval()
-
-    # Predict all tokens
-    predictions = model(tokens_tensor, segments_tensors)
-    predicted_index = torch.argmax(predictions[0, masked_index]).item()
-    predicted_token = tokenizer.convert_ids_to_tokens([predicted_index])
-
     print("Original:", text)
     print("Masked:", " ".join(tokenized_text))
 
-    print("Predicted token:", predicted_token)
+    print("Predicted token:", predicted_tokens[:1])
     print("Other options:")
     # just curious about what the next few options look like.
-    for i in range(10):
-        predictions[0, masked_index, predicted_index] = -11100000
-        predicted_index = torch.argmax(predictions[0, masked_index]).item()
-        predicted_token = tokenizer.convert_ids_to_tokens([predicted_index])
-        print(predicted_token)
+    for predicted_token in predicted_tokens[1:]:
+        print([predicted_token])
+
+
+def mask_predict(tokenizer, model, text, tokens_to_generate, iterations=10, n_candidates=4, top_k=10):
+    """ Generate a span of `tokens_to_generate` tokens after `text` with mask-predict (Ghazvininejad et al., 2019).
+
+        The span starts fully masked and every position is predicted in one forward pass. Each following
+        iteration re-masks the lowest-confidence tokens (fewer and fewer, linearly) and predicts them again, so
+        the cost is `iterations` forward passes whatever the span length. The `n_candidates` spans are refined
+        together in the same batch; all but the first draw their initial tokens among the `top_k` best.
+        Returns a list of (tokens, average log-probability), best first. Raises ValueError if the span doesn't
+        fit in the window of the model after `text`.
+    """
+    if tokens_to_generate < 1:
+        raise ValueError("tokens_to_generate should be at least 1")
+    if iterations < 1:
+        raise ValueError("iterations should be at least 1")
+    if n_candidates < 1:
+        raise ValueError("n_candidates should be at least 1")
+    mask_id, = tokenizer.convert_tokens_to_ids(['[MASK]'])
+    prefix = ['[CLS]'] + tokenizer.tokenize(text)
+    # With [SEP]
+    max_positions = model.config.max_position_embeddings
+    if len(prefix) + tokens_to_generate + 1 > max_positions:
+        raise ValueError("Text (%d tokens) and tokens_to_generate (%d) are longer than the window size: %d"
+                         % (len(prefix) - 1, tokens_to_generate, max_positions))
+    start, end = len(prefix), len(prefix) + tokens_to_generate
+    indexed_tokens = tokenizer.convert_tokens_to_ids(prefix + ['[MASK]'] * tokens_to_generate + ['[SEP]'])
+
+    device = next(model.parameters()).device
+    tokens_tensor = torch.tensor([indexed_tokens], device=device).repeat(n_candidates, 1)
+    segments_tensors = torch.zeros_like(tokens_tensor)
+    scores = torch.zeros((n_candidates, tokens_to_generate), device=device)
+    # Never generate the special tokens
+    banned = [tokenizer.vocab[token] for token in ('[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]')
+              if token in tokenizer.vocab]
+    sampler = LogitsSampler(top_k=top_k)
+
+    with torch.no_grad():
+        for iteration in range(iterations):
+            span = tokens_tensor[:, start:end]
+            masked = span == mask_id
+
+            log_probs = torch.log_softmax(model(tokens_tensor, segments_tensors)[:, start:end], dim=-1)
+            log_probs[:, :, banned] = -float('inf')
+            best_scores, predicted = log_probs.max(dim=-1)
+            if iteration == 0 and n_candidates > 1:
+                choice = sampler(log_probs[1:].reshape(-1, log_probs.size(-1)).clone())
+                choice = choice.view(n_candidates - 1, -1, 1)
+                predicted[1:] = choice.squeeze(-1)
+                best_scores[1:] = log_probs[1:].gather(-1, choice).squeeze(-1)
+            span[masked] = predicted[masked]
+            scores[masked] = best_scores[masked]
+
+            # Re-mask the lowest-confidence tokens for the next iteration
+            n_masks = tokens_to_generate * (iterations - iteration - 1) // iterations
+            if n_masks == 0:
+                break
+            remasked = torch.topk(scores, n_masks, dim=-1, largest=False)[1]
+            span.scatter_(1, remasked, mask_id)
+
+    results = [(tokenizer.convert_ids_to_tokens(tokens_tensor[i, start:end].tolist()), score)
+               for i, score in enumerate(scores.mean(dim=-1).tolist())]
+    return sorted(results, key=lambda result: result[1], reverse=True)
+
+
+def bert_span_generation(model_name_or_path, text, tokens_to_generate, iterations=10, n_candidates=4, dtype=None):
+    from pytorch_pretrained_bert import BertForMaskedLM, BertTokenizer
+    tokenizer = get_tokenizer(BertTokenizer, model_name_or_path)
+    model = get_model(BertForMaskedLM, model_name_or_path, dtype=dtype)
+
+    candidates = mask_predict(tokenizer, model, text, tokens_to_generate, iterations, n_candidates)
+
+    print("Original:", text)
+    for tokens, score in candidates:
+        print("%.3f" % score, " ".join(tokens).replace(" ##", ""))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,124 @@
+# Copyright 2019 - UMONS
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You should have received a copy of the Apache License Version 2.0 along with this program.
+# If not, see
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Periodic training checkpoints written from a background thread.
+
+    A checkpoint is a dict (model and optimizer state dicts, RNG states, position in the data...) saved as
+    `checkpoint-<step>.pt` in the checkpoint directory. Its tensors are copied to the CPU by the training loop,
+    which then goes on while the copy is serialized and written to disk. Files are written under a temporary name
+    and renamed once complete, so a crash never leaves a truncated checkpoint behind.
+"""
+import glob
+import logging
+import os
+import random
+import re
+import threading
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def rng_state():
+    """ State of the Python, NumPy and PyTorch (CPU and CUDA) random number generators. """
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def _cpu_copy(obj):
+    """ Copy of `obj` where every tensor is detached and copied to the CPU, so training can modify the originals. """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((key, _cpu_copy(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_cpu_copy(value) for value in obj)
+    return obj
+
+
+def _checkpoints(checkpoint_dir):
+    """ Sorted list of the (step, path) of the checkpoints in `checkpoint_dir`. """
+    checkpoints = []
+    for path in glob.glob(os.path.join(checkpoint_dir, 'checkpoint-*.pt')):
+        match = re.match(r'checkpoint-(\d+)\.pt$', os.path.basename(path))
+        if match:
+            checkpoints.append((int(match.group(1)), path))
+    return sorted(checkpoints)
+
+
+def latest_checkpoint(checkpoint_dir):
+    """ Path of the checkpoint of the highest step in `checkpoint_dir`, None if there is none. """
+    checkpoints = _checkpoints(checkpoint_dir)
+    return checkpoints[-1][1] if checkpoints else None
+
+
+def load_checkpoint(path, map_location='cpu'):
+    # Checkpoints hold more than tensors (the optimizer learning rate schedule, the RNG states)
+    return torch.load(path, map_location=map_location, weights_only=False)
+
+
+class AsyncCheckpointer(object):
+    """ Writes checkpoints to `checkpoint_dir` from a background thread, keeping the `keep` most recent ones.
+
+        At most one checkpoint is being written at a time: `save` first waits for the previous one. Errors of the
+        writer thread are raised by the next call to `save` or `wait`.
+    """
+
+    def __init__(self, checkpoint_dir, keep=2):
+        self.checkpoint_dir = checkpoint_dir
+        self.keep = keep
+        self.thread = None
+        self.error = None
+        if not os.path.exists(checkpoint_dir):
+            os.makedirs(checkpoint_dir)
+
+    def save(self, state, step):
+        """ Snapshot `state` now and write it as the checkpoint of `step` in the background. """
+        self.wait()
+        state = _cpu_copy(state)
+        self.thread = threading.Thread(target=self._write, args=(state, step), daemon=True)
+        self.thread.start()
+
+    def _write(self, state, step):
+        try:
+            path = os.path.join(self.checkpoint_dir, 'checkpoint-%d.pt' % step)
+            torch.save(state, path + '.tmp')
+            os.replace(path + '.tmp', path)
+            logger.info("Saved checkpoint %s", path)
+            for _, old_path in _checkpoints(self.checkpoint_dir)[:-self.keep]:
+                os.remove(old_path)
+        except Exception as e:
+            self.error = e
+
+    def wait(self):
+        """ Wait for the checkpoint being written, if any. """
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
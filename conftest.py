@@ -0,0 +1,42 @@
+# Copyright 2019 - UMONS
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You should have received a copy of the Apache License Version 2.0 along with this program.
+# If not, see
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Tiny randomly initialized models shared by the tests. """
+import pytest
+import torch
+from pytorch_pretrained_bert import GPT2Config, GPT2LMHeadModel, OpenAIGPTConfig, OpenAIGPTLMHeadModel
+
+TINY = {'vocab_size_or_config_json_file': 100, 'n_positions': 64, 'n_ctx': 64, 'n_embd': 32, 'n_layer': 2,
+        'n_head': 4}
+
+
+@pytest.fixture
+def tiny_gpt2():
+    torch.manual_seed(0)
+    return GPT2LMHeadModel(GPT2Config(**TINY)).eval()
+
+
+@pytest.fixture
+def tiny_openai():
+    torch.manual_seed(0)
+    return OpenAIGPTLMHeadModel(OpenAIGPTConfig(**TINY)).eval()
+
+
+@pytest.fixture(scope='session')
+def model_dirs(tmp_path_factory):
+    """ `model_dirs(kind)`: directory of the tiny random `kind` model of benchmark.py, with its tokenizer. """
+    import benchmark
+    work_dir = str(tmp_path_factory.mktemp('models'))
+    return lambda kind: benchmark.model_dir(work_dir, kind, 'tiny')
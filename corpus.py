@@ -0,0 +1,122 @@
+# Copyright 2019 - UMONS
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You should have received a copy of the Apache License Version 2.0 along with this program.
+# If not, see
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Tokenized corpus cache for fine-tuning.
+
+    A text file is BPE-tokenized once, in parallel, into two NumPy files next to each other in the cache directory:
+    `<key>.ids` holds the token ids of all the lines back to back and `<key>.offsets` the start of every line
+    (plus the end of the last one). Both are memory-mapped, so examples are read from disk on demand. The key
+    hashes the file (path, size, modification time) with the tokenizer vocabulary, merges and special tokens, so
+    the cache is rebuilt whenever one of them changes.
+"""
+import hashlib
+import itertools
+import json
+import logging
+import os
+from multiprocessing import Pool
+
+import numpy as np
+from torch.utils.data import Dataset
+
+logger = logging.getLogger(__name__)
+
+_worker_tokenizer = None
+
+
+def tokenizer_fingerprint(tokenizer):
+    """ Hash of the vocabulary, merges and special tokens of a BPE tokenizer. """
+    h = hashlib.sha1()
+    h.update(json.dumps(sorted(tokenizer.encoder.items())).encode('utf_8'))
+    h.update(json.dumps(sorted((' '.join(merge), rank) for merge, rank in tokenizer.bpe_ranks.items())).encode('utf_8'))
+    h.update(json.dumps(sorted(tokenizer.special_tokens.items())).encode('utf_8'))
+    return h.hexdigest()
+
+
+def corpus_key(dataset_path, tokenizer):
+    stat = os.stat(dataset_path)
+    h = hashlib.sha1()
+    h.update(json.dumps([os.path.abspath(dataset_path), stat.st_size, stat.st_mtime]).encode('utf_8'))
+    h.update(tokenizer_fingerprint(tokenizer).encode('utf_8'))
+    return h.hexdigest()[:16]
+
+
+def _init_worker(tokenizer):
+    global _worker_tokenizer
+    _worker_tokenizer = tokenizer
+
+
+def _encode_lines(lines):
+    return [_worker_tokenizer.convert_tokens_to_ids(_worker_tokenizer.tokenize(line)) for line in lines]
+
+
+def _chunks(f, chunk_size):
+    while True:
+        lines = list(itertools.islice(f, chunk_size))
+        if not lines:
+            return
+        yield lines
+
+
+def build_corpus(dataset_path, tokenizer, prefix, num_workers=None, chunk_size=1024):
+    """ Tokenize every line of `dataset_path` into `prefix.ids` and `prefix.offsets`. """
+    n_lines, n_tokens = 0, 0
+    offsets = [0]
+    with open(dataset_path, encoding='utf_8') as f, open(prefix + '.ids.tmp', 'wb') as ids_file, \
+            Pool(num_workers, initializer=_init_worker, initargs=(tokenizer,)) as pool:
+        # imap keeps the order of the chunks while the workers tokenize ahead
+        for encoded_lines in pool.imap(_encode_lines, _chunks(f, chunk_size)):
+            for ids in encoded_lines:
+                np.asarray(ids, dtype=np.int32).tofile(ids_file)
+                n_tokens += len(ids)
+                offsets.append(n_tokens)
+            n_lines += len(encoded_lines)
+    np.save(prefix + '.offsets.tmp.npy', np.asarray(offsets, dtype=np.int64))
+    # Rename last so an interrupted build is never mistaken for a complete cache
+    os.replace(prefix + '.ids.tmp', prefix + '.ids')
+    os.replace(prefix + '.offsets.tmp.npy', prefix + '.offsets.npy')
+    logger.info("Tokenized %d lines (%d tokens) of %s", n_lines, n_tokens, dataset_path)
+
+
+class TokenizedCorpus(Dataset):
+    """ Memory-mapped token ids of every line of a text file, `corpus[i]` is a np.int32 array. """
+
+    def __init__(self, prefix):
+        self.offsets = np.load(prefix + '.offsets.npy', mmap_mode='r')
+        n_tokens = int(self.offsets[-1])
+        # np.memmap can't map an empty file
+        self.ids = np.memmap(prefix + '.ids', dtype=np.int32, mode='r') if n_tokens else np.zeros(0, np.int32)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.ids[self.offsets[i]:self.offsets[i + 1]]
+
+    def lengths(self):
+        """ Number of tokens of every line. """
+        return np.diff(self.offsets)
+
+
+def load_corpus(dataset_path, tokenizer, cache_dir, num_workers=None):
+    """ Tokenized version of `dataset_path`, built in `cache_dir` on first use. """
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    prefix = os.path.join(cache_dir, os.path.basename(dataset_path) + '.' + corpus_key(dataset_path, tokenizer))
+    if os.path.exists(prefix + '.ids') and os.path.exists(prefix + '.offsets.npy'):
+        logger.info("Loading tokenized %s from %s", dataset_path, prefix)
+    else:
+        build_corpus(dataset_path, tokenizer, prefix, num_workers)
+    return TokenizedCorpus(prefix)
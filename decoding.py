@@ -0,0 +1,261 @@
+# Copyright 2019 - UMONS
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You should have received a copy of the Apache License Version 2.0 along with this program.
+# If not, see
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Incremental (key/value cached) decoding shared by the GPT and GPT-2 generators.
+
+    The cache (`past`) has the layout used by `GPT2LMHeadModel`: one tensor per layer of shape
+    (2, batch, head, seq_length, head_features) holding the keys and values of every token already seen.
+    Only the new tokens are fed to the model at each step. Both step functions also accept an attention mask
+    and explicit position ids so that left-padded batches of prompts can share one forward pass.
+
+    A `TracedDecoder` (see export.py) runs the same step from a TorchScript file, without building the model in
+    Python. Its cache is a single tensor stacking the layers, which the functions here also accept.
+"""
+import json
+import math
+import os
+import types
+
+import torch
+import torch.nn as nn
+
+from sampling import LogitsSampler
+from tracing import NULL_TRACER
+
+
+def _cached_attention(attn, x, layer_past=None, attention_mask=None, mask_value=-1e9):
+    """ Cached version of the `Attention.forward` of both GPT and GPT-2.
+
+        `attention_mask` is an optional (batch, past_length + seq_length) tensor with 0 on the padded keys.
+    """
+    x = attn.c_attn(x)
+    query, key, value = x.split(attn.split_size, dim=2)
+    query = attn.split_heads(query)
+    key = attn.split_heads(key, k=True)
+    value = attn.split_heads(value)
+    if layer_past is not None:
+        past_key, past_value = layer_past[0].transpose(-2, -1), layer_past[1]
+        key = torch.cat((past_key, key), dim=-1)
+        value = torch.cat((past_value, value), dim=-2)
+    present = torch.stack((key.transpose(-2, -1), value))
+
+    w = torch.matmul(query, key)
+    if attn.scale:
+        w = w / math.sqrt(value.size(-1))
+    # The new queries sit at the end of the sequence, so the causal mask has to be offset by the cache length
+    nd, ns = w.size(-2), w.size(-1)
+    if attention_mask is None:
+        b = attn.bias[:, :, ns - nd:ns, :ns]
+    else:
+        b = torch.ones(nd, ns, dtype=w.dtype, device=w.device).tril(ns - nd)
+        b = b.view(1, 1, nd, ns) * attention_mask.to(w.dtype).view(-1, 1, 1, ns)
+    w = w * b + mask_value * (1 - b)
+    w = nn.Softmax(dim=-1)(w)
+    if hasattr(attn, 'attn_dropout'):
+        w = attn.attn_dropout(w)
+    a = torch.matmul(w, value)
+
+    a = attn.merge_heads(a)
+    a = attn.c_proj(a)
+    if hasattr(attn, 'resid_dropout'):
+        a = attn.resid_dropout(a)
+    return a, present
+
+
+def _position_ids(input_ids, past, position_ids):
+    if position_ids is not None:
+        return position_ids
+    past_length = 0 if past is None else past[0][0].size(-2)
+    position_ids = torch.arange(past_length, past_length + input_ids.size(-1), dtype=torch.long,
+                                device=input_ids.device)
+    return position_ids.unsqueeze(0).expand_as(input_ids)
+
+
+def gpt2_step(model, input_ids, past=None, attention_mask=None, position_ids=None):
+    """ Run `input_ids` through a GPT-2 LM model on top of `past`, returns (logits, presents). """
+    if attention_mask is None:
+        return model(input_ids, position_ids=position_ids, past=past)
+
+    transformer = model.transformer
+    position_ids = _position_ids(input_ids, past, position_ids)
+    if past is None:
+        past = [None] * len(transformer.h)
+    hidden_states = transformer.wte(input_ids) + transformer.wpe(position_ids)
+    presents = []
+    for block, layer_past in zip(transformer.h, past):
+        a, present = _cached_attention(block.attn, block.ln_1(hidden_states), layer_past, attention_mask, -1e4)
+        hidden_states = hidden_states + a
+        hidden_states = hidden_states + block.mlp(block.ln_2(hidden_states))
+        presents.append(present)
+    return model.lm_head(transformer.ln_f(hidden_states)), presents
+
+
+def openai_step(model, input_ids, past=None, attention_mask=None, position_ids=None):
+    """ Run `input_ids` through an OpenAI-GPT LM model on top of `past`, returns (logits, presents).
+
+        `OpenAIGPTModel` has no cache of its own, so the blocks are replayed here with their own weights.
+    """
+    transformer = model.transformer
+    position_ids = _position_ids(input_ids, past, position_ids)
+    if past is None:
+        past = [None] * len(transformer.h)
+    hidden_states = transformer.tokens_embed(input_ids) + transformer.positions_embed(position_ids)
+    presents = []
+    for block, layer_past in zip(transformer.h, past):
+        a, present = _cached_attention(block.attn, hidden_states, layer_past, attention_mask)
+        n = block.ln_1(hidden_states + a)
+        m = block.mlp(n)
+        hidden_states = block.ln_2(n + m)
+        presents.append(present)
+    return model.lm_head(hidden_states), presents
+
+
+TRACED_DECODER_NAME = 'decoder.pt'
+
+
+class TracedDecoder(nn.Module):
+    """ Decoding step of a GPT or GPT-2 LM model traced by export.py.
+
+        `module(input_ids, position_ids, past)` returns the logits of the last position and the new cache,
+        `past` stacking the caches of all the layers: (layer, 2, batch, head, seq_length, head_features).
+        `config` has the fields of the model's config used by the generators.
+    """
+
+    def __init__(self, module, config):
+        super(TracedDecoder, self).__init__()
+        self.module = module
+        self.config = config
+
+    def forward(self, input_ids, position_ids, past):
+        return self.module(input_ids, position_ids, past)
+
+
+def load_traced_decoder(directory, device=None):
+    """ Load the TracedDecoder exported to `directory`. """
+    extra_files = {'config.json': ''}
+    module = torch.jit.load(os.path.join(directory, TRACED_DECODER_NAME), map_location=device,
+                            _extra_files=extra_files)
+    return TracedDecoder(module, types.SimpleNamespace(**json.loads(extra_files['config.json'])))
+
+
+def traced_step(model, input_ids, past=None, attention_mask=None, position_ids=None):
+    """ Run `input_ids` through a TracedDecoder on top of `past`, returns (logits, presents).
+
+        Only the logits of the last position are computed, as a (batch, 1, vocab) tensor.
+    """
+    if attention_mask is not None:
+        raise ValueError("Traced decoders don't support padded batches")
+    config = model.config
+    if past is None:
+        past = torch.zeros((config.n_layer, 2, input_ids.size(0), config.n_head, 0, config.n_embd // config.n_head),
+                           device=input_ids.device)
+    elif not torch.is_tensor(past):
+        past = torch.stack(past)
+    logits, presents = model(input_ids, _position_ids(input_ids, past, position_ids), past)
+    return logits.unsqueeze(1), presents
+
+
+def model_step(model):
+    """ Return the incremental step function to use with `model`. """
+    if isinstance(model, TracedDecoder):
+        return traced_step
+    # Imported here, traced decoders run without the model classes
+    from pytorch_pretrained_bert import GPT2LMHeadModel, OpenAIGPTLMHeadModel
+    if isinstance(model, GPT2LMHeadModel):
+        return gpt2_step
+    if isinstance(model, OpenAIGPTLMHeadModel):
+        return openai_step
+    raise ValueError("No incremental decoder for model of type %s" % type(model).__name__)
+
+
+def generate_tokens(model, context_ids, tokens_to_generate, sampler=None, generator=None, tracer=None,
+                    prefix_cache=None):
+    """ Generate `tokens_to_generate` ids after `context_ids`, yielding each one as a (1, 1) LongTensor.
+
+        The context is encoded once, then only the last predicted token is fed to the model at each step.
+        Tokens are picked by the LogitsSampler `sampler` (greedy by default), with the torch.Generator
+        `generator` if given. `tracer` (see tracing.py) receives the timings of the phases of every step.
+        With a PrefixCache `prefix_cache` (see prefix_cache.py), the longest cached prefix of the context is
+        not encoded again, and the context is cached for the next requests.
+    """
+    sampler = sampler or LogitsSampler(greedy=True)
+    tracer = tracer or NULL_TRACER
+    step = model_step(model)
+    device = next(model.parameters()).device
+    generators = [generator] if generator is not None else None
+    with tracer.span('transfer'):
+        # The whole sequence, for the repetition penalty
+        sequence = torch.empty((1, len(context_ids) + tokens_to_generate), dtype=torch.long, device=device)
+        sequence[0, :len(context_ids)] = torch.tensor(context_ids, dtype=torch.long)
+    past, cached_length = None, 0
+    if prefix_cache is not None:
+        with tracer.span('prefix_cache'):
+            past, cached_length = prefix_cache.lookup(context_ids)
+    input_ids = sequence[:, cached_length:len(context_ids)]
+    for i in range(tokens_to_generate):
+        length = len(context_ids) + i
+        with tracer.span('forward'), torch.no_grad():
+            logits, past = step(model, input_ids, past)
+        if i == 0 and prefix_cache is not None:
+            with tracer.span('prefix_cache'):
+                prefix_cache.insert(context_ids, past)
+        with tracer.span('sample'):
+            input_ids = sampler(logits[:, -1, :], sequence[:, :length], generators)
+            sequence[:, length] = input_ids[:, 0]
+        tracer.step(1, length)
+        yield input_ids
+
+
+def greedy_tokens(model, context_ids, tokens_to_generate, tracer=None, prefix_cache=None):
+    """ Greedily generate `tokens_to_generate` ids after `context_ids`, yielding each one as a (1, 1) LongTensor. """
+    return generate_tokens(model, context_ids, tokens_to_generate, tracer=tracer, prefix_cache=prefix_cache)
+
+
+def decode(model, context_ids, tokens_to_generate, sampler=None, generator=None, prefix_cache=None):
+    """ Generate `tokens_to_generate` ids after `context_ids` with `sampler` (greedy by default).
+
+        Returns a LongTensor of shape (tokens_to_generate,) on the model's device.
+    """
+    device = next(model.parameters()).device
+    output = torch.empty(tokens_to_generate, dtype=torch.long, device=device)
+    for i, token in enumerate(generate_tokens(model, context_ids, tokens_to_generate, sampler, generator,
+                                              prefix_cache=prefix_cache)):
+        output[i] = token[0, 0]
+    return output
+
+
+def greedy_decode(model, context_ids, tokens_to_generate):
+    """ Greedily generate `tokens_to_generate` ids after `context_ids`.
+
+        Returns a LongTensor of shape (tokens_to_generate,) on the model's device.
+    """
+    return decode(model, context_ids, tokens_to_generate)
+
+
+def select_past(past, index):
+    """ Keep (and reorder) the batch rows of `past` given by the LongTensor `index`. """
+    return [layer_past.index_select(1, index) for layer_past in past]
+
+
+def left_pad_past(past, length):
+    """ Left-pad every layer of `past` with zeros along the sequence axis up to `length` tokens. """
+    padded = []
+    for layer_past in past:
+        missing = length - layer_past.size(-2)
+        if missing > 0:
+            layer_past = torch.cat((layer_past.new_zeros(layer_past.shape[:-2] + (missing, layer_past.size(-1))),
+                                    layer_past), dim=-2)
+        padded.append(layer_past)
+    return padded
@@ -0,0 +1,147 @@
+# Copyright 2019 - UMONS
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You should have received a copy of the Apache License Version 2.0 along with this program.
+# If not, see
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Streaming detokenizers: the text of a sequence of token ids, given one id at a time.
+
+    `add(token_id)` returns the text that the new token completes, possibly empty, and `flush()` the rest once
+    the sequence is over. Together they give the same text as decoding the whole sequence, in constant time per
+    token. Some tokens can only be written once the next ones are known:
+
+    - GPT-2 tokens are byte sequences, a character can be split between tokens. The bytes of an incomplete
+      UTF-8 character wait for the next tokens, like `GPT2Tokenizer.decode`.
+    - OpenAI GPT marks the end of words with `</w>`, turned into spaces. Spaces wait for the next word, since
+      `OpenAIGPTTokenizer.decode` strips them at both ends of the text.
+    - Transformer-XL symbols are WikiText words, written with the detokenization rules of `WIKITEXT_RULES`,
+      which glue `@-@` hyphens or punctuation to their neighbours. Punctuation waits for the next word.
+"""
+import codecs
+
+# Applied in this order to the text of the symbols joined by spaces, `<eos>` being a new line
+WIKITEXT_RULES = [(' @-@ ', '-'), (' @,@ ', ','), (' @.@ ', '.'), (' . ', '. '), (' , ', ', '), (' : ', ': '),
+                  (' ; ', '; '), (" 's ", "'s "), (' ( ', ' ('), (' ) ', ') ')]
+_WIKITEXT_SYMBOLS = frozenset(pattern.strip() for pattern, _ in WIKITEXT_RULES)
+
+
+class GPT2Detokenizer(object):
+    """ Streaming `GPT2Tokenizer.decode`. """
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.decoder = codecs.getincrementaldecoder('utf_8')(errors=tokenizer.errors)
+
+    def add(self, token_id):
+        special = self.tokenizer.special_tokens_decoder.get(token_id)
+        if special is not None:
+            return self.flush() + special
+        byte_decoder = self.tokenizer.byte_decoder
+        return self.decoder.decode(bytes(byte_decoder[c] for c in self.tokenizer.decoder[token_id]))
+
+    def flush(self):
+        return self.decoder.decode(b'', final=True)
+
+
+class OpenAIGPTDetokenizer(object):
+    """ Streaming `OpenAIGPTTokenizer.decode` (without `clean_up_tokenization_spaces`). """
+    end_of_word = '</w>'
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.buffer = ''  # End of the text that may be the start of `</w>`
+        self.spaces = ''  # Whitespace after the last word
+        self.started = False
+
+    def _write(self, text):
+        if not self.started:
+            text = text.lstrip()
+            self.started = bool(text)
+        words = text.rstrip()
+        if not words:
+            self.spaces += text
+            return ''
+        text, self.spaces = self.spaces + text, text[len(words):]
+        return text[:len(text) - len(self.spaces)]
+
+    def add(self, token_id):
+        text = self.buffer + self.tokenizer.convert_ids_to_tokens([token_id])[0]
+        # `</w>` can't overlap itself, so an occurrence is never split between the text and the buffer
+        kept = next((n for n in range(len(self.end_of_word) - 1, 0, -1)
+                     if text.endswith(self.end_of_word[:n])), 0)
+        self.buffer = text[len(text) - kept:]
+        return self._write(text[:len(text) - kept].replace(self.end_of_word, ' '))
+
+    def flush(self):
+        text = self._write(self.buffer)
+        self.buffer = ''
+        return text
+
+
+class WikiTextDetokenizer(object):
+    """ Streaming WikiText detokenization of Transformer-XL symbols, see `WIKITEXT_RULES`.
+
+        A rule only involves the symbols it glues and the spaces around them, so the symbols it applies to are
+        held until the next other symbol and only that run, with the space before it, goes through the rules.
+    """
+
+    def __init__(self, tokenizer=None):
+        self.tokenizer = tokenizer
+        self.run = []  # Symbols of the rules since the last word
+        self.space = False  # Space after the last word, not written yet
+
+    def add(self, token_id):
+        return self.add_symbol(self.tokenizer.get_sym(token_id))
+
+    def add_symbol(self, symbol):
+        if symbol in _WIKITEXT_SYMBOLS:
+            self.run.append(symbol)
+            return ''
+        text = self._write_run() + (' ' if self.space else '')
+        if symbol == '<eos>':
+            self.space = False
+            return text + '\n'
+        self.space = True
+        return text + symbol
+
+    def _write_run(self):
+        if not self.run:
+            return ''
+        text = (' ' if self.space else '') + ' '.join(self.run) + ' '
+        for pattern, replacement in WIKITEXT_RULES:
+            text = text.replace(pattern, replacement)
+        self.run = []
+        self.space = text.endswith(' ')
+        return text[:-1] if self.space else text
+
+    def flush(self):
+        text = self._write_run() + (' ' if self.space else '')
+        self.space = False
+        return text
+
+
+def get_detokenizer(tokenizer):
+    """ New streaming detokenizer for the ids of `tokenizer`. """
+    from pytorch_pretrained_bert import GPT2Tokenizer, OpenAIGPTTokenizer, TransfoXLTokenizer
+    if isinstance(tokenizer, GPT2Tokenizer):
+        return GPT2Detokenizer(tokenizer)
+    if isinstance(tokenizer, OpenAIGPTTokenizer):
+        return OpenAIGPTDetokenizer(tokenizer)
+    if isinstance(tokenizer, TransfoXLTokenizer):
+        return WikiTextDetokenizer(tokenizer)
+    raise ValueError("No detokenizer for tokenizer of type %s" % type(tokenizer).__name__)
+
+
+def detokenize(tokenizer, token_ids):
+    """ Text of the whole sequence `token_ids`. """
+    detokenizer = get_detokenizer(tokenizer)
+    return ''.join([detokenizer.add(token_id) for token_id in token_ids]) + detokenizer.flush()
@@ -0,0 +1,104 @@
+# Copyright 2019 - UMONS
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You should have received a copy of the Apache License Version 2.0 along with this program.
+# If not, see
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Export the decoding step of a GPT or GPT-2 model to TorchScript.
+
+    The step takes the new token ids, their positions and the cache of all the layers stacked in one tensor,
+    and returns the logits of the last position and the new cache. It is traced once, with a single token on a
+    cache of one token, and the trace holds for any batch, number of new tokens and cache length, so the same
+    file encodes the prompt and decodes the following tokens.
+
+    The output directory holds `decoder.pt`, with the config of the model, and the tokenizer files. Given as
+    `model_name_or_path` to `gpt2.py`, `openai.py` or the server, it is loaded through the registry in place of
+    the model: no Python model is built and no weights are deserialized into it.
+"""
+import argparse
+import json
+import logging
+import os
+import warnings
+
+import torch
+import torch.nn as nn
+
+from pytorch_pretrained_bert import GPT2LMHeadModel, GPT2Tokenizer, OpenAIGPTLMHeadModel, OpenAIGPTTokenizer
+
+from decoding import TRACED_DECODER_NAME, model_step
+from registry import get_model, get_tokenizer
+
+logger = logging.getLogger(__name__)
+
+MODELS = {'gpt2': (GPT2Tokenizer, GPT2LMHeadModel),
+          'openai-gpt': (OpenAIGPTTokenizer, OpenAIGPTLMHeadModel)}
+
+
+class _DecodeStep(nn.Module):
+    """ `model_step` of `model` with the layer caches stacked in one tensor, as traced by `export_decoder`. """
+
+    def __init__(self, model):
+        super(_DecodeStep, self).__init__()
+        self.model = model
+        self.step = model_step(model)
+
+    def forward(self, input_ids, position_ids, past):
+        logits, presents = self.step(self.model, input_ids, list(past.unbind(0)), None, position_ids)
+        return logits[:, -1], torch.stack(presents)
+
+
+def export_decoder(model, output_dir, tokenizer=None):
+    """ Trace the decoding step of the GPT or GPT-2 LM model `model` to `output_dir`, with `tokenizer` if given. """
+    config = model.config
+    head_features = config.n_embd // config.n_head
+    past = torch.zeros((config.n_layer, 2, 1, config.n_head, 1, head_features))
+    example = (torch.zeros((1, 1), dtype=torch.long), torch.ones((1, 1), dtype=torch.long), past)
+    with torch.no_grad(), warnings.catch_warnings():
+        # The only values the trace takes as constants are the head size and the config
+        warnings.simplefilter('ignore', torch.jit.TracerWarning)
+        traced = torch.jit.trace(_DecodeStep(model).eval(), example, check_trace=False)
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    fields = {'model_type': 'gpt2' if isinstance(model, GPT2LMHeadModel) else 'openai-gpt',
+              'n_layer': config.n_layer, 'n_head': config.n_head, 'n_embd': config.n_embd,
+              'n_positions': config.n_positions, 'n_ctx': config.n_ctx, 'vocab_size': config.vocab_size}
+    torch.jit.save(traced, os.path.join(output_dir, TRACED_DECODER_NAME),
+                   _extra_files={'config.json': json.dumps(fields)})
+    if tokenizer is not None:
+        tokenizer.save_vocabulary(output_dir)
+    logger.info("Exported the decoder of %s to %s", type(model).__name__, output_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_type', type=str, default='gpt2', choices=sorted(MODELS))
+    parser.add_argument('--model_name_or_path', type=str, default='gpt2',
+                        help='pretrained model name or path to local checkpoint')
+    parser.add_argument('--output_dir', type=str, required=True)
+    parser.add_argument('--quantize', action='store_true',
+                        help='Export the model with its linear layers in int8, for CPU (see quantization.py).')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                        datefmt='%m/%d/%Y %H:%M:%S',
+                        level=logging.INFO)
+
+    tokenizer_class, model_class = MODELS[args.model_type]
+    tokenizer = get_tokenizer(tokenizer_class, args.model_name_or_path)
+    model = get_model(model_class, args.model_name_or_path, dtype=torch.qint8 if args.quantize else None)
+    export_decoder(model, args.output_dir, tokenizer)
+
+
+if __name__ == '__main__':
+    main()
@@ -21,19 +21,30 @@
     It self adapted from https://github.com/openai/finetune-transformer-lm/blob/master/train.py
 """
 import argparse
+import contextlib
+import math
 import os
 import random
 import logging
+import time
 from tqdm import tqdm, trange
 
 import numpy as np
 import torch
-from torch.utils.data import (DataLoader, RandomSampler, SequentialSampler,
-                              TensorDataset)
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn.functional as F
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.checkpoint import checkpoint
+from torch.utils.data import BatchSampler, DataLoader, Dataset, RandomSampler, Sampler, SequentialSampler
 
 from pytorch_pretrained_bert import (OpenAIGPTDoubleHeadsModel, OpenAIGPTTokenizer,
                                      OpenAIAdam, WEIGHTS_NAME, CONFIG_NAME)
 
+from checkpointing import AsyncCheckpointer, latest_checkpoint, load_checkpoint, rng_state, set_rng_state
+from corpus import load_corpus
+from perplexity import lm_nll
+
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
                     datefmt='%m/%d/%Y %H:%M:%S',
                     level=logging.INFO)
@@ -45,29 +56,162 @@ def accuracy(out, labels):
     return np.sum(outputs == labels)
 
 
-def load_dataset(dataset_path):
-    with open(dataset_path, encoding='utf_8') as f:
-        output = [line for line in f.readlines()]
-    return output
-
+def enable_gradient_checkpointing(model):
+    """ Recompute the activations of each transformer block during the backward pass instead of keeping them.
 
-def pre_process_dataset(encoded_datasets, input_len, cap_length, start_token, clf_token):
-    """ Pre-process datasets to Transformer inputs of shape (n_batch, n_alternative, length) comprising for each batch, continuation:
-        input_ids[batch, alternative, :] = [start_token] + line[:cap_length] + [clf_token]
+        The blocks' `forward` is wrapped in place, so the module tree and the saved weights are unchanged.
+    """
+    for block in model.transformer.h:
+        def checkpointed_forward(x, forward=block.forward, block=block):
+            if block.training and torch.is_grad_enabled():
+                return checkpoint(forward, x, use_reentrant=False)
+            return forward(x)
+        block.forward = checkpointed_forward
+
+
+class PreProcessedDataset(Dataset):
+    """ Transformer inputs built on the fly from a tokenized corpus, each example being (with n_alternative = 1):
+        input_ids[alternative, :] = [start_token] + line[:cap_length] + [clf_token]
+        with the matching mc_token_ids[alternative] and mc_label. Padding is left to `pad_collate`.
     """
-    n_batch = len(encoded_datasets)
-    input_ids = np.zeros((n_batch, 1, input_len), dtype=np.int64)
-    mc_token_ids = np.zeros((n_batch, 1), dtype=np.int64)
-    lm_labels = np.full((n_batch, 1, input_len), fill_value=-1, dtype=np.int64)
-    mc_labels = np.zeros((n_batch,), dtype=np.int64)
-    for i, line in enumerate(encoded_datasets):
-        with_cont = [start_token] + line[:cap_length] + [clf_token]
+
+    def __init__(self, corpus, cap_length, start_token, clf_token):
+        self.corpus = corpus
+        self.cap_length = cap_length
+        self.start_token = start_token
+        self.clf_token = clf_token
+
+    def __len__(self):
+        return len(self.corpus)
+
+    def lengths(self):
+        return np.minimum(self.corpus.lengths(), self.cap_length) + 2
+
+    def __getitem__(self, i):
+        line = self.corpus[i][:self.cap_length]
+        with_cont = np.concatenate(([self.start_token], line, [self.clf_token])).astype(np.int64)
+        return with_cont, 0
+
+
+def pad_collate(examples):
+    """ Pad a list of examples to the longest of them, returns (input_ids, mc_token_ids, lm_labels, mc_labels). """
+    input_len = max(len(with_cont) for with_cont, _ in examples)
+    input_ids = np.zeros((len(examples), 1, input_len), dtype=np.int64)
+    mc_token_ids = np.zeros((len(examples), 1), dtype=np.int64)
+    lm_labels = np.full((len(examples), 1, input_len), fill_value=-1, dtype=np.int64)
+    mc_labels = np.zeros((len(examples),), dtype=np.int64)
+    for i, (with_cont, mc_label) in enumerate(examples):
         input_ids[i, 0, :len(with_cont)] = with_cont
         mc_token_ids[i, 0] = len(with_cont) - 1
         lm_labels[i, 0, :len(with_cont)] = with_cont
-        mc_labels[i] = 0
+        mc_labels[i] = mc_label
     all_inputs = (input_ids, mc_token_ids, lm_labels, mc_labels)
-    return tuple(torch.tensor(t) for t in all_inputs)
+    return tuple(torch.from_numpy(t) for t in all_inputs)
+
+
+class BucketBatchSampler(Sampler):
+    """ Batches of examples of similar lengths, so that `pad_collate` adds little padding.
+
+        The examples are shuffled, cut in pools of `batch_size * bucket_multiplier` examples, each pool is sorted by
+        length and cut in batches, and the order of all the batches is shuffled. Larger pools give less padding
+        but less randomness.
+    """
+
+    def __init__(self, lengths, batch_size, bucket_multiplier=50, shuffle=True):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.pool_size = batch_size * bucket_multiplier
+        self.shuffle = shuffle
+
+    def __iter__(self):
+        indexes = np.random.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+        batches = []
+        for start in range(0, len(indexes), self.pool_size):
+            pool = indexes[start:start + self.pool_size]
+            pool = pool[np.argsort(self.lengths[pool], kind='stable')]
+            batches.extend(pool[i:i + self.batch_size].tolist() for i in range(0, len(pool), self.batch_size))
+        if self.shuffle:
+            batches = [batches[i] for i in np.random.permutation(len(batches))]
+        return iter(batches)
+
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+
+class ShardedBatchSampler(Sampler):
+    """ The batches of `batch_sampler` that fall to the process `rank` out of `world_size`.
+
+        Every process draws the same batches (they share the random seed) and takes one in `world_size` of them.
+        The first batches are repeated at the end so that all the processes run the same number of steps.
+    """
+
+    def __init__(self, batch_sampler, rank, world_size):
+        self.batch_sampler = batch_sampler
+        self.rank = rank
+        self.world_size = world_size
+
+    def __iter__(self):
+        batches = list(self.batch_sampler)
+        batches += batches[:len(self) * self.world_size - len(batches)]
+        return iter(batches[self.rank::self.world_size])
+
+    def __len__(self):
+        return (len(self.batch_sampler) + self.world_size - 1) // self.world_size
+
+
+def bind_to_core_group(local_rank, local_world_size):
+    """ Pin this process and its intra-op threads to its own contiguous share of the available cores. """
+    if not hasattr(os, 'sched_getaffinity'):
+        return
+    cores = sorted(os.sched_getaffinity(0))
+    group_size = max(len(cores) // local_world_size, 1)
+    start = local_rank * group_size % len(cores)
+    group = cores[start:start + group_size]
+    os.sched_setaffinity(0, group)
+    torch.set_num_threads(len(group))
+    logger.info("Process %d bound to cores %s", local_rank, group)
+
+
+def init_distributed():
+    """ (rank, local rank, world size) of this process, joining the gloo process group if there is more than one.
+
+        The processes are described by the RANK, LOCAL_RANK, WORLD_SIZE and LOCAL_WORLD_SIZE environment variables,
+        as set by `torchrun` or by the `--nproc` launcher.
+    """
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size == 1:
+        return 0, 0, 1
+    rank = int(os.environ['RANK'])
+    local_rank = int(os.environ.get('LOCAL_RANK', rank))
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    bind_to_core_group(local_rank, int(os.environ.get('LOCAL_WORLD_SIZE', world_size)))
+    return rank, local_rank, world_size
+
+
+def _distributed_worker(local_rank, args):
+    os.environ.update(RANK=str(local_rank), LOCAL_RANK=str(local_rank), WORLD_SIZE=str(args.nproc),
+                      LOCAL_WORLD_SIZE=str(args.nproc))
+    fine_tune(args)
+
+
+class SkipBatchSampler(Sampler):
+    """ Batches of `batch_sampler`, the first `skip` of them being left out of the next iteration only.
+
+        All the batches of an epoch are drawn when the iteration starts, so the random state used to shuffle them
+        is the one at that time, whichever sampler is wrapped.
+    """
+
+    def __init__(self, batch_sampler):
+        self.batch_sampler = batch_sampler
+        self.skip = 0
+
+    def __iter__(self):
+        batches = list(self.batch_sampler)[self.skip:]
+        self.skip = 0
+        return iter(batches)
+
+    def __len__(self):
+        return len(self.batch_sampler)
 
 
 def main():
@@ -80,10 +224,21 @@ def main():
                         help="The output directory where the model predictions and checkpoints will be written.")
     parser.add_argument('--train_dataset', type=str, default='')
     parser.add_argument('--eval_dataset', type=str, default='')
+    parser.add_argument('--cache_dir', type=str, default=None,
+                        help="Where the tokenized datasets are cached, defaults to `output_dir`/cache.")
+    parser.add_argument('--num_workers', type=int, default=None,
+                        help="Number of processes tokenizing the datasets, defaults to the number of cores.")
     parser.add_argument('--seed', type=int, default=42)
     parser.add_argument('--num_train_epochs', type=int, default=3)
     parser.add_argument('--train_batch_size', type=int, default=8)
+    parser.add_argument('--gradient_accumulation_steps', type=int, default=1,
+                        help="Number of batches whose gradients are accumulated before each optimizer step.")
+    parser.add_argument('--bf16', action='store_true', help="Run the forward passes under bfloat16 autocast.")
+    parser.add_argument('--gradient_checkpointing', action='store_true',
+                        help="Recompute the transformer blocks activations in the backward pass to save memory.")
     parser.add_argument('--eval_batch_size', type=int, default=16)
+    parser.add_argument('--bucket_multiplier', type=int, default=50,
+                        help="Batches are made of similar lengths within pools of this many batches, 0 to disable.")
     parser.add_argument('--max_grad_norm', type=int, default=1)
     parser.add_argument('--learning_rate', type=float, default=6.25e-5)
     parser.add_argument('--warmup_proportion', type=float, default=0.002)
@@ -91,12 +246,37 @@ def main():
     parser.add_argument('--weight_decay', type=float, default=0.01)
     parser.add_argument('--lm_coef', type=float, default=0.9)
     parser.add_argument('--n_valid', type=int, default=374)
+    parser.add_argument('--save_steps', type=int, default=0,
+                        help="Write a checkpoint every this many optimizer steps, 0 to disable.")
+    parser.add_argument('--save_seconds', type=float, default=0,
+                        help="Write a checkpoint every this many seconds, 0 to disable.")
+    parser.add_argument('--resume', action='store_true',
+                        help="Continue training from the last checkpoint of `output_dir`.")
+    parser.add_argument('--nproc', type=int, default=1,
+                        help="Number of training processes on this machine, each on its own group of cores, "
+                             "synchronized with DistributedDataParallel over gloo.")
+    parser.add_argument('--master_port', type=str, default='29500',
+                        help="Port used by the `--nproc` processes to communicate.")
 
     parser.add_argument('--server_ip', type=str, default='', help="Can be used for distant debugging.")
     parser.add_argument('--server_port', type=str, default='', help="Can be used for distant debugging.")
     args = parser.parse_args()
     print(args)
 
+    if args.nproc > 1 and 'WORLD_SIZE' not in os.environ:
+        os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+        os.environ.setdefault('MASTER_PORT', args.master_port)
+        mp.spawn(_distributed_worker, args=(args,), nprocs=args.nproc)
+    else:
+        fine_tune(args)
+
+
+def fine_tune(args):
+    rank, local_rank, world_size = init_distributed()
+    if rank != 0:
+        # Only the first process logs, checkpoints and evaluates
+        logging.getLogger().setLevel(logging.WARNING)
+
     if args.server_ip and args.server_port:
         # Distant debugging - see https://code.visualstudio.com/docs/python/debugging#_attach-to-a-local-script
         import ptvsd
@@ -109,14 +289,18 @@ def main():
     torch.manual_seed(args.seed)
     torch.cuda.manual_seed_all(args.seed)
 
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    device = torch.device("cuda", local_rank) if torch.cuda.is_available() else torch.device("cpu")
     n_gpu = torch.cuda.device_count()
-    logger.info("device: {}, n_gpu {}".format(device, n_gpu))
+    logger.info("device: {}, n_gpu {}, processes {}".format(device, n_gpu, world_size))
 
     if not args.do_train and not args.do_eval:
         raise ValueError("At least one of `do_train` or `do_eval` must be True.")
 
-    if not os.path.exists(args.output_dir):
+    if args.gradient_accumulation_steps < 1:
+        raise ValueError("Invalid gradient_accumulation_steps parameter: {}, should be >= 1".format(
+                            args.gradient_accumulation_steps))
+
+    if rank == 0 and not os.path.exists(args.output_dir):
         os.makedirs(args.output_dir)
 
     # Load tokenizer and model
@@ -127,42 +311,48 @@ def main():
     special_tokens_ids = list(tokenizer.convert_tokens_to_ids(token) for token in special_tokens)
     model = OpenAIGPTDoubleHeadsModel.from_pretrained(args.model_name, num_special_tokens=len(special_tokens))
     model.to(device)
+    if args.gradient_checkpointing:
+        enable_gradient_checkpointing(model)
+    if world_size > 1:
+        model = DistributedDataParallel(model, device_ids=[local_rank] if device.type == 'cuda' else None)
 
-    def tokenize_and_encode(obj):
-        """ Tokenize and encode a nested object """
-        if isinstance(obj, str):
-            return tokenizer.convert_tokens_to_ids(tokenizer.tokenize(obj))
-        elif isinstance(obj, int):
-            return obj
-        return list(tokenize_and_encode(o) for o in obj)
+    def autocast():
+        if args.bf16:
+            return torch.autocast(device_type=device.type, dtype=torch.bfloat16)
+        return contextlib.nullcontext()
 
     logger.info("Encoding dataset...")
+    cache_dir = args.cache_dir if args.cache_dir is not None else os.path.join(args.output_dir, 'cache')
 
-    max_length = model.config.n_positions // 2 - 2
+    raw_model = model.module if hasattr(model, 'module') else model
+    max_length = raw_model.config.n_positions // 2 - 2
 
-    if args.do_train:
-        train_dataset = load_dataset(args.train_dataset)
-        encoded_train = tokenize_and_encode(train_dataset)
-        max_train_length = max(len(line[:max_length]) + 2 for line in encoded_train)
-        input_length = max_train_length
+    # The first process builds the tokenized corpus cache, the others wait and load it
+    if rank != 0:
+        dist.barrier()
 
-    if args.do_eval:
-        eval_dataset = load_dataset(args.eval_dataset)
-        encoded_eval = tokenize_and_encode(eval_dataset)
-        max_eval_length = max(len(line[:max_length]) + 2 for line in encoded_eval)
-        input_length = max_eval_length
+    if args.do_train:
+        encoded_train = load_corpus(args.train_dataset, tokenizer, cache_dir, args.num_workers)
 
-    if args.do_train and args.do_eval:
-        input_length = max(max_train_length, max_eval_length)
+    if args.do_eval and rank == 0:
+        encoded_eval = load_corpus(args.eval_dataset, tokenizer, cache_dir, args.num_workers)
 
-    input_length = min(input_length, model.config.n_positions)  # Max size of input for the pre-trained model
+    if rank == 0 and world_size > 1:
+        dist.barrier()
 
     # Prepare optimizer
     if args.do_train:
-        train_tensor_dataset = pre_process_dataset(encoded_train, input_length, max_length, *special_tokens_ids)
-        train_data = TensorDataset(*train_tensor_dataset)
-        train_sampler = RandomSampler(train_data)
-        train_dataloader = DataLoader(train_data, sampler=train_sampler, batch_size=args.train_batch_size)
+        # Each batch is only padded to its own longest example
+        train_data = PreProcessedDataset(encoded_train, max_length, *special_tokens_ids)
+        if args.bucket_multiplier > 0:
+            train_sampler = BucketBatchSampler(train_data.lengths(), args.train_batch_size, args.bucket_multiplier)
+        else:
+            train_sampler = BatchSampler(RandomSampler(train_data), args.train_batch_size, drop_last=False)
+        if world_size > 1:
+            train_sampler = ShardedBatchSampler(train_sampler, rank, world_size)
+        # Resuming in the middle of an epoch skips the batches already seen without loading them
+        train_sampler = SkipBatchSampler(train_sampler)
+        train_dataloader = DataLoader(train_data, batch_sampler=train_sampler, collate_fn=pad_collate)
 
         param_optimizer = list(model.named_parameters())
         no_decay = ['bias', 'LayerNorm.bias', 'LayerNorm.weight']
@@ -170,7 +360,8 @@ def main():
             {'params': [p for n, p in param_optimizer if not any(nd in n for nd in no_decay)], 'weight_decay': 0.01},
             {'params': [p for n, p in param_optimizer if any(nd in n for nd in no_decay)], 'weight_decay': 0.0}
         ]
-        num_train_optimization_steps = len(train_dataloader) * args.num_train_epochs
+        num_train_optimization_steps = (len(train_dataloader) + args.gradient_accumulation_steps - 1) \
+            // args.gradient_accumulation_steps * args.num_train_epochs
         optimizer = OpenAIAdam(optimizer_grouped_parameters,
                                lr=args.learning_rate,
                                warmup=args.warmup_proportion,
@@ -180,23 +371,106 @@ def main():
 
     if args.do_train:
         nb_tr_steps, tr_loss, exp_average_loss = 0, 0, None
+        global_step, start_epoch, start_step = 0, 0, 0
+        checkpoint_dir = os.path.join(args.output_dir, 'checkpoints')
+        checkpointer = AsyncCheckpointer(checkpoint_dir) if rank == 0 else None
+        checkpoint = None
+        if args.resume:
+            checkpoint_path = latest_checkpoint(checkpoint_dir)
+            if checkpoint_path is None:
+                logger.warning("No checkpoint in %s, training from scratch", checkpoint_dir)
+            else:
+                checkpoint = load_checkpoint(checkpoint_path)
+                raw_model.load_state_dict(checkpoint['model'])
+                optimizer.load_state_dict(checkpoint['optimizer'])
+                global_step = checkpoint['global_step']
+                start_epoch, start_step = checkpoint['epoch'], checkpoint['step']
+                nb_tr_steps, tr_loss, exp_average_loss = checkpoint['nb_tr_steps'], checkpoint['tr_loss'], \
+                    checkpoint['exp_average_loss']
+                logger.info("Resuming from %s (epoch %d, step %d)", checkpoint_path, start_epoch, start_step)
+
+        def save_checkpoint(epoch, step):
+            # Checkpoints are only taken after an optimizer step, when no gradient is being accumulated
+            if step + 1 == len(train_dataloader):
+                epoch, step = epoch + 1, 0
+            else:
+                step += 1
+            checkpointer.save({'model': raw_model.state_dict(),
+                               'optimizer': optimizer.state_dict(),
+                               'global_step': global_step,
+                               'epoch': epoch,
+                               'step': step,
+                               'epoch_rng_state': epoch_rng_state if step > 0 else None,
+                               'rng_state': rng_state(),
+                               'nb_tr_steps': nb_tr_steps,
+                               'tr_loss': tr_loss,
+                               'exp_average_loss': exp_average_loss}, global_step)
+
         model.train()
-        for _ in trange(int(args.num_train_epochs), desc="Epoch"):
-            tr_loss = 0
-            nb_tr_steps = 0
-            tqdm_bar = tqdm(train_dataloader, desc="Training")
-            for step, batch in enumerate(tqdm_bar):
+        last_save_time = time.time()
+        for epoch in trange(start_epoch, int(args.num_train_epochs), desc="Epoch"):
+            if checkpoint is not None and checkpoint['epoch_rng_state'] is not None:
+                # Draw the batches of the interrupted epoch again, then skip the ones already trained on
+                epoch_rng_state = checkpoint['epoch_rng_state']
+                set_rng_state(epoch_rng_state)
+                train_sampler.skip = start_step
+                batches = iter(train_dataloader)
+                set_rng_state(checkpoint['rng_state'])
+            else:
+                if checkpoint is not None:
+                    set_rng_state(checkpoint['rng_state'])
+                epoch_rng_state = rng_state()
+                batches = iter(train_dataloader)
+                tr_loss = 0
+                nb_tr_steps = 0
+                start_step = 0
+            checkpoint = None
+            nb_tr_tokens, nb_tr_padded_tokens, start_time = 0, 0, time.time()
+            tqdm_bar = tqdm(batches, desc="Training", total=len(train_dataloader), initial=start_step,
+                            disable=rank != 0)
+            for step, batch in enumerate(tqdm_bar, start_step):
                 batch = tuple(t.to(device) for t in batch)
                 input_ids, mc_token_ids, lm_labels, mc_labels = batch
-                losses = model(input_ids, mc_token_ids, lm_labels, mc_labels)
-                loss = args.lm_coef * losses[0] + losses[1]
-                loss.backward()
-                optimizer.step()
-                optimizer.zero_grad()
+                nb_tr_tokens += (lm_labels != -1).sum().item()
+                nb_tr_padded_tokens += input_ids.numel()
+                optimizer_step = (step + 1) % args.gradient_accumulation_steps == 0 \
+                    or step + 1 == len(train_dataloader)
+                # The processes only all-reduce their gradients on the batch of the optimizer step
+                no_sync = model.no_sync() if world_size > 1 and not optimizer_step else contextlib.nullcontext()
+                with no_sync:
+                    with autocast():
+                        losses = model(input_ids, mc_token_ids, lm_labels, mc_labels)
+                        loss = args.lm_coef * losses[0] + losses[1]
+                    (loss / args.gradient_accumulation_steps).backward()
                 tr_loss += loss.item()
                 exp_average_loss = loss.item() if exp_average_loss is None else 0.7 * exp_average_loss + 0.3 * loss.item()
                 nb_tr_steps += 1
+                if optimizer_step:
+                    optimizer.step()
+                    optimizer.zero_grad()
+                    global_step += 1
+                    if rank == 0 and ((args.save_steps > 0 and global_step % args.save_steps == 0) or
+                                      (args.save_seconds > 0 and time.time() - last_save_time >= args.save_seconds)):
+                        save_checkpoint(epoch, step)
+                        last_save_time = time.time()
                 tqdm_bar.desc = "Training loss: {:.2e} lr: {:.2e}".format(exp_average_loss, optimizer.get_lr()[0])
+            elapsed = time.time() - start_time
+            if world_size > 1:
+                counts = torch.tensor([nb_tr_tokens, nb_tr_padded_tokens], dtype=torch.float64)
+                dist.all_reduce(counts)
+                nb_tr_tokens, nb_tr_padded_tokens = counts.tolist()
+            if nb_tr_padded_tokens:
+                logger.info("%.1f tokens/s with %d process(es) (%.1f per process), padding ratio %.3f",
+                            nb_tr_tokens / elapsed, world_size, nb_tr_tokens / elapsed / world_size,
+                            1 - nb_tr_tokens / nb_tr_padded_tokens)
+        if checkpointer is not None:
+            checkpointer.wait()
+
+    if world_size > 1:
+        dist.destroy_process_group()
+        model = raw_model
+        if rank != 0:
+            return
 
     # Save a trained model
     if args.do_train:
@@ -210,27 +484,27 @@ def main():
         torch.save(model_to_save.state_dict(), output_model_file)
         model_to_save.config.to_json_file(output_config_file)
         tokenizer.save_vocabulary(args.output_dir)
-
-        # Load a trained model and vocabulary that you have fine-tuned
-        model = OpenAIGPTDoubleHeadsModel.from_pretrained(args.output_dir)
-        tokenizer = OpenAIGPTTokenizer.from_pretrained(args.output_dir)
-        model.to(device)
+        # The trained model is evaluated as is, without being loaded again from `output_dir`
 
     if args.do_eval:
-        eval_tensor_dataset = pre_process_dataset(encoded_eval, input_length, max_length, *special_tokens_ids)
-        eval_data = TensorDataset(*eval_tensor_dataset)
+        eval_data = PreProcessedDataset(encoded_eval, max_length, *special_tokens_ids)
         eval_sampler = SequentialSampler(eval_data)
-        eval_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=args.eval_batch_size)
+        eval_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=args.eval_batch_size,
+                                     collate_fn=pad_collate)
 
         model.eval()
-        eval_loss, eval_accuracy = 0, 0
-        nb_eval_steps, nb_eval_examples = 0, 0
+        eval_loss, eval_accuracy, eval_lm_nll = 0, 0, 0
+        nb_eval_steps, nb_eval_examples, nb_eval_tokens = 0, 0, 0
         for batch in tqdm(eval_dataloader, desc="Evaluating"):
             batch = tuple(t.to(device) for t in batch)
             input_ids, mc_token_ids, lm_labels, mc_labels = batch
+            # A single forward pass, the losses are computed from the logits
             with torch.no_grad():
-                _, mc_loss = model(input_ids, mc_token_ids, lm_labels, mc_labels)
-                _, mc_logits = model(input_ids, mc_token_ids)
+                lm_logits, mc_logits = model(input_ids, mc_token_ids)
+                mc_loss = F.cross_entropy(mc_logits.view(-1, mc_logits.size(-1)), mc_labels.view(-1))
+            lm_nll_sum, nb_lm_tokens = lm_nll(lm_logits, lm_labels)
+            eval_lm_nll += lm_nll_sum
+            nb_eval_tokens += nb_lm_tokens
 
             mc_logits = mc_logits.detach().cpu().numpy()
             mc_labels = mc_labels.to('cpu').numpy()
@@ -244,9 +518,12 @@ def main():
 
         eval_loss = eval_loss / nb_eval_steps
         eval_accuracy = eval_accuracy / nb_eval_examples
+        eval_lm_loss = eval_lm_nll / nb_eval_tokens
         train_loss = tr_loss / nb_tr_steps if args.do_train else None
         result = {'eval_loss': eval_loss,
                   'eval_accuracy': eval_accuracy,
+                  'eval_lm_loss': eval_lm_loss,
+                  'eval_perplexity': math.exp(eval_lm_loss),
                   'train_loss': train_loss}
 
         output_eval_file = os.path.join(args.output_dir, "eval_results.txt")
@@ -12,9 +12,20 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import torch
 import argparse
-from pytorch_pretrained_bert import GPT2Tokenizer, GPT2LMHeadModel
+import logging
+import time
+
+import torch
+
+from beam_search import gpt_beam_search
+from decoding import decode
+from detokenizer import detokenize
+from registry import get_model, get_tokenizer
+from sampling import LogitsSampler
+from speculative import ModelDrafter, NGramDrafter, speculative_decode
+
+logger = logging.getLogger(__name__)
 
 
 def main():
@@ -25,34 +36,107 @@ def main():
                         help='The sentence used to initiate generation.')
     parser.add_argument("--tokens_to_generate", type=int, default="30",
                         help='Number of tokens to generate after the end of the sentence.')
+    parser.add_argument("--sample", action='store_true', help='Sample the tokens instead of taking the best one.')
+    parser.add_argument("--temperature", type=float, default=1.0)
+    parser.add_argument("--top_k", type=int, default=0)
+    parser.add_argument("--top_p", type=float, default=1.0)
+    parser.add_argument("--repetition_penalty", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--num_beams", type=int, default=1, help='Beam search with this many beams if above 1.')
+    parser.add_argument("--length_penalty", type=float, default=1.,
+                        help='Exponent of the length dividing the beam scores, above 0 favours long hypotheses.')
+    parser.add_argument("--no_repeat_ngram_size", type=int, default=0,
+                        help='Forbid the beams to repeat n-grams of this size.')
+    parser.add_argument("--quantize", action='store_true',
+                        help='Run the linear layers in int8 on CPU (see quantization.py to check the accuracy).')
+    parser.add_argument("--speculative", action='store_true',
+                        help='Greedy decoding checking several drafted tokens per forward pass, drafted from the '
+                             'n-grams of the text or by --draft_model_name_or_path. Same output, faster on repetitive '
+                             'text.')
+    parser.add_argument("--draft_model_name_or_path", type=str, default=None,
+                        help='Smaller GPT-2 model with the same tokenizer drafting the tokens of --speculative.')
+    parser.add_argument("--num_draft_tokens", type=int, default=4, help='Tokens drafted per forward pass.')
+    parser.add_argument("--max_ngram_size", type=int, default=3, help='Longest n-gram looked up to draft tokens.')
+    parser.add_argument("--check", action='store_true',
+                        help='Also run greedy decoding after --speculative, to compare the outputs and times.')
     args = parser.parse_args()
 
-    gpt2_generation(args.model_name_or_path, args.text, args.tokens_to_generate)
+    if args.speculative and (args.sample or args.num_beams > 1):
+        parser.error("--speculative only works with greedy decoding")
+
+    sampler = LogitsSampler(args.temperature, args.top_k, args.top_p, args.repetition_penalty, greedy=not args.sample)
+    if args.speculative:
+        logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                            datefmt='%m/%d/%Y %H:%M:%S',
+                            level=logging.INFO)
+        speculative_generation(args.model_name_or_path, args.text, args.tokens_to_generate,
+                               args.draft_model_name_or_path, args.num_draft_tokens, args.max_ngram_size,
+                               torch.qint8 if args.quantize else None, args.check)
+        return
+    gpt2_generation(args.model_name_or_path, args.text, args.tokens_to_generate, sampler, args.seed, args.num_beams,
+                    args.length_penalty, args.no_repeat_ngram_size, torch.qint8 if args.quantize else None)
 
 
-def gpt2_generation(model_name_or_path, text, tokens_to_generate):
-    tokenizer = GPT2Tokenizer.from_pretrained(model_name_or_path)
-    lm_model = GPT2LMHeadModel.from_pretrained(model_name_or_path)
-    lm_model.eval()
+def gpt2_generation(model_name_or_path, text, tokens_to_generate, sampler=None, seed=None, num_beams=1,
+                    length_penalty=1., no_repeat_ngram_size=0, dtype=None):
+    """ Print `text` continued by `tokens_to_generate` tokens picked by `sampler` (greedy by default), or by
+        beam search with `num_beams` > 1.
+    """
+    from pytorch_pretrained_bert import GPT2LMHeadModel, GPT2Tokenizer
+    tokenizer = get_tokenizer(GPT2Tokenizer, model_name_or_path)
+    lm_model = get_model(GPT2LMHeadModel, model_name_or_path, dtype=dtype)
 
     #  Prepare tokenized input
     tokenized_text = tokenizer.tokenize(text)
-    while tokens_to_generate > 0:
-        indexed_tokens = tokenizer.convert_tokens_to_ids(tokenized_text)
-        tokens_tensor = torch.tensor([indexed_tokens])
+    indexed_tokens = tokenizer.convert_tokens_to_ids(tokenized_text)
+
+    # Predict the continuation, feeding only the new token to the model at each step
+    if num_beams > 1:
+        hypotheses = gpt_beam_search(lm_model, [indexed_tokens], tokens_to_generate, num_beams, length_penalty,
+                                     no_repeat_ngram_size, tokenizer.encoder.get('<|endoftext|>'))[0]
+        predicted_indexes = hypotheses[0][0]
+    else:
+        generator = torch.Generator().manual_seed(seed) if seed is not None else None
+        predicted_indexes = decode(lm_model, indexed_tokens, tokens_to_generate, sampler, generator).tolist()
+
+    print(detokenize(tokenizer, indexed_tokens + predicted_indexes))
 
-        # Predict all tokens
-        with torch.no_grad():
-            predictions, _ = lm_model(tokens_tensor)
 
-        # Get the last predicted token
-        predicted_index = torch.argmax(predictions[0, -1, :]).item()
-        predicted_token = tokenizer.convert_ids_to_tokens([predicted_index])[0]
-        tokenized_text.append(predicted_token)
-        tokens_to_generate -= 1
+def speculative_generation(model_name_or_path, text, tokens_to_generate, draft_model_name_or_path=None,
+                           num_draft_tokens=4, max_ngram_size=3, dtype=None, check=False):
+    """ Print the greedy continuation of `text` found by speculative decoding (see speculative.py), and log the
+        acceptance rate of the drafts. With `check`, also run token by token greedy decoding to log the speedup
+        and warn if the outputs differ.
+    """
+    from pytorch_pretrained_bert import GPT2LMHeadModel, GPT2Tokenizer
+    tokenizer = get_tokenizer(GPT2Tokenizer, model_name_or_path)
+    lm_model = get_model(GPT2LMHeadModel, model_name_or_path, dtype=dtype)
+    if draft_model_name_or_path is None:
+        drafter = NGramDrafter(max_ngram_size)
+    else:
+        draft_model = get_model(GPT2LMHeadModel, draft_model_name_or_path, dtype=dtype)
+        if draft_model.config.vocab_size != lm_model.config.vocab_size:
+            raise ValueError("The draft model should share the tokenizer of the model")
+        drafter = ModelDrafter(draft_model)
+    indexed_tokens = tokenizer.convert_tokens_to_ids(tokenizer.tokenize(text))
 
-    print("".join(tokenized_text).replace("Ġ", " ").replace("Ċ", "\r\n"))
+    start = time.perf_counter()
+    predicted_indexes, stats = speculative_decode(lm_model, indexed_tokens, tokens_to_generate, drafter,
+                                                  num_draft_tokens)
+    speculative_time = time.perf_counter() - start
 
+    print(detokenize(tokenizer, indexed_tokens + predicted_indexes))
+    logger.info("Accepted %d of %d drafted tokens (%.1f%%), %.2f tokens per forward pass in %.3fs",
+                stats['accepted_tokens'], stats['drafted_tokens'], 100 * stats['acceptance_rate'],
+                stats['tokens_per_pass'], speculative_time)
+    if check:
+        start = time.perf_counter()
+        greedy_indexes = decode(lm_model, indexed_tokens, tokens_to_generate).tolist()
+        greedy_time = time.perf_counter() - start
+        if greedy_indexes != predicted_indexes:
+            logger.warning("Speculative and greedy decoding differ, the logits of some steps are too close to call")
+        logger.info("%.2fx faster than greedy decoding (%.3fs against %.3fs)", greedy_time / speculative_time,
+                    speculative_time, greedy_time)
 
 if __name__ == '__main__':
     main()
@@ -13,9 +13,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import torch
 import argparse
-from pytorch_pretrained_bert import OpenAIGPTTokenizer, OpenAIGPTLMHeadModel
+
+import torch
+
+from beam_search import gpt_beam_search
+from decoding import decode
+from detokenizer import detokenize
+from registry import get_model, get_tokenizer
+from sampling import LogitsSampler
 
 
 def main():
@@ -26,33 +32,49 @@ def main():
                         help='The sentence used to initiate generation.')
     parser.add_argument("--tokens_to_generate", type=int, default="30",
                         help='Number of tokens to generate after the end of the sentence.')
+    parser.add_argument("--sample", action='store_true', help='Sample the tokens instead of taking the best one.')
+    parser.add_argument("--temperature", type=float, default=1.0)
+    parser.add_argument("--top_k", type=int, default=0)
+    parser.add_argument("--top_p", type=float, default=1.0)
+    parser.add_argument("--repetition_penalty", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--num_beams", type=int, default=1, help='Beam search with this many beams if above 1.')
+    parser.add_argument("--length_penalty", type=float, default=1.,
+                        help='Exponent of the length dividing the beam scores, above 0 favours long hypotheses.')
+    parser.add_argument("--no_repeat_ngram_size", type=int, default=0,
+                        help='Forbid the beams to repeat n-grams of this size.')
+    parser.add_argument("--quantize", action='store_true',
+                        help='Run the linear layers in int8 on CPU (see quantization.py to check the accuracy).')
     args = parser.parse_args()
 
-    openai_generation(args.model_name_or_path, args.text, args.tokens_to_generate)
+    sampler = LogitsSampler(args.temperature, args.top_k, args.top_p, args.repetition_penalty, greedy=not args.sample)
+    openai_generation(args.model_name_or_path, args.text, args.tokens_to_generate, sampler, args.seed, args.num_beams,
+                      args.length_penalty, args.no_repeat_ngram_size, torch.qint8 if args.quantize else None)
 
 
-def openai_generation(model_name_or_path, text, tokens_to_generate):
-    tokenizer = OpenAIGPTTokenizer.from_pretrained(model_name_or_path)
-    lm_model = OpenAIGPTLMHeadModel.from_pretrained(model_name_or_path)
-    lm_model.eval()
+def openai_generation(model_name_or_path, text, tokens_to_generate, sampler=None, seed=None, num_beams=1,
+                      length_penalty=1., no_repeat_ngram_size=0, dtype=None):
+    """ Print `text` continued by `tokens_to_generate` tokens picked by `sampler` (greedy by default), or by
+        beam search with `num_beams` > 1.
+    """
+    from pytorch_pretrained_bert import OpenAIGPTLMHeadModel, OpenAIGPTTokenizer
+    tokenizer = get_tokenizer(OpenAIGPTTokenizer, model_name_or_path)
+    lm_model = get_model(OpenAIGPTLMHeadModel, model_name_or_path, dtype=dtype)
 
     #  Prepare tokenized input
     tokenized_text = tokenizer.tokenize(text)
-    while tokens_to_generate > 0:
-        indexed_tokens = tokenizer.convert_tokens_to_ids(tokenized_text)
-        tokens_tensor = torch.tensor([indexed_tokens])
-
-        # Predict all tokens
-        with torch.no_grad():
-            predictions = lm_model(tokens_tensor)
+    indexed_tokens = tokenizer.convert_tokens_to_ids(tokenized_text)
 
-        # Get the last predicted token
-        predicted_index = torch.argmax(predictions[0, -1, :]).item()
-        predicted_token = tokenizer.convert_ids_to_tokens([predicted_index])[0]
-        tokenized_text.append(predicted_token)
-        tokens_to_generate -= 1
+    # Predict the continuation, feeding only the new token to the model at each step
+    if num_beams > 1:
+        hypotheses = gpt_beam_search(lm_model, [indexed_tokens], tokens_to_generate, num_beams, length_penalty,
+                                     no_repeat_ngram_size)[0]
+        predicted_indexes = hypotheses[0][0]
+    else:
+        generator = torch.Generator().manual_seed(seed) if seed is not None else None
+        predicted_indexes = decode(lm_model, indexed_tokens, tokens_to_generate, sampler, generator).tolist()
 
-    print("".join(tokenized_text).replace("</w>", " "))
+    print(detokenize(tokenizer, indexed_tokens + predicted_indexes))
 
 
 if __name__ == '__main__':
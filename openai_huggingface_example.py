@@ -20,11 +20,14 @@ import logging
 from tqdm import trange
 
 import torch
-import torch.nn.functional as F
 import numpy as np
 import random as rd
 
-from pytorch_pretrained_bert import OpenAIGPTLMHeadModel, OpenAIGPTTokenizer
+from detokenizer import detokenize
+from registry import get_model, get_tokenizer
+from sampling import LogitsSampler
+from session import ChatSession
+from tracing import NULL_TRACER, ChromeTrace
 
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
                     datefmt='%m/%d/%Y %H:%M:%S',
@@ -47,34 +50,52 @@ def top_k_logits(logits, k):
 
 
 def sample_sequence(model, length, start_token=None, batch_size=None, context=None, temperature=1, top_k=0,
-                    device='cuda', sample=True):
-    if start_token is None:
-        assert context is not None, 'Specify exactly one of start_token and context!'
-        context = torch.tensor(context, device=device, dtype=torch.long).unsqueeze(0).repeat(batch_size, 1)
-    else:
-        assert context is None, 'Specify exactly one of start_token and context!'
-        context = torch.full((batch_size, 1), start_token, device=device, dtype=torch.long)
+                    device='cuda', sample=True, tracer=None, sampler=None, generators=None):
+    """ Tokens are picked by the LogitsSampler `sampler`, built from `temperature`, `top_k` and `sample` if not
+        given, with one torch.Generator per row if `generators` is given.
+        `tracer` (see tracing.py) receives the timings of the phases of every step.
+    """
+    sampler = sampler or LogitsSampler(temperature, top_k, greedy=not sample)
+    tracer = tracer or NULL_TRACER
+    with tracer.span('transfer'):
+        if start_token is None:
+            assert context is not None, 'Specify exactly one of start_token and context!'
+            context = torch.tensor(context, device=device, dtype=torch.long).unsqueeze(0).repeat(batch_size, 1)
+        else:
+            assert context is None, 'Specify exactly one of start_token and context!'
+            context = torch.full((batch_size, 1), start_token, device=device, dtype=torch.long)
     prev = context
     output = context
     past = None
     with torch.no_grad():
         for i in trange(length):
-            logits = model(prev)
-            logits = logits[:, -1, :] / temperature
-            logits = top_k_logits(logits, k=top_k)
-            log_probs = F.softmax(logits, dim=-1)
-            if sample:
-                word = torch.multinomial(log_probs, num_samples=1)
+            with tracer.span('forward'):
+                logits = model(prev)
+            with tracer.span('sample'):
+                word = sampler(logits[:, -1, :], prev, generators)
                 prev = torch.cat((prev, word), dim=1)
-
-            else:
-                _, word = torch.topk(log_probs, k=1, dim=-1)
-                prev = torch.cat((prev, word), dim=1)
-            output = torch.cat((output, word), dim=1)
+                output = torch.cat((output, word), dim=1)
+            tracer.step(prev.size(0), prev.size(1))
     return output
 
 
+def chat(enc, model, length, sampler, tracer=None, keep_tokens=None, trace_file=None):
+    """ Answer the prompts of the user with `length` tokens, in a ChatSession (see session.py). """
+    session = ChatSession(model, keep_tokens)
+    while True:
+        raw_text = input("Model prompt >>> ")
+        while not raw_text:
+            print('Prompt should not be empty!')
+            raw_text = input("Model prompt >>> ")
+        out = [token.item() for token in session.generate(enc.encode(raw_text), length, sampler, tracer=tracer)]
+        print(detokenize(enc, out))
+        logger.info("Session: %s", session.stats())
+        if tracer is not None:
+            tracer.save(trace_file)
+
+
 def run_model():
+    from pytorch_pretrained_bert import OpenAIGPTLMHeadModel, OpenAIGPTTokenizer
     parser = argparse.ArgumentParser()
     parser.add_argument('--model_name_or_path', type=str, default='openai-gpt',
                         help='pretrained model name or path to local checkpoint')
@@ -84,7 +105,16 @@ def run_model():
     parser.add_argument("--length", type=int, default=-1)
     parser.add_argument("--temperature", type=float, default=1.0)
     parser.add_argument("--top_k", type=int, default=0)
+    parser.add_argument("--top_p", type=float, default=1.0)
+    parser.add_argument("--repetition_penalty", type=float, default=1.0)
     parser.add_argument('--unconditional', action='store_true', help='If true, unconditional generation.')
+    parser.add_argument('--chat', action='store_true',
+                        help='Every prompt continues the conversation, whose context is kept between prompts and '
+                             'slides when it gets longer than the model window.')
+    parser.add_argument('--keep_tokens', type=int, default=None,
+                        help='Tokens kept when the chat context slides, defaults to half the window.')
+    parser.add_argument('--trace_file', type=str, default=None,
+                        help='Write the timings of every sampling step to this Chrome trace (chrome://tracing).')
     args = parser.parse_args()
 
     if args.batch_size == -1:
@@ -96,16 +126,22 @@ def run_model():
     torch.cuda.manual_seed(args.seed)
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-    enc = OpenAIGPTTokenizer.from_pretrained(args.model_name_or_path)
-    model = OpenAIGPTLMHeadModel.from_pretrained(args.model_name_or_path)
-    model.to(device)
-    model.eval()
+    enc = get_tokenizer(OpenAIGPTTokenizer, args.model_name_or_path)
+    model = get_model(OpenAIGPTLMHeadModel, args.model_name_or_path, device=device)
+
+    tracer = ChromeTrace() if args.trace_file else None
+    sampler = LogitsSampler(args.temperature, args.top_k, args.top_p, args.repetition_penalty)
 
     if args.length == -1:
         args.length = model.config.n_ctx // 2
-    elif args.length > model.config.n_ctx:
+    elif args.length > model.config.n_ctx and not args.chat:
         raise ValueError("Can't get samples longer than window size: %s" % model.config.n_ctx)
 
+    if args.chat:
+        chat(enc, model, args.length, sampler, tracer, args.keep_tokens, args.trace_file)
+        return
+
+    vocabulary = list(enc.encoder.keys())
     while True:
         context_tokens = []
         if not args.unconditional:
@@ -121,7 +157,7 @@ def run_model():
                     context=context_tokens,
                     start_token=None,
                     batch_size=args.batch_size,
-                    temperature=args.temperature, top_k=args.top_k, device=device
+                    device=device, tracer=tracer, sampler=sampler
                 )
                 out = out[:, len(context_tokens):].tolist()
                 for i in range(args.batch_size):
@@ -132,7 +168,7 @@ def run_model():
             print("=" * 80)
         else:
             generated = 0
-            start_token = rd.choice(list(enc.encoder.keys()))
+            start_token = rd.choice(vocabulary)
             print("Using start word :" + start_token)
             for _ in range(args.nsamples // args.batch_size):
                 out = sample_sequence(
@@ -140,7 +176,7 @@ def run_model():
                     context=None,
                     start_token=enc.encoder[start_token],
                     batch_size=args.batch_size,
-                    temperature=args.temperature, top_k=args.top_k, device=device
+                    device=device, tracer=tracer, sampler=sampler
                 )
                 out = out[:, 1:].tolist()
                 for i in range(args.batch_size):
@@ -149,6 +185,8 @@ def run_model():
                     print("=" * 40 + " SAMPLE " + str(generated) + " " + "=" * 40)
                     print(text)
             print("=" * 80)
+        if tracer is not None:
+            tracer.save(args.trace_file)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,213 @@
+# Copyright 2019 - UMONS
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You should have received a copy of the Apache License Version 2.0 along with this program.
+# If not, see
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Batched perplexity of the GPT, GPT-2 and Transformer-XL language models on a held-out text file.
+
+    The file is read and tokenized line by line, never as a whole. GPT and GPT-2 score the token stream with
+    windows of `n_ctx` tokens overlapping by `n_ctx - stride` tokens, each token being scored once with as much
+    context as the window allows. Transformer-XL splits the file in `batch_size` contiguous shards scored in
+    parallel, carrying its memory from one segment to the next.
+"""
+import argparse
+import logging
+import math
+import os
+
+import torch
+import torch.nn.functional as F
+
+from pytorch_pretrained_bert import (GPT2LMHeadModel, GPT2Tokenizer, OpenAIGPTLMHeadModel, OpenAIGPTTokenizer,
+                                     TransfoXLLMHeadModel, TransfoXLTokenizer)
+
+from registry import get_model, get_tokenizer
+from transformer_xl import encode_context
+
+logger = logging.getLogger(__name__)
+
+MODELS = {'gpt2': (GPT2Tokenizer, GPT2LMHeadModel),
+          'openai-gpt': (OpenAIGPTTokenizer, OpenAIGPTLMHeadModel),
+          'transfo-xl': (TransfoXLTokenizer, TransfoXLLMHeadModel)}
+
+
+def lm_nll(lm_logits, lm_labels):
+    """ Summed negative log-likelihood of `lm_labels` (-1 being ignored) under `lm_logits`, and the number of
+        tokens scored. Position i predicts label i + 1, as in the LM heads of pytorch_pretrained_bert.
+    """
+    shift_logits = lm_logits[..., :-1, :].contiguous()
+    shift_labels = lm_labels[..., 1:].contiguous()
+    nll = F.cross_entropy(shift_logits.view(-1, shift_logits.size(-1)).float(), shift_labels.view(-1),
+                          ignore_index=-1, reduction='sum')
+    return nll.item(), (shift_labels != -1).sum().item()
+
+
+def _file_tokens(tokenizer, path, start=0, end=None):
+    """ Token ids of the lines of `path` between the byte offsets `start` and `end`. """
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while end is None or f.tell() < end:
+            line = f.readline()
+            if not line:
+                return
+            line = line.decode('utf_8')
+            if isinstance(tokenizer, TransfoXLTokenizer):
+                ids = encode_context(tokenizer, line.rstrip('\n'))
+            else:
+                ids = tokenizer.encode(line)
+            for idx in ids:
+                yield idx
+
+
+def _windows(tokens, n_ctx, stride):
+    """ Yield (window, n_scored): the last n_scored tokens of each window are the ones it scores. """
+    window = []
+    scored_until = 0  # number of tokens of the current window already scored by the previous one
+    for idx in tokens:
+        window.append(idx)
+        if len(window) == n_ctx:
+            yield window, n_ctx - max(scored_until, 1)
+            window = window[stride:]
+            scored_until = len(window)
+    if len(window) > scored_until:
+        yield window, len(window) - max(scored_until, 1)
+
+
+def gpt_perplexity(model, tokens, batch_size=4, stride=None):
+    """ Summed NLL and number of tokens scored by a GPT or GPT-2 LM head model on the token id iterator `tokens`. """
+    n_ctx = model.config.n_ctx
+    stride = stride or n_ctx
+    device = next(model.parameters()).device
+    total_nll, total_tokens = 0., 0
+
+    def score(batch):
+        length = max(len(window) for window, _ in batch)
+        input_ids = torch.zeros((len(batch), length), dtype=torch.long)
+        lm_labels = torch.full((len(batch), length), -1, dtype=torch.long)
+        for i, (window, n_scored) in enumerate(batch):
+            input_ids[i, :len(window)] = torch.tensor(window)
+            lm_labels[i, len(window) - n_scored:len(window)] = torch.tensor(window[len(window) - n_scored:])
+        with torch.no_grad():
+            lm_logits = model(input_ids.to(device))
+        if isinstance(lm_logits, tuple):
+            lm_logits = lm_logits[0]
+        return lm_nll(lm_logits, lm_labels.to(device))
+
+    batch = []
+    for window in _windows(tokens, n_ctx, stride):
+        batch.append(window)
+        if len(batch) == batch_size:
+            nll, n = score(batch)
+            total_nll, total_tokens = total_nll + nll, total_tokens + n
+            batch = []
+    if batch:
+        nll, n = score(batch)
+        total_nll, total_tokens = total_nll + nll, total_tokens + n
+    return total_nll, total_tokens
+
+
+def _shards(path, n_shards):
+    """ Byte offsets splitting `path` in `n_shards` contiguous shards at line boundaries. """
+    size = os.path.getsize(path)
+    offsets = [0]
+    with open(path, 'rb') as f:
+        for i in range(1, n_shards):
+            f.seek(max(size * i // n_shards, offsets[-1]))
+            if f.tell() > 0:
+                f.readline()
+            offsets.append(f.tell())
+    offsets.append(size)
+    return list(zip(offsets[:-1], offsets[1:]))
+
+
+def transfo_xl_perplexity(model, tokenizer, path, batch_size=4):
+    """ Summed NLL and number of tokens scored by a Transformer-XL LM head model on the file `path`. """
+    tgt_len = model.transformer.tgt_len
+    device = next(model.parameters()).device
+    streams = [_file_tokens(tokenizer, path, start, end) for start, end in _shards(path, batch_size)]
+    # Each row keeps the last token of its previous segment as the input of the next one
+    last = [next(stream, None) for stream in streams]
+    rows = [i for i in range(len(streams)) if last[i] is not None]
+    mems = None
+    total_nll, total_tokens = 0., 0
+    while rows:
+        segments = []
+        for i in rows:
+            segment = [last[i]]
+            for idx in streams[i]:
+                segment.append(idx)
+                if len(segment) == tgt_len + 1:
+                    break
+            segments.append(segment)
+        length = max(len(segment) for segment in segments) - 1
+        if length == 0:
+            break
+        input_ids = torch.zeros((len(rows), length), dtype=torch.long)
+        target = torch.zeros((len(rows), length), dtype=torch.long)
+        mask = torch.zeros((len(rows), length))
+        for j, segment in enumerate(segments):
+            input_ids[j, :len(segment) - 1] = torch.tensor(segment[:-1])
+            target[j, :len(segment) - 1] = torch.tensor(segment[1:])
+            mask[j, :len(segment) - 1] = 1
+        with torch.no_grad():
+            nll, mems = model(input_ids.to(device), target=target.to(device), mems=mems)
+        total_nll += (nll * mask.to(device)).sum().item()
+        total_tokens += int(mask.sum().item())
+
+        # Rows whose shard is over leave the batch, with their memory
+        keep = [j for j, segment in enumerate(segments) if len(segment) == tgt_len + 1]
+        for j, segment in enumerate(segments):
+            last[rows[j]] = segment[-1]
+        rows = [rows[j] for j in keep]
+        if keep and len(keep) < len(segments):
+            index = torch.tensor(keep, device=device)
+            mems = [mem.index_select(1, index) for mem in mems]
+    return total_nll, total_tokens
+
+
+def evaluate_perplexity(model, tokenizer, path, batch_size=4, stride=None):
+    """ Average per-token loss and perplexity of `model` on the text file `path`. """
+    if isinstance(model, TransfoXLLMHeadModel):
+        nll, n_tokens = transfo_xl_perplexity(model, tokenizer, path, batch_size)
+    else:
+        nll, n_tokens = gpt_perplexity(model, _file_tokens(tokenizer, path), batch_size, stride)
+    loss = nll / max(n_tokens, 1)
+    return {'loss': loss, 'perplexity': math.exp(loss), 'tokens': n_tokens}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_type', type=str, default='gpt2', choices=sorted(MODELS))
+    parser.add_argument('--model_name_or_path', type=str, default='gpt2',
+                        help='pretrained model name or path to local checkpoint')
+    parser.add_argument('--eval_file', type=str, required=True, help='The held-out text file.')
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--stride', type=int, default=None,
+                        help='GPT/GPT-2 windows move by this many tokens, defaults to n_ctx (no overlap).')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                        datefmt='%m/%d/%Y %H:%M:%S',
+                        level=logging.INFO)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    tokenizer_class, model_class = MODELS[args.model_type]
+    tokenizer = get_tokenizer(tokenizer_class, args.model_name_or_path)
+    model = get_model(model_class, args.model_name_or_path, device=device)
+
+    result = evaluate_perplexity(model, tokenizer, args.eval_file, args.batch_size, args.stride)
+    for key in sorted(result.keys()):
+        logger.info("  %s = %s", key, str(result[key]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+# Copyright 2019 - UMONS
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You should have received a copy of the Apache License Version 2.0 along with this program.
+# If not, see
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Cache of the attention `past` of prompt prefixes, for GPT and GPT-2 requests sharing the same header.
+
+    Prompts are cut in blocks of `block_size` tokens. A block is keyed by its tokens and the id of the block
+    before it, so a chain of keys identifies a whole prefix without hashing it again at every block, and holds
+    the keys and values of its own tokens only: prompts sharing a prefix share its blocks. A new request takes
+    the past of its longest cached prefix of whole blocks and only runs the rest of its prompt through the model.
+
+    Blocks are evicted in least recently used order once they take more than `max_bytes`. A lookup touches the
+    blocks of a prefix from the last one to the first one, so a prefix loses its end before its beginning.
+    Blocks following an evicted one can't be reached anymore and go next.
+"""
+import collections
+import threading
+
+import torch
+
+
+class PrefixCache(object):
+    """ Attention `past` (see decoding.py) of token id prefixes, safe to share between threads. """
+
+    def __init__(self, max_bytes=256 * 2 ** 20, block_size=16):
+        if block_size < 1:
+            raise ValueError("block_size should be at least 1")
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.blocks = collections.OrderedDict()  # (previous block id, tokens) -> (block id, past, bytes), LRU first
+        self.lock = threading.Lock()
+        self.next_id = 1  # 0 is the empty prefix
+        self.bytes = 0
+        self.lookups = self.hits = self.lookup_tokens = self.hit_tokens = self.evictions = 0
+
+    def _keys(self, token_ids, n_blocks):
+        """ Keys and blocks of the longest cached chain of the first `n_blocks` blocks of `token_ids`. """
+        keys, blocks, block_id = [], [], 0
+        for start in range(0, n_blocks * self.block_size, self.block_size):
+            key = (block_id, tuple(token_ids[start:start + self.block_size]))
+            block = self.blocks.get(key)
+            if block is None:
+                break
+            keys.append(key)
+            blocks.append(block)
+            block_id = block[0]
+        return keys, blocks
+
+    def _touch(self, keys):
+        for key in reversed(keys):
+            self.blocks.move_to_end(key)
+
+    def lookup(self, token_ids):
+        """ (past, length) of the longest cached prefix of `token_ids`, (None, 0) if there is none.
+
+            At least the last token is left out, so that the model still gives the logits after the prompt.
+        """
+        with self.lock:
+            keys, blocks = self._keys(token_ids, (len(token_ids) - 1) // self.block_size)
+            self._touch(keys)
+            self.lookups += 1
+            self.lookup_tokens += len(token_ids)
+            if not blocks:
+                return None, 0
+            self.hits += 1
+            self.hit_tokens += len(blocks) * self.block_size
+        past = [torch.cat(layers, dim=-2) for layers in zip(*(block[1] for block in blocks))]
+        return past, len(blocks) * self.block_size
+
+    def insert(self, token_ids, past):
+        """ Cache the whole blocks of `token_ids`, `past` being their cache for a batch of one. """
+        n_blocks = len(token_ids) // self.block_size
+        with self.lock:
+            keys, blocks = self._keys(token_ids, n_blocks)
+            block_id = blocks[-1][0] if blocks else 0
+            for start in range(len(keys) * self.block_size, n_blocks * self.block_size, self.block_size):
+                block_past = [layer_past[..., start:start + self.block_size, :].clone() for layer_past in past]
+                size = sum(tensor.numel() * tensor.element_size() for tensor in block_past)
+                if size > self.max_bytes:
+                    break
+                key = (block_id, tuple(token_ids[start:start + self.block_size]))
+                self.blocks[key] = (self.next_id, block_past, size)
+                self.bytes += size
+                keys.append(key)
+                block_id = self.next_id
+                self.next_id += 1
+            self._touch(keys)
+            while self.bytes > self.max_bytes:
+                _, (_, _, size) = self.blocks.popitem(last=False)
+                self.bytes -= size
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.blocks.clear()
+            self.bytes = 0
+
+    def stats(self):
+        """ Hit rates (of the lookups and of their tokens), size and evictions of the cache. """
+        with self.lock:
+            return {'lookups': self.lookups, 'hits': self.hits,
+                    'hit_rate': self.hits / self.lookups if self.lookups else 0.,
+                    'token_hit_rate': self.hit_tokens / self.lookup_tokens if self.lookup_tokens else 0.,
+                    'blocks': len(self.blocks), 'bytes': self.bytes, 'evictions': self.evictions}
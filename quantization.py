@@ -0,0 +1,205 @@
+# Copyright 2019 - UMONS
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You should have received a copy of the Apache License Version 2.0 along with this program.
+# If not, see
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Dynamic int8 quantization of the GPT, GPT-2 and BERT models for CPU inference, and its accuracy gate.
+
+    The weights of the linear layers (the `Conv1D` of GPT and GPT-2 are turned into `nn.Linear` first, LM heads
+    included) are stored in int8 and the activations are quantized on the fly, so matrix products read a quarter
+    of the memory. Models are quantized when asked to the registry with `dtype=torch.qint8`.
+
+    Run as a script, it compares a quantized model with its fp32 version on a text file: GPT and GPT-2 predict
+    every next token, BERT fills randomly masked tokens. It reports the forward time and size of both, the
+    fraction of positions where their best token agrees and their perplexity, and exits with status 1 when the
+    agreement or the perplexity drift is over the thresholds.
+"""
+import argparse
+import json
+import logging
+import math
+import random
+import sys
+import time
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from pytorch_pretrained_bert import (BertForMaskedLM, BertTokenizer, GPT2LMHeadModel, GPT2Tokenizer,
+                                     OpenAIGPTLMHeadModel, OpenAIGPTTokenizer)
+from pytorch_pretrained_bert import modeling_gpt2, modeling_openai
+
+from perplexity import _file_tokens, _windows
+from registry import get_model, get_tokenizer, model_size
+
+logger = logging.getLogger(__name__)
+
+MODELS = {'gpt2': (GPT2Tokenizer, GPT2LMHeadModel),
+          'openai-gpt': (OpenAIGPTTokenizer, OpenAIGPTLMHeadModel),
+          'bert': (BertTokenizer, BertForMaskedLM)}
+
+
+def conv1d_to_linear(model):
+    """ Replace the `Conv1D` layers of a GPT or GPT-2 model by the equivalent `nn.Linear`, in place. """
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if isinstance(child, (modeling_gpt2.Conv1D, modeling_openai.Conv1D)):
+                linear = nn.Linear(child.weight.size(0), child.weight.size(1))
+                linear.weight = nn.Parameter(child.weight.detach().t().contiguous())
+                linear.bias = child.bias
+                setattr(module, name, linear)
+    return model
+
+
+def quantize_dynamic_int8(model):
+    """ Quantize the linear layers of the CPU model `model` to int8 with dynamic activation quantization. """
+    if next(model.parameters()).device.type != 'cpu':
+        raise ValueError("Dynamic quantization only runs on CPU")
+    model = conv1d_to_linear(model)
+    return torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
+def _gpt_batches(tokenizer, path, batch_size, max_length):
+    """ (input_ids, labels) of consecutive windows of the file, labels[i] being the token after input_ids[i]. """
+    def batch_tensors(windows):
+        length = max(len(window) for window in windows)
+        input_ids = torch.zeros((len(windows), length), dtype=torch.long)
+        labels = torch.full((len(windows), length), -1, dtype=torch.long)
+        for i, window in enumerate(windows):
+            input_ids[i, :len(window)] = torch.tensor(window)
+            labels[i, :len(window) - 1] = torch.tensor(window[1:])
+        return input_ids, labels
+
+    batch = []
+    for window, _ in _windows(_file_tokens(tokenizer, path), max_length, max_length):
+        batch.append(window)
+        if len(batch) == batch_size:
+            yield batch_tensors(batch)
+            batch = []
+    if batch:
+        yield batch_tensors(batch)
+
+
+def _bert_batches(tokenizer, path, batch_size, max_length, mask_probability=0.15, seed=0):
+    """ (input_ids, labels) of the lines of the file with `mask_probability` of their tokens masked, labels
+        holding the masked tokens and -1 elsewhere.
+    """
+    rng = random.Random(seed)
+    mask_id = tokenizer.vocab['[MASK]']
+
+    def batch_tensors(lines):
+        length = max(len(ids) for ids in lines)
+        input_ids = torch.zeros((len(lines), length), dtype=torch.long)
+        labels = torch.full((len(lines), length), -1, dtype=torch.long)
+        for i, ids in enumerate(lines):
+            input_ids[i, :len(ids)] = torch.tensor(ids)
+            # At least one masked token per line, never [CLS] or [SEP]
+            masked = [j for j in range(1, len(ids) - 1) if rng.random() < mask_probability] or [1]
+            labels[i, masked] = input_ids[i, masked]
+            input_ids[i, masked] = mask_id
+        return input_ids, labels
+
+    batch = []
+    with open(path, encoding='utf_8') as f:
+        for line in f:
+            tokens = tokenizer.tokenize(line)[:max_length - 2]
+            if not tokens:
+                continue
+            batch.append(tokenizer.convert_tokens_to_ids(['[CLS]'] + tokens + ['[SEP]']))
+            if len(batch) == batch_size:
+                yield batch_tensors(batch)
+                batch = []
+    if batch:
+        yield batch_tensors(batch)
+
+
+def _logits(model, input_ids):
+    if isinstance(model, BertForMaskedLM):
+        # Padding is ignored by the attention
+        return model(input_ids, attention_mask=(input_ids != 0).long())
+    logits = model(input_ids)
+    return logits[0] if isinstance(logits, tuple) else logits
+
+
+def compare_models(reference, candidate, batches):
+    """ Forward time, perplexity and top-1 agreement of `candidate` against `reference` on `batches` of
+        (input_ids, labels), the logits at the positions whose label isn't -1 being scored.
+    """
+    times, nlls = [0., 0.], [0., 0.]
+    n_tokens, n_agree = 0, 0
+    for input_ids, labels in batches:
+        scored = labels != -1
+        best = []
+        for i, model in enumerate((reference, candidate)):
+            start = time.perf_counter()
+            with torch.no_grad():
+                logits = _logits(model, input_ids)
+            times[i] += time.perf_counter() - start
+            logits = logits[scored].float()
+            nlls[i] += F.cross_entropy(logits, labels[scored], reduction='sum').item()
+            best.append(logits.argmax(dim=-1))
+        n_tokens += int(scored.sum())
+        n_agree += int((best[0] == best[1]).sum())
+
+    perplexities = [math.exp(nll / max(n_tokens, 1)) for nll in nlls]
+    return {'tokens': n_tokens,
+            'fp32_time': times[0], 'int8_time': times[1], 'speedup': times[0] / times[1],
+            'fp32_perplexity': perplexities[0], 'int8_perplexity': perplexities[1],
+            'perplexity_drift': perplexities[1] / perplexities[0] - 1,
+            'top1_agreement': n_agree / max(n_tokens, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_type', type=str, default='gpt2', choices=sorted(MODELS))
+    parser.add_argument('--model_name_or_path', type=str, default='gpt2',
+                        help='pretrained model name or path to local checkpoint')
+    parser.add_argument('--eval_file', type=str, required=True, help='The sample text file.')
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--max_length', type=int, default=128, help='Length of the windows, or BERT lines.')
+    parser.add_argument('--min_agreement', type=float, default=0.95,
+                        help='Lowest acceptable fraction of positions where both models pick the same token.')
+    parser.add_argument('--max_perplexity_drift', type=float, default=0.02,
+                        help='Highest acceptable relative increase of the perplexity.')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                        datefmt='%m/%d/%Y %H:%M:%S',
+                        level=logging.INFO)
+
+    tokenizer_class, model_class = MODELS[args.model_type]
+    tokenizer = get_tokenizer(tokenizer_class, args.model_name_or_path)
+    reference = get_model(model_class, args.model_name_or_path)
+    candidate = get_model(model_class, args.model_name_or_path, dtype=torch.qint8)
+
+    if args.model_type == 'bert':
+        batches = _bert_batches(tokenizer, args.eval_file, args.batch_size, args.max_length, seed=args.seed)
+    else:
+        max_length = min(args.max_length, reference.config.n_positions)
+        batches = _gpt_batches(tokenizer, args.eval_file, args.batch_size, max_length)
+    result = compare_models(reference, candidate, batches)
+    result['fp32_mb'] = model_size(reference) / 2 ** 20
+    result['int8_mb'] = model_size(candidate) / 2 ** 20
+    result['memory_saving'] = 1 - result['int8_mb'] / result['fp32_mb']
+    result['safe'] = (result['top1_agreement'] >= args.min_agreement
+                      and result['perplexity_drift'] <= args.max_perplexity_drift)
+    print(json.dumps(result, indent=2))
+    if not result['safe']:
+        logger.warning("int8 quantization of %s is over the accuracy thresholds", args.model_name_or_path)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
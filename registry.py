@@ -0,0 +1,175 @@
+# Copyright 2019 - UMONS
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You should have received a copy of the Apache License Version 2.0 along with this program.
+# If not, see
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Process-wide registry of pre-trained models and tokenizers.
+
+    Every generator asks the registry instead of calling `from_pretrained` itself, so weights are deserialized
+    once per process and the same eval-mode instance is handed out to every caller. Models are evicted in least
+    recently used order once their total size goes over the memory budget.
+"""
+import collections
+import logging
+import os
+import threading
+import time
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+ModelEntry = collections.namedtuple('ModelEntry', ['model', 'load_time', 'size'])
+
+
+def model_size(model):
+    """ Number of bytes held by the parameters and buffers of `model`, counting tied weights once. """
+    seen = set()
+    size = 0
+    tensors = list(model.parameters()) + list(model.buffers())
+    for module in model.modules():
+        # The weights of the quantized layers are packed outside of the parameters
+        if hasattr(module, '_packed_params') and hasattr(module._packed_params, '_weight_bias'):
+            tensors.extend(tensor for tensor in module._packed_params._weight_bias() if tensor is not None)
+    for tensor in tensors:
+        if tensor.data_ptr() in seen:
+            continue
+        seen.add(tensor.data_ptr())
+        size += tensor.nelement() * tensor.element_size()
+    return size
+
+
+class ModelRegistry(object):
+    """ LRU cache of loaded models keyed by (model class, name or path, device, dtype).
+
+        `max_bytes` is the memory budget for the models (None for no limit). The most recently loaded model is
+        never evicted, even if it is bigger than the budget on its own. `dtype=torch.qint8` loads the model with
+        its linear layers dynamically quantized to int8 (see quantization.py), on CPU only. A directory exported
+        by export.py gives its traced decoder, whatever `model_class` and `dtype`. A weight store written by
+        weight_store.py is memory-mapped instead of deserialized.
+    """
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self.models = collections.OrderedDict()
+        self.tokenizers = {}
+        self.lock = threading.RLock()  # Only held to read and update the caches, not while loading
+        self.loading = {}  # key -> lock of the thread loading it
+
+    def _load_once(self, cache, key, load):
+        """ `cache[key]`, set to `load()` by a single thread if missing. Other keys can be read meanwhile. """
+        with self.lock:
+            if key in cache:
+                return cache[key], False
+            key_lock = self.loading.setdefault(key, threading.Lock())
+        with key_lock:
+            try:
+                with self.lock:
+                    # Loaded by another thread while this one waited
+                    if key in cache:
+                        return cache[key], False
+                value = load()
+                with self.lock:
+                    cache[key] = value
+                return value, True
+            finally:
+                with self.lock:
+                    self.loading.pop(key, None)
+
+    def _load_model(self, model_class, model_name_or_path, device, dtype, kwargs):
+        from decoding import TRACED_DECODER_NAME, load_traced_decoder
+        from weight_store import WEIGHT_STORE_INDEX, load_weight_store
+        start = time.time()
+        if os.path.isfile(os.path.join(model_name_or_path, TRACED_DECODER_NAME)):
+            model = load_traced_decoder(model_name_or_path, device)
+        else:
+            if os.path.isfile(os.path.join(model_name_or_path, WEIGHT_STORE_INDEX)):
+                model = load_weight_store(model_class, model_name_or_path)
+            else:
+                model = model_class.from_pretrained(model_name_or_path, **kwargs)
+            model.to(device)
+            if dtype == torch.qint8:
+                from quantization import quantize_dynamic_int8
+                model = quantize_dynamic_int8(model)
+            elif dtype is not None:
+                model.to(dtype)
+        model.eval()
+        entry = ModelEntry(model, time.time() - start, model_size(model))
+        logger.info("Loaded %s from %s in %.2fs (%.1f MB)", model_class.__name__, model_name_or_path,
+                    entry.load_time, entry.size / 2 ** 20)
+        return entry
+
+    def get_model(self, model_class, model_name_or_path, device=None, dtype=None, **kwargs):
+        """ Return a shared eval-mode `model_class` instance, loading it on first use.
+
+            Extra `kwargs` are given to `from_pretrained` and are part of the key. Concurrent calls for the same
+            key load it once, calls for the models already loaded don't wait for the loads of the other ones.
+        """
+        device = torch.device(device) if device is not None else torch.device('cpu')
+        key = (model_class, model_name_or_path, str(device), dtype, tuple(sorted(kwargs.items())))
+
+        def load():
+            return self._load_model(model_class, model_name_or_path, device, dtype, kwargs)
+
+        entry, loaded = self._load_once(self.models, key, load)
+        with self.lock:
+            if key in self.models:
+                self.models.move_to_end(key)
+            if loaded:
+                self._evict()
+        return entry.model
+
+    def get_tokenizer(self, tokenizer_class, model_name_or_path, **kwargs):
+        """ Return a shared `tokenizer_class` instance, loading it on first use. """
+        key = (tokenizer_class, model_name_or_path, tuple((k, tuple(v) if isinstance(v, list) else v)
+                                                          for k, v in sorted(kwargs.items())))
+        return self._load_once(self.tokenizers, key,
+                               lambda: tokenizer_class.from_pretrained(model_name_or_path, **kwargs))[0]
+
+    def resident_size(self):
+        return sum(entry.size for entry in self.models.values())
+
+    def _evict(self):
+        while self.max_bytes is not None and len(self.models) > 1 and self.resident_size() > self.max_bytes:
+            (model_class, model_name_or_path, _, _, _), entry = self.models.popitem(last=False)
+            logger.info("Evicted %s from %s (%.1f MB)", model_class.__name__, model_name_or_path,
+                        entry.size / 2 ** 20)
+
+    def stats(self):
+        """ Load time (seconds) and resident size (bytes) of every loaded model, least recently used first. """
+        with self.lock:
+            return [{'model_class': model_class.__name__,
+                     'model_name_or_path': model_name_or_path,
+                     'device': device,
+                     'dtype': str(dtype) if dtype is not None else None,
+                     'load_time': entry.load_time,
+                     'size': entry.size}
+                    for (model_class, model_name_or_path, device, dtype, _), entry in self.models.items()]
+
+    def clear(self):
+        with self.lock:
+            self.models.clear()
+            self.tokenizers.clear()
+
+
+# The memory budget of the process-wide registry can be set in MB through the environment
+_max_mb = os.environ.get('TEXT_GENERATION_MAX_MODEL_MB')
+registry = ModelRegistry(max_bytes=int(_max_mb) * 2 ** 20 if _max_mb else None)
+
+
+def get_model(model_class, model_name_or_path, device=None, dtype=None, **kwargs):
+    return registry.get_model(model_class, model_name_or_path, device, dtype, **kwargs)
+
+
+def get_tokenizer(tokenizer_class, model_name_or_path, **kwargs):
+    return registry.get_tokenizer(tokenizer_class, model_name_or_path, **kwargs)
@@ -0,0 +1,134 @@
+# Copyright 2019 - UMONS
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You should have received a copy of the Apache License Version 2.0 along with this program.
+# If not, see
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Next token selection shared by all the generators.
+
+    `LogitsSampler` applies, in this order and in place on a batch of logits: banned tokens, repetition penalty,
+    temperature, top-k and top-p (nucleus) filtering. It then takes the argmax (greedy mode) or samples.
+
+    Only the candidates are processed after the penalties: the `top_k` best logits, or all of them sorted for top-p
+    alone, written to buffers allocated once per sampler and reused at every step. Sampling uses the exponential
+    race: with E_i ~ Exp(1) drawn independently, argmax_i p_i / E_i is distributed as p, even unnormalized. So no
+    softmax is needed and the noise of each row can come from its own seeded generator (see `row_generators`),
+    which makes every row reproducible whatever the batch it runs in.
+"""
+import torch
+
+
+class LogitsSampler(object):
+    """ Picks the next token of every row of (batch, vocab) logits.
+
+        `repetition_penalty` > 1 divides the positive logits (multiplies the negative ones) of the tokens already
+        in the sequence (Keskar et al., 2019). `banned_tokens` are never picked, `top_k` = 0 and `top_p` = 1
+        disable these filters.
+    """
+
+    def __init__(self, temperature=1., top_k=0, top_p=1., repetition_penalty=1., banned_tokens=(), greedy=False):
+        if not greedy and temperature <= 0:
+            raise ValueError("Temperature should be positive, use greedy mode instead")
+        if top_k < 0:
+            raise ValueError("top_k should be positive or 0")
+        if not 0 < top_p <= 1:
+            raise ValueError("top_p should be in ]0, 1]")
+        if repetition_penalty <= 0:
+            raise ValueError("repetition_penalty should be positive")
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.repetition_penalty = repetition_penalty
+        self.banned_tokens = list(banned_tokens)
+        self.greedy = greedy
+        self._buffers = {}
+
+    def _buffer(self, name, like, width=None, dtype=None):
+        """ Reusable (batch, width) tensor on the device of `like`, grown when the batch gets bigger. """
+        width = width or like.size(1)
+        dtype = dtype or like.dtype
+        buffer = self._buffers.get((name, dtype))
+        if buffer is None or buffer.size(0) < like.size(0) or buffer.size(1) != width or buffer.device != like.device:
+            rows = max(like.size(0), buffer.size(0) if buffer is not None else 0)
+            buffer = self._buffers[(name, dtype)] = torch.empty((rows, width), dtype=dtype, device=like.device)
+        return buffer[:like.size(0)]
+
+    def penalize(self, logits, input_ids=None):
+        """ Ban tokens and penalize the repetitions in `logits`, in place. `input_ids` are the tokens seen so far. """
+        if self.banned_tokens:
+            banned = self._buffers.get('banned')
+            if banned is None or banned.device != logits.device:
+                banned = self._buffers['banned'] = torch.tensor(self.banned_tokens, device=logits.device)
+            logits.index_fill_(1, banned, -float('inf'))
+
+        if self.repetition_penalty != 1 and input_ids is not None and input_ids.numel():
+            score = logits.gather(1, input_ids)
+            score = torch.where(score > 0, score / self.repetition_penalty, score * self.repetition_penalty)
+            logits.scatter_(1, input_ids, score)
+        return logits
+
+    def __call__(self, logits, input_ids=None, generators=None):
+        """ Next token of every row as a (batch, 1) LongTensor. `logits` is overwritten.
+
+            `generators` gives one torch.Generator per row, the global generator is used otherwise.
+        """
+        logits = self.penalize(logits, input_ids)
+        if self.greedy:
+            return logits.argmax(dim=-1, keepdim=True)
+
+        # Candidates, best first unless there is no filter at all
+        indexes = None
+        if 0 < self.top_k < logits.size(-1):
+            values = self._buffer('values', logits, self.top_k)
+            indexes = self._buffer('indexes', logits, self.top_k, torch.long)
+            torch.topk(logits, self.top_k, dim=-1, out=(values, indexes))
+        elif self.top_p < 1:
+            values, indexes = self._buffer('values', logits), self._buffer('indexes', logits, dtype=torch.long)
+            torch.sort(logits, dim=-1, descending=True, out=(values, indexes))
+        else:
+            values = logits
+
+        # Unnormalized probabilities, the temperature applies after the max is subtracted
+        top = values[:, :1].clone() if indexes is not None else values.max(dim=-1, keepdim=True)[0]
+        probs = values.sub_(top)
+        if self.temperature != 1:
+            probs.div_(self.temperature)
+        probs.exp_()
+
+        if self.top_p < 1:
+            # The most likely candidate is always kept, the others until the mass before them reaches top_p
+            before = self._buffer('before', probs)
+            torch.cumsum(probs, dim=-1, out=before)
+            total = before[:, -1:] * self.top_p
+            before.sub_(probs)
+            mask = self._buffer('mask', probs, dtype=torch.bool)
+            torch.ge(before, total, out=mask)
+            probs.masked_fill_(mask, 0.)
+
+        noise = self._buffer('noise', probs)
+        if generators is None:
+            noise.exponential_()
+        else:
+            for row, generator in zip(noise, generators):
+                row.exponential_(generator=generator)
+        choice = probs.div_(noise).argmax(dim=-1, keepdim=True)
+        return choice if indexes is None else indexes.gather(1, choice)
+
+
+def row_generators(seeds, device='cpu'):
+    """ One torch.Generator per row, seeded with `seeds`. """
+    generators = []
+    for seed in seeds:
+        generator = torch.Generator(device=device)
+        generator.manual_seed(seed)
+        generators.append(generator)
+    return generators
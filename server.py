@@ -0,0 +1,425 @@
+# Copyright 2019 - UMONS
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You should have received a copy of the Apache License Version 2.0 along with this program.
+# If not, see
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Asynchronous HTTP generation server over the GPT, GPT-2, Transformer-XL and BERT generators.
+
+    Endpoints (JSON body, e.g. {"model": "gpt2", "text": "Maybe this will work", "tokens_to_generate": 30}):
+        GET  /models    names of the available models
+        GET  /stats     hit rates and sizes of the prompt prefix caches and chat sessions of the GPT and GPT-2
+                        models
+        POST /generate  the whole generation as {"model", "tokens", "text"}
+        POST /stream    the same generation as server-sent events, one `data: {"token": ...}` event per piece of
+                        text (see detokenizer.py, a token may only be written with the next ones)
+
+    BERT requests take a `mask` word instead of `tokens_to_generate` and return the suggestions as tokens.
+    GPT and GPT-2 requests reuse the attention states of the prompt prefixes seen before (see prefix_cache.py).
+    With a `session` id, a GPT or GPT-2 request is the next turn of that conversation: its text is added to the
+    context kept since the previous turns (see session.py). Requests for a session still generating get a 409.
+    Each model step runs on a bounded thread pool. The fields of a request, and the length of its prompt against the
+    model window, are checked before any step runs: invalid requests get a 400. Requests over `max_pending` get a
+    503, requests over their `timeout` get a 504, failures once streaming started end the stream with an `error`
+    event instead of a status code, and a stream stops as soon as its client disconnects. Only the standard library
+    is used on the HTTP side. pytorch_pretrained_bert and the generator modules of a backend are imported on its
+    first request, and a GPT or GPT-2 directory exported by export.py runs its traced decoder.
+"""
+import argparse
+import asyncio
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from decoding import greedy_tokens
+from detokenizer import WikiTextDetokenizer, get_detokenizer
+from prefix_cache import PrefixCache
+from registry import get_model, get_tokenizer
+from session import ChatSession, SessionBusyError, SessionStore
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 409: 'Conflict', 500: 'Internal Server Error',
+                503: 'Service Unavailable', 504: 'Gateway Timeout'}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super(HTTPError, self).__init__(message)
+        self.status = status
+
+
+def _positive(request, name, default, number_type=int):
+    """ Field `name` of `request` (or `default`), checked to be a positive integer or number. """
+    value = request.get(name, default)
+    if isinstance(value, bool) or not isinstance(value, int if number_type is int else (int, float)):
+        raise HTTPError(400, "`%s` should be %s" % (name, "an integer" if number_type is int else "a number"))
+    if value <= 0:
+        raise HTTPError(400, "`%s` should be positive" % name)
+    return number_type(value)
+
+
+class Backend(object):
+    """ Lazily loaded tokenizer and model of one generator. `load` is called on the worker pool.
+
+        `tokenizer_class` and `model_class` are names in pytorch_pretrained_bert, which is only imported by `load`.
+    """
+    generative = True
+
+    def __init__(self, model_name_or_path=None, tokenizer=None, model=None, dtype=None):
+        self.model_name_or_path = model_name_or_path
+        self.tokenizer = tokenizer
+        self.model = model
+        self.dtype = dtype
+
+    def load(self):
+        if self.model is None:
+            import pytorch_pretrained_bert
+            tokenizer_class = getattr(pytorch_pretrained_bert, self.tokenizer_class)
+            model_class = getattr(pytorch_pretrained_bert, self.model_class)
+            self.tokenizer = get_tokenizer(tokenizer_class, self.model_name_or_path)
+            self.model = get_model(model_class, self.model_name_or_path, dtype=self.dtype)
+
+    def parse(self, request):
+        """ Arguments of `stream` for `request`, once loaded. Raises HTTPError (400) if the request is invalid. """
+        raise NotImplementedError
+
+    def stream(self, request, args):
+        """ Iterator over the text pieces answering `request`, given the result of `parse`. """
+        raise NotImplementedError
+
+
+class GPT2Backend(Backend):
+    tokenizer_class, model_class = 'GPT2Tokenizer', 'GPT2LMHeadModel'
+
+    def __init__(self, model_name_or_path=None, tokenizer=None, model=None, dtype=None, prefix_cache=None,
+                 sessions=None):
+        super(GPT2Backend, self).__init__(model_name_or_path, tokenizer, model, dtype)
+        self.prefix_cache = prefix_cache
+        self.sessions = sessions
+
+    def parse(self, request):
+        tokens_to_generate = _positive(request, 'tokens_to_generate', 30)
+        indexed_tokens = self.tokenizer.convert_tokens_to_ids(self.tokenizer.tokenize(request['text']))
+        if not indexed_tokens:
+            raise HTTPError(400, "Prompt should not be empty!")
+        session = request.get('session')
+        if session is not None and self.sessions is not None:
+            # Sessions slide their window instead
+            return {'indexed_tokens': indexed_tokens, 'tokens_to_generate': tokens_to_generate,
+                    'session': str(session)}
+        n_positions = self.model.config.n_positions
+        if len(indexed_tokens) + tokens_to_generate > n_positions:
+            raise HTTPError(400, "Prompt (%d tokens) and tokens_to_generate (%d) are longer than the window size: %d"
+                            % (len(indexed_tokens), tokens_to_generate, n_positions))
+        return {'indexed_tokens': indexed_tokens, 'tokens_to_generate': tokens_to_generate, 'session': None}
+
+    def stream(self, request, args):
+        if args['session'] is not None:
+            session = self.sessions.get(args['session'], lambda: ChatSession(self.model))
+            tokens = session.generate(args['indexed_tokens'], args['tokens_to_generate'])
+        else:
+            tokens = greedy_tokens(self.model, args['indexed_tokens'], args['tokens_to_generate'],
+                                   prefix_cache=self.prefix_cache)
+        detokenizer = get_detokenizer(self.tokenizer)
+        for token in tokens:
+            piece = detokenizer.add(token.item())
+            if piece:
+                yield piece
+        piece = detokenizer.flush()
+        if piece:
+            yield piece
+
+
+class OpenAIGPTBackend(GPT2Backend):
+    tokenizer_class, model_class = 'OpenAIGPTTokenizer', 'OpenAIGPTLMHeadModel'
+
+
+class TransfoXLBackend(Backend):
+    tokenizer_class, model_class = 'TransfoXLTokenizer', 'TransfoXLLMHeadModel'
+
+    def parse(self, request):
+        from transformer_xl import encode_context
+        # The relative positions and the memory let Transformer-XL generate past any window
+        return {'context': encode_context(self.tokenizer, request['text']),
+                'tokens_to_generate': _positive(request, 'tokens_to_generate', 40),
+                'select_from_k': _positive(request, 'select_from_k', 40)}
+
+    def stream(self, request, args):
+        from transformer_xl import transformer_xl_tokens
+        ctx_tensor = torch.tensor([args['context']], device=next(self.model.parameters()).device)
+        detokenizer = WikiTextDetokenizer()
+        for symbol in transformer_xl_tokens(self.model, self.tokenizer, ctx_tensor, args['tokens_to_generate'],
+                                            args['select_from_k']):
+            piece = detokenizer.add_symbol(symbol)
+            if piece:
+                yield piece
+        piece = detokenizer.flush()
+        if piece:
+            yield piece
+
+
+class BertBackend(Backend):
+    tokenizer_class, model_class = 'BertTokenizer', 'BertForMaskedLM'
+    generative = False
+
+    def parse(self, request):
+        if not isinstance(request.get('mask'), str):
+            raise HTTPError(400, "BERT requests need a `mask` word")
+        tokenized_text = self.tokenizer.tokenize(request['text'])
+        if request['mask'] not in tokenized_text:
+            raise HTTPError(400, "Masked word doesn't appear in sentence.")
+        # With [CLS] and [SEP]
+        max_positions = self.model.config.max_position_embeddings
+        if len(tokenized_text) + 2 > max_positions:
+            raise HTTPError(400, "Sentence is longer than the window size: %d" % max_positions)
+        return {'n_options': _positive(request, 'n_options', 10)}
+
+    def stream(self, request, args):
+        from bert import bert_suggestions
+        _, predicted_tokens = bert_suggestions(self.tokenizer, self.model, request['text'], request['mask'],
+                                               args['n_options'])
+        for predicted_token in predicted_tokens:
+            yield predicted_token
+
+
+def _next(iterator):
+    return next(iterator, _DONE)
+
+
+class GenerationServer(object):
+    """ Serves the `backends` (dict of name -> Backend) with at most `workers` model steps running at once. """
+
+    def __init__(self, backends, workers=2, max_pending=64, timeout=60.):
+        self.backends = backends
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.pending = 0
+
+    async def _steps(self, request, deadline):
+        """ Asynchronous iterator over the pieces of `request`, each step running on the worker pool. """
+        backend = self.backends.get(request.get('model'))
+        if backend is None:
+            raise HTTPError(404, "Unknown model %r" % request.get('model'))
+        if not isinstance(request.get('text'), str) or not request['text']:
+            raise HTTPError(400, "Prompt should not be empty!")
+
+        loop = asyncio.get_running_loop()
+        if backend.model is None:
+            await asyncio.wait_for(loop.run_in_executor(self.pool, backend.load), deadline - loop.time())
+        # Bad requests are answered before any generation step
+        iterator = backend.stream(request, backend.parse(request))
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise asyncio.TimeoutError()
+            piece = await asyncio.wait_for(loop.run_in_executor(self.pool, _next, iterator), remaining)
+            if piece is _DONE:
+                return
+            yield piece
+
+    async def handle(self, reader, writer):
+        try:
+            method, path, request = await self._read_request(reader)
+            if method == 'GET' and path == '/models':
+                await self._send_json(writer, 200, {'models': sorted(self.backends)})
+            elif method == 'GET' and path == '/stats':
+                await self._send_json(writer, 200, {'prefix_cache': {
+                    name: backend.prefix_cache.stats() for name, backend in self.backends.items()
+                    if getattr(backend, 'prefix_cache', None) is not None}, 'sessions': {
+                    name: backend.sessions.stats() for name, backend in self.backends.items()
+                    if getattr(backend, 'sessions', None) is not None}})
+            elif method == 'POST' and path in ('/generate', '/stream'):
+                if self.pending >= self.max_pending:
+                    raise HTTPError(503, "Too many pending requests")
+                deadline = asyncio.get_running_loop().time() + _positive(request, 'timeout', self.timeout, float)
+                self.pending += 1
+                try:
+                    if path == '/generate':
+                        await self._generate(writer, request, deadline)
+                    else:
+                        await self._stream(reader, writer, request, deadline)
+                finally:
+                    self.pending -= 1
+            else:
+                raise HTTPError(404, "Unknown endpoint %s %s" % (method, path))
+        except HTTPError as e:
+            await self._send_json(writer, e.status, {'error': str(e)})
+        except SessionBusyError as e:
+            await self._send_json(writer, 409, {'error': str(e)})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            logger.exception("Request failed")
+            await self._send_json(writer, 500, {'error': str(e)})
+        finally:
+            writer.close()
+
+    async def _generate(self, writer, request, deadline):
+        pieces = []
+        try:
+            async for piece in self._steps(request, deadline):
+                pieces.append(piece)
+        except asyncio.TimeoutError:
+            raise HTTPError(504, "Generation timed out")
+        result = {'model': request['model'], 'tokens': pieces}
+        if self.backends[request['model']].generative:
+            result['text'] = "".join(pieces)
+        await self._send_json(writer, 200, result)
+
+    async def _stream(self, reader, writer, request, deadline):
+        steps = self._steps(request, deadline)
+        headers_sent = False
+        disconnected = None
+        try:
+            # Validate the request before answering 200
+            try:
+                first = await steps.__anext__()
+            except StopAsyncIteration:
+                first = None
+
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n"
+                         b"Connection: close\r\n\r\n")
+            headers_sent = True
+            # The client sends nothing more, so anything read from now on means it went away
+            disconnected = asyncio.ensure_future(reader.read(1))
+            if first is not None:
+                await self._send_event(writer, {'token': first})
+            async for piece in steps:
+                if disconnected.done():
+                    logger.info("Client disconnected, generation cancelled")
+                    return
+                await self._send_event(writer, {'token': piece})
+            writer.write(b"data: [DONE]\n\n")
+        except (ConnectionError, asyncio.IncompleteReadError):
+            raise
+        except asyncio.TimeoutError:
+            if not headers_sent:
+                raise HTTPError(504, "Generation timed out")
+            self._write_error_event(writer, "Generation timed out")
+        except Exception as e:
+            # Once streaming started, errors can only be reported as events
+            if not headers_sent:
+                raise
+            logger.exception("Generation failed")
+            self._write_error_event(writer, str(e))
+        finally:
+            if disconnected is not None:
+                disconnected.cancel()
+            await steps.aclose()
+        await writer.drain()
+
+    def _write_error_event(self, writer, message):
+        writer.write(b"event: error\ndata: " + json.dumps({'error': message}).encode('utf_8') + b"\n\n")
+
+    async def _read_request(self, reader):
+        request_line = (await reader.readline()).decode('latin-1').split()
+        if len(request_line) != 3:
+            raise HTTPError(400, "Malformed request line")
+        method, path, _ = request_line
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1')
+            if line in ('\r\n', '\n', ''):
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get('content-length', 0)))
+        try:
+            request = json.loads(body.decode('utf_8')) if body else {}
+        except ValueError:
+            raise HTTPError(400, "Body should be JSON")
+        if not isinstance(request, dict):
+            raise HTTPError(400, "Body should be a JSON object")
+        return method, path, request
+
+    async def _send_json(self, writer, status, obj):
+        body = json.dumps(obj).encode('utf_8')
+        writer.write(("HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n"
+                      "Connection: close\r\n\r\n" % (status, HTTP_REASONS[status], len(body))).encode('latin-1'))
+        writer.write(body)
+        await writer.drain()
+
+    async def _send_event(self, writer, obj):
+        writer.write(b"data: " + json.dumps(obj).encode('utf_8') + b"\n\n")
+        await writer.drain()
+
+    async def serve(self, host='127.0.0.1', port=8000):
+        server = await asyncio.start_server(self.handle, host, port)
+        logger.info("Serving %s on %s:%d", ", ".join(sorted(self.backends)), host, port)
+        async with server:
+            await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=2,
+                        help='Number of model steps running at the same time.')
+    parser.add_argument('--max_pending', type=int, default=64,
+                        help='Number of requests accepted before answering 503.')
+    parser.add_argument('--timeout', type=float, default=60.,
+                        help='Default timeout of a request in seconds.')
+    parser.add_argument('--gpt2', type=str, default='gpt2',
+                        help='GPT-2 model name or path, empty to disable.')
+    parser.add_argument('--openai_gpt', type=str, default='openai-gpt',
+                        help='OpenAI-GPT model name or path, empty to disable.')
+    parser.add_argument('--transfo_xl', type=str, default='transfo-xl-wt103',
+                        help='Transformer-XL model name or path, empty to disable.')
+    parser.add_argument('--bert', type=str, default='bert-base-uncased',
+                        help='BERT model name or path, empty to disable.')
+    parser.add_argument('--prefix_cache_mb', type=float, default=256.,
+                        help='Memory for the prompt prefix cache of each GPT model, 0 to disable it.')
+    parser.add_argument('--prefix_block_size', type=int, default=16,
+                        help='Prompt prefixes are cached by blocks of this many tokens.')
+    parser.add_argument('--max_sessions', type=int, default=16,
+                        help='Chat sessions kept for each GPT model, each with the cache of a whole window. 0 to '
+                             'disable them.')
+    parser.add_argument('--session_idle_timeout', type=float, default=600.,
+                        help='Chat sessions unused for this many seconds are dropped.')
+    parser.add_argument('--quantize', action='store_true',
+                        help='Run the linear layers of GPT, GPT-2 and BERT in int8 on CPU.')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                        datefmt='%m/%d/%Y %H:%M:%S',
+                        level=logging.INFO)
+
+    backends = {}
+    for name, backend_class, model_name_or_path in [('gpt2', GPT2Backend, args.gpt2),
+                                                    ('openai-gpt', OpenAIGPTBackend, args.openai_gpt),
+                                                    ('transfo-xl', TransfoXLBackend, args.transfo_xl),
+                                                    ('bert', BertBackend, args.bert)]:
+        if not model_name_or_path:
+            continue
+        dtype = torch.qint8 if args.quantize and backend_class is not TransfoXLBackend else None
+        if issubclass(backend_class, GPT2Backend):
+            prefix_cache = PrefixCache(int(args.prefix_cache_mb * 2 ** 20), args.prefix_block_size) \
+                if args.prefix_cache_mb > 0 else None
+            sessions = SessionStore(args.max_sessions, args.session_idle_timeout) if args.max_sessions > 0 else None
+            backends[name] = backend_class(model_name_or_path, dtype=dtype, prefix_cache=prefix_cache,
+                                           sessions=sessions)
+        else:
+            backends[name] = backend_class(model_name_or_path, dtype=dtype)
+
+    server = GenerationServer(backends, workers=args.workers, max_pending=args.max_pending, timeout=args.timeout)
+    asyncio.run(server.serve(args.host, args.port))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+# Copyright 2019 - UMONS
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You should have received a copy of the Apache License Version 2.0 along with this program.
+# If not, see
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Chat sessions over the GPT and GPT-2 models: conversations whose context is kept between turns.
+
+    A `ChatSession` holds the token ids of the conversation and their attention cache (`past`, see decoding.py).
+    A new turn only runs its own tokens, and the last generated token, through the model. When the conversation
+    no longer fits in the `n_ctx` positions of the model, the window slides: only the last `keep_tokens` tokens
+    are kept and, the position embeddings being absolute, they are run through the model again from position 0.
+    This happens once every `n_ctx - keep_tokens` tokens at most, instead of failing.
+
+    A `SessionStore` keeps the sessions by id, up to `max_sessions` of them: the least recently used one is
+    dropped to make room for a new one, and the sessions that weren't used for `idle_timeout` seconds expire.
+    Every session holds a whole cache, so `max_sessions` bounds the memory used.
+"""
+import collections
+import threading
+import time
+
+import torch
+
+from decoding import model_step
+from sampling import LogitsSampler
+from tracing import NULL_TRACER
+
+
+class SessionBusyError(RuntimeError):
+    pass
+
+
+class ChatSession(object):
+    """ Token ids of a conversation with a GPT or GPT-2 `model`, and their cache. One turn at a time. """
+
+    def __init__(self, model, keep_tokens=None):
+        self.model = model
+        self.step = model_step(model)
+        self.n_ctx = model.config.n_ctx
+        self.keep_tokens = self.n_ctx // 2 if keep_tokens is None else keep_tokens
+        if not 0 <= self.keep_tokens < self.n_ctx:
+            raise ValueError("keep_tokens should be in [0, %d[" % self.n_ctx)
+        device = next(model.parameters()).device
+        self.window = torch.empty((1, self.n_ctx), dtype=torch.long, device=device)
+        self.length = 0  # Tokens in the window
+        self.cached = 0  # Tokens of the window in `past`
+        self.past = None
+        self.busy = False
+        self.lock = threading.Lock()
+        self.total_tokens = self.slides = self.reprimed_tokens = 0
+
+    @property
+    def tokens(self):
+        """ Token ids of the window: the end of the conversation. """
+        return self.window[0, :self.length].tolist()
+
+    def _slide(self, n_new):
+        keep = min(self.keep_tokens, self.n_ctx - n_new)
+        self.window[0, :keep] = self.window[0, self.length - keep:self.length].clone()
+        self.length = keep
+        self.cached = 0
+        self.past = None
+        self.slides += 1
+        self.reprimed_tokens += keep
+
+    def _append(self, token_ids):
+        token_ids = token_ids[len(token_ids) - self.n_ctx:] if len(token_ids) > self.n_ctx else token_ids
+        if self.length + len(token_ids) > self.n_ctx:
+            self._slide(len(token_ids))
+        self.window[0, self.length:self.length + len(token_ids)] = torch.as_tensor(token_ids)
+        self.length += len(token_ids)
+        self.total_tokens += len(token_ids)
+
+    def generate(self, token_ids, tokens_to_generate, sampler=None, generator=None, tracer=None):
+        """ Add the turn `token_ids` to the conversation and generate `tokens_to_generate` ids after it, yielding
+            each one as a (1, 1) LongTensor. Generated ids are part of the conversation too.
+
+            Tokens are picked by the LogitsSampler `sampler` (greedy by default), with the torch.Generator
+            `generator` if given, the repetition penalty seeing the whole window. Raises SessionBusyError if the
+            previous turn is still being generated.
+        """
+        with self.lock:
+            if self.busy:
+                raise SessionBusyError("The session is still generating")
+            self.busy = True
+        try:
+            if not token_ids and not self.length:
+                raise ValueError("The first turn should not be empty")
+            sampler = sampler or LogitsSampler(greedy=True)
+            tracer = tracer or NULL_TRACER
+            generators = [generator] if generator is not None else None
+            self._append(token_ids)
+            for i in range(tokens_to_generate):
+                with tracer.span('forward'), torch.no_grad():
+                    logits, self.past = self.step(self.model, self.window[:, self.cached:self.length], self.past)
+                self.cached = self.length
+                with tracer.span('sample'):
+                    token = sampler(logits[:, -1, :], self.window[:, :self.length], generators)
+                    self._append(token[0])
+                tracer.step(1, self.length)
+                yield token
+        finally:
+            self.busy = False
+
+    def stats(self):
+        return {'tokens': self.total_tokens, 'window': self.length, 'slides': self.slides,
+                'reprimed_tokens': self.reprimed_tokens}
+
+
+class SessionStore(object):
+    """ Sessions by id, least recently used first, safe to share between threads. """
+
+    def __init__(self, max_sessions=16, idle_timeout=600.):
+        if max_sessions < 1:
+            raise ValueError("max_sessions should be at least 1")
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.sessions = collections.OrderedDict()  # id -> (session, last use), LRU first
+        self.lock = threading.Lock()
+        self.created = self.expired = self.evictions = 0
+
+    def _expire(self, now):
+        while self.sessions:
+            session_id, (_, last_use) = next(iter(self.sessions.items()))
+            if now - last_use < self.idle_timeout:
+                return
+            del self.sessions[session_id]
+            self.expired += 1
+
+    def get(self, session_id, factory):
+        """ Session `session_id`, made by calling `factory` if there is none. """
+        now = time.monotonic()
+        with self.lock:
+            self._expire(now)
+            session = self.sessions.pop(session_id, (None, None))[0]
+            if session is None:
+                session = factory()
+                self.created += 1
+                while len(self.sessions) >= self.max_sessions:
+                    self.sessions.popitem(last=False)
+                    self.evictions += 1
+            self.sessions[session_id] = (session, now)
+        return session
+
+    def remove(self, session_id):
+        """ Forget session `session_id`, returns whether there was one. """
+        with self.lock:
+            return self.sessions.pop(session_id, None) is not None
+
+    def stats(self):
+        with self.lock:
+            self._expire(time.monotonic())
+            return {'sessions': len(self.sessions), 'created': self.created, 'expired': self.expired,
+                    'evictions': self.evictions}
@@ -0,0 +1,153 @@
+# Copyright 2019 - UMONS
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You should have received a copy of the Apache License Version 2.0 along with this program.
+# If not, see
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Speculative greedy decoding for GPT and GPT-2.
+
+    A drafter guesses the next tokens, and the model checks them all in one forward pass: after the last known
+    token and the k drafted ones, its greedy predictions are compared with the draft, and the longest agreeing
+    prefix is kept along with the model's own token after it. Every pass gives between 1 and k + 1 tokens, the
+    same ones greedy decoding gives one pass at a time. The cache of the rejected tokens is dropped.
+
+    Drafts come from the text itself (`NGramDrafter`: what followed the last occurrence of the current suffix,
+    prompt included), which pays off when the output copies the prompt or repeats itself, or from a smaller model
+    sharing the tokenizer (`ModelDrafter`).
+"""
+import torch
+
+from decoding import TracedDecoder, model_step
+from tracing import NULL_TRACER
+
+
+class NGramDrafter(object):
+    """ Drafts the tokens that followed the last earlier occurrence of the longest suffix of the sequence, of at
+        most `max_ngram_size` tokens.
+    """
+
+    def __init__(self, max_ngram_size=3):
+        if max_ngram_size < 1:
+            raise ValueError("max_ngram_size should be at least 1")
+        self.max_ngram_size = max_ngram_size
+        self.sequence = []
+        self.index = {}  # n-gram -> position of the token after its last occurrence
+
+    def extend(self, tokens):
+        for token in tokens:
+            # The n-grams ending with the previous token are now followed by `token`
+            end = len(self.sequence)
+            for n in range(1, min(self.max_ngram_size, end) + 1):
+                self.index[tuple(self.sequence[end - n:end])] = end
+            self.sequence.append(token)
+
+    def draft(self, n_tokens):
+        for n in range(min(self.max_ngram_size, len(self.sequence)), 0, -1):
+            start = self.index.get(tuple(self.sequence[len(self.sequence) - n:]))
+            if start is not None:
+                return self.sequence[start:start + n_tokens]
+        return []
+
+
+class ModelDrafter(object):
+    """ Drafts the greedy continuation of the sequence by `draft_model`, a smaller GPT or GPT-2 model. """
+
+    def __init__(self, draft_model):
+        self.model = draft_model
+        self.step = model_step(draft_model)
+        self.device = next(draft_model.parameters()).device
+        self.sequence = []
+        self.cached = []  # Tokens in `past`
+        self.past = None
+
+    def extend(self, tokens):
+        self.sequence.extend(tokens)
+
+    def draft(self, n_tokens):
+        # The last drafted token doesn't go through the draft model
+        n_tokens = min(n_tokens, self.model.config.n_positions + 1 - len(self.sequence))
+        if n_tokens < 1:
+            return []
+        # Keep the cache of the drafted tokens that were accepted
+        common = 0
+        for cached, token in zip(self.cached, self.sequence):
+            if cached != token:
+                break
+            common += 1
+        common = min(common, len(self.sequence) - 1)
+        if common < len(self.cached):
+            self.past = [layer_past[..., :common, :] for layer_past in self.past] if common else None
+            self.cached = self.cached[:common]
+
+        drafted = []
+        input_ids = torch.tensor([self.sequence[common:]], dtype=torch.long, device=self.device)
+        with torch.no_grad():
+            for i in range(n_tokens):
+                logits, self.past = self.step(self.model, input_ids, self.past)
+                self.cached.extend(input_ids[0].tolist())
+                input_ids = logits[:, -1].argmax(dim=-1, keepdim=True)
+                drafted.append(input_ids.item())
+        return drafted
+
+
+def speculative_decode(model, context_ids, tokens_to_generate, drafter=None, num_draft_tokens=4, tracer=None):
+    """ Greedily generate `tokens_to_generate` ids after `context_ids`, `num_draft_tokens` at most drafted by
+        `drafter` (an `NGramDrafter` by default) being checked at each forward pass.
+
+        Returns the list of ids, and the statistics of the drafts: forward passes, drafted and accepted tokens,
+        acceptance rate and tokens per forward pass.
+    """
+    if num_draft_tokens < 0:
+        raise ValueError("num_draft_tokens should be positive")
+    if isinstance(model, TracedDecoder):
+        raise ValueError("Traced decoders only give the logits of the last position, drafts can't be checked")
+    if len(context_ids) + tokens_to_generate > model.config.n_positions:
+        raise ValueError("Can't get samples longer than window size: %s" % model.config.n_positions)
+    drafter = drafter or NGramDrafter()
+    tracer = tracer or NULL_TRACER
+    step = model_step(model)
+    device = next(model.parameters()).device
+    drafter.extend(context_ids)
+
+    output = []
+    passes = drafted = accepted = 0
+    past = None
+    input_ids = list(context_ids)  # Tokens that aren't in `past` yet
+    with torch.no_grad():
+        while len(output) < tokens_to_generate:
+            # The token after the last accepted one is always the model's own, so it can't overshoot
+            with tracer.span('draft'):
+                draft = drafter.draft(min(num_draft_tokens, tokens_to_generate - len(output) - 1)) if output else []
+            with tracer.span('forward'):
+                tokens = torch.tensor([input_ids + draft], dtype=torch.long, device=device)
+                logits, past = step(model, tokens, past)
+            with tracer.span('sample'):
+                predicted = logits[0, len(input_ids) - 1:].argmax(dim=-1).tolist()
+                n_accepted = 0
+                while n_accepted < len(draft) and draft[n_accepted] == predicted[n_accepted]:
+                    n_accepted += 1
+                new_tokens = draft[:n_accepted] + [predicted[n_accepted]]
+                # Drop the cache of the rejected draft tokens
+                length = len(context_ids) + len(output) + n_accepted
+                if n_accepted < len(draft):
+                    past = [layer_past[..., :length, :] for layer_past in past]
+            output.extend(new_tokens)
+            drafter.extend(new_tokens)
+            input_ids = new_tokens[-1:]
+            passes += 1
+            drafted += len(draft)
+            accepted += n_accepted
+            tracer.step(1, length)
+
+    return output, {'forward_passes': passes, 'drafted_tokens': drafted, 'accepted_tokens': accepted,
+                    'acceptance_rate': accepted / drafted if drafted else 0.,
+                    'tokens_per_pass': len(output) / passes if passes else 0.}
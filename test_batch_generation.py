@@ -0,0 +1,57 @@
+# Copyright 2019 - UMONS
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You should have received a copy of the Apache License Version 2.0 along with this program.
+# If not, see
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Offline generation of a JSONL file with bad lines, by one worker on the tiny GPT-2 of benchmark.py. """
+import json
+import os
+
+from batch_generation import run_job
+
+LINES = ['{"prompt": "hello there", "id": "a"}',
+         '{"prompt": "hello',
+         '["hello"]',
+         '"hello"',
+         '{"id": "b"}',
+         '{"prompt": "hello", "tokens_to_generate": "many"}',
+         '{"prompt": "good bye"}']
+
+
+def read_results(output_dir):
+    results = []
+    for name in sorted(os.listdir(output_dir)):
+        if name.startswith('shard-'):
+            with open(os.path.join(output_dir, name), encoding='utf_8') as f:
+                results.extend(json.loads(line) for line in f)
+    return sorted(results, key=lambda result: result['line'])
+
+
+def test_bad_lines(model_dirs, tmp_path):
+    input_file = str(tmp_path / 'prompts.jsonl')
+    with open(input_file, 'w', encoding='utf_8') as f:
+        f.write('\n'.join(LINES) + '\n')
+    output_dir = str(tmp_path / 'output')
+    assert run_job(input_file, output_dir, 'gpt2', model_dirs('gpt2'), {'tokens_to_generate': 3}, shard_size=3,
+                   num_workers=1) == len(LINES)
+
+    results = read_results(output_dir)
+    assert [result['line'] for result in results] == list(range(len(LINES)))
+    assert [result['id'] for result in results] == ['a', 1, 2, 3, 'b', 5, 6]
+    assert ['text' in result for result in results] == [True, False, False, False, False, False, True]
+    assert all(('error' in result) != ('text' in result) for result in results)
+    with open(os.path.join(output_dir, 'manifest.json'), encoding='utf_8') as f:
+        assert json.load(f)['complete'] == [0, 1, 2]
+    # Nothing left to generate
+    assert run_job(input_file, output_dir, 'gpt2', model_dirs('gpt2'), {'tokens_to_generate': 3}, shard_size=3,
+                   num_workers=1) == 0
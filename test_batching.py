@@ -0,0 +1,66 @@
+# Copyright 2019 - UMONS
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You should have received a copy of the Apache License Version 2.0 along with this program.
+# If not, see
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Continuous batching gives the output of decoding each prompt on its own, on the tiny random models. """
+import random
+
+import pytest
+
+from batching import ContinuousBatcher
+from decoding import decode
+
+
+def requests(n, seed=0):
+    """ (context, length) of `n` prompts of different lengths. """
+    rng = random.Random(seed)
+    return [([rng.randrange(100) for _ in range(rng.randrange(1, 12))], rng.randrange(1, 15)) for _ in range(n)]
+
+
+def test_empty_step(tiny_gpt2):
+    batcher = ContinuousBatcher(tiny_gpt2, sample=False)
+    assert batcher.step() == []
+    assert list(batcher.run()) == []
+
+
+@pytest.mark.parametrize('model_name', ['tiny_gpt2', 'tiny_openai'])
+def test_staggered_requests(request, model_name):
+    model = request.getfixturevalue(model_name)
+    batcher = ContinuousBatcher(model, max_batch_size=3, sample=False)
+    prompts = requests(10)
+    results = {}
+    # Some prompts are queued while others are decoding, some arrive once the batch is empty
+    for i, (context, length) in enumerate(prompts[:5]):
+        batcher.submit(context, length, request_id=i)
+    for _ in range(4):
+        results.update(batcher.step())
+    for i, (context, length) in enumerate(prompts[5:8], 5):
+        batcher.submit(context, length, request_id=i)
+    results.update(batcher.run())
+    assert batcher.step() == []
+    for i, (context, length) in enumerate(prompts[8:], 8):
+        batcher.submit(context, length, request_id=i)
+    results.update(batcher.run())
+
+    assert sorted(results) == list(range(len(prompts)))
+    for i, (context, length) in enumerate(prompts):
+        assert results[i] == decode(model, context, length).tolist(), i
+
+
+def test_window(tiny_gpt2):
+    batcher = ContinuousBatcher(tiny_gpt2)
+    with pytest.raises(ValueError):
+        batcher.submit([1] * 60, 5)
+    with pytest.raises(ValueError):
+        batcher.submit([], 5)
@@ -0,0 +1,77 @@
+# Copyright 2019 - UMONS
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You should have received a copy of the Apache License Version 2.0 along with this program.
+# If not, see
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Beam search on a model given by a table of next token probabilities, and on a tiny GPT-2. """
+import math
+
+import pytest
+import torch
+
+from beam_search import beam_search, gpt_beam_search
+from decoding import decode
+
+EOS = 0
+
+
+def table_search(table, contexts, tokens_to_generate, num_beams=2, **kwargs):
+    """ `beam_search` with the next token probabilities `table[last token]`. """
+    log_probs = torch.tensor(table).log()
+
+    def advance(tokens, cache):
+        return log_probs[tokens[:, 0]].clone(), tokens[:, 0]
+
+    def reorder(cache, index):
+        return cache.index_select(0, index)
+
+    last = torch.tensor([context[-1] for context in contexts]).repeat_interleave(num_beams)
+    return beam_search(advance, reorder, log_probs[last].clone(), last, contexts, tokens_to_generate, num_beams,
+                       eos_token_id=EOS, **kwargs)
+
+
+# After token 1, the end of sequence is the most likely, then token 2 which is always followed by the end
+TABLE = [[0.25, 0.25, 0.25, 0.25],
+         [0.6, 0.05, 0.3, 0.05],
+         [0.9, 0.04, 0.03, 0.03],
+         [0.25, 0.25, 0.25, 0.25]]
+
+
+def test_no_empty_hypothesis():
+    hypotheses, = table_search(TABLE, [[1]], 5)
+    assert [] not in [tokens for tokens, _ in hypotheses]
+    assert hypotheses[0][0] == [2]
+
+
+def test_eos_counts_in_the_length():
+    hypotheses, = table_search(TABLE, [[1]], 5, length_penalty=1.)
+    tokens, score = hypotheses[0]
+    assert score == pytest.approx((math.log(0.3) + math.log(0.9)) / 2)
+
+
+def test_nothing_to_generate():
+    assert table_search(TABLE, [[1], [3]], 0) == [[([], 0.)], [([], 0.)]]
+
+
+def test_every_continuation_banned():
+    # Only the end of sequence can follow token 1, and it can't be the first token
+    table = [[0.25, 0.25, 0.25, 0.25], [1., 0., 0., 0.], [0.25, 0.25, 0.25, 0.25], [0.25, 0.25, 0.25, 0.25]]
+    hypotheses = table_search(table, [[1], [3]], 3)
+    assert hypotheses[0] == [([], 0.)]
+    assert hypotheses[1][0][0]
+
+
+def test_one_beam_is_greedy(tiny_gpt2):
+    context = [5, 17, 42, 8]
+    hypotheses, = gpt_beam_search(tiny_gpt2, [context], 12, num_beams=1)
+    assert hypotheses[0][0] == decode(tiny_gpt2, context, 12).tolist()
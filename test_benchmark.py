@@ -0,0 +1,40 @@
+# Copyright 2019 - UMONS
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You should have received a copy of the Apache License Version 2.0 along with this program.
+# If not, see
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" A run of the benchmarks on the tiny configuration. """
+import pytest
+
+import benchmark
+
+
+def test_failure_is_skipped(tmp_path, monkeypatch):
+    def bench_failing(*args):
+        raise RuntimeError("masked_fill_ only supports boolean masks")
+    monkeypatch.setattr(benchmark, 'bench_transformer_xl_generation', bench_failing)
+    results = benchmark.run_benchmarks(str(tmp_path), ['transformer_xl_generation', 'gpt2_generation'], ['tiny'],
+                                       [1, 4], [8], 4, 1)
+    failed = [result for result in results if result['benchmark'] == 'transformer_xl_generation']
+    assert [result['batch_size'] for result in failed] == [1, 4]
+    assert all('masked_fill_' in result['skipped'] and 'tokens_per_second' not in result for result in failed)
+    # Only one sequence for the greedy generators
+    generated = [result for result in results if result['benchmark'] == 'gpt2_generation']
+    assert [result['batch_size'] for result in generated] == [1]
+    assert generated[0]['tokens_per_second'] > 0 and 'skipped' not in generated[0]
+    assert benchmark.compare(results, results) == []
+
+
+def test_single_sequence(tmp_path):
+    with pytest.raises(ValueError):
+        benchmark.bench_gpt2_generation(str(tmp_path), 'tiny', 4, 8, 4, 1)
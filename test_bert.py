@@ -0,0 +1,56 @@
+# Copyright 2019 - UMONS
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You should have received a copy of the Apache License Version 2.0 along with this program.
+# If not, see
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Mask-predict span generation on the tiny random BERT of benchmark.py. """
+import pytest
+from pytorch_pretrained_bert import BertForMaskedLM, BertTokenizer
+
+from bert import mask_predict
+
+
+@pytest.fixture(scope='module')
+def bert(model_dirs):
+    directory = model_dirs('bert')
+    return BertTokenizer.from_pretrained(directory), BertForMaskedLM.from_pretrained(directory).eval()
+
+
+def test_mask_predict(bert):
+    tokenizer, model = bert
+    text = ' '.join(list(tokenizer.vocab)[5:12])
+    candidates = mask_predict(tokenizer, model, text, 6, iterations=3, n_candidates=3)
+    assert len(candidates) == 3
+    assert [score for _, score in candidates] == sorted((score for _, score in candidates), reverse=True)
+    for tokens, _ in candidates:
+        assert len(tokens) == 6 and '[MASK]' not in tokens
+
+
+@pytest.mark.parametrize('kwargs', [{'iterations': 0}, {'iterations': -1}, {'n_candidates': 0},
+                                    {'tokens_to_generate': 0}])
+def test_invalid_arguments(bert, kwargs):
+    tokenizer, model = bert
+    arguments = dict({'tokens_to_generate': 4}, **kwargs)
+    with pytest.raises(ValueError):
+        mask_predict(tokenizer, model, 'text', **arguments)
+
+
+def test_window(bert):
+    tokenizer, model = bert
+    max_positions = model.config.max_position_embeddings
+    text = ' '.join(list(tokenizer.vocab)[5:15])
+    n_tokens = len(tokenizer.tokenize(text))
+    # [CLS], the text, the span and [SEP] fill the window exactly
+    assert len(mask_predict(tokenizer, model, text, max_positions - n_tokens - 2, iterations=1)) == 4
+    with pytest.raises(ValueError, match='window size'):
+        mask_predict(tokenizer, model, text, max_positions - n_tokens - 1, iterations=1)
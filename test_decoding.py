@@ -0,0 +1,55 @@
+# Copyright 2019 - UMONS
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You should have received a copy of the Apache License Version 2.0 along with this program.
+# If not, see
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" The cached decoding of decoding.py gives the tokens of a full forward pass over the sequence at every step. """
+import pytest
+import torch
+
+from decoding import decode
+from sampling import LogitsSampler
+
+CONTEXT = [5, 17, 42, 8, 99, 3]
+
+
+def full_recompute(model, context_ids, tokens_to_generate, sampler, generator=None):
+    """ The generators before the cache: the whole sequence goes through the model at every step. """
+    sequence = torch.tensor([context_ids])
+    generators = [generator] if generator is not None else None
+    with torch.no_grad():
+        for _ in range(tokens_to_generate):
+            logits = model(sequence)
+            logits = logits[0] if isinstance(logits, tuple) else logits
+            sequence = torch.cat((sequence, sampler(logits[:, -1, :], sequence, generators)), dim=1)
+    return sequence[0, len(context_ids):].tolist()
+
+
+@pytest.mark.parametrize('model_name', ['tiny_gpt2', 'tiny_openai'])
+def test_greedy_matches_full_recompute(request, model_name):
+    model = request.getfixturevalue(model_name)
+    sampler = LogitsSampler(greedy=True)
+    assert decode(model, CONTEXT, 30, sampler).tolist() == full_recompute(model, CONTEXT, 30, sampler)
+
+
+@pytest.mark.parametrize('model_name', ['tiny_gpt2', 'tiny_openai'])
+def test_sampling_matches_full_recompute(request, model_name):
+    model = request.getfixturevalue(model_name)
+    sampler = LogitsSampler(temperature=0.8, top_k=20, repetition_penalty=1.3)
+    cached = decode(model, CONTEXT, 30, sampler, torch.Generator().manual_seed(1)).tolist()
+    assert cached == full_recompute(model, CONTEXT, 30, sampler, torch.Generator().manual_seed(1))
+
+
+def test_single_token_context(tiny_gpt2):
+    sampler = LogitsSampler(greedy=True)
+    assert decode(tiny_gpt2, [7], 10, sampler).tolist() == full_recompute(tiny_gpt2, [7], 10, sampler)
@@ -0,0 +1,130 @@
+# Copyright 2019 - UMONS
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You should have received a copy of the Apache License Version 2.0 along with this program.
+# If not, see
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" The streaming detokenizers against the decoding of the whole sequence. """
+import json
+import random
+
+import pytest
+from pytorch_pretrained_bert import GPT2Tokenizer, OpenAIGPTTokenizer
+
+from detokenizer import WIKITEXT_RULES, WikiTextDetokenizer, detokenize, get_detokenizer
+
+
+def check_stream(detokenizer, items, expected, add=None):
+    """ The pieces given for `items` are a prefix of `expected` after each item, and `expected` once flushed. """
+    add = add or detokenizer.add
+    text = ''
+    for item in items:
+        text += add(item)
+        assert expected.startswith(text)
+    assert text + detokenizer.flush() == expected
+
+
+@pytest.fixture(scope='module')
+def gpt2_tokenizer(model_dirs):
+    # One token per byte
+    return GPT2Tokenizer.from_pretrained(model_dirs('gpt2'))
+
+
+def byte_ids(tokenizer, data):
+    return [tokenizer.encoder[tokenizer.byte_encoder[byte]] for byte in data]
+
+
+@pytest.mark.parametrize('text', ['hello world', 'héllo wörld', '日本語 text', 'emoji 😀 and 🇧🇪', ' é\n😀 '])
+def test_gpt2_split_characters(gpt2_tokenizer, text):
+    # The characters outside of ASCII are split between tokens
+    ids = byte_ids(gpt2_tokenizer, text.encode('utf_8'))
+    assert detokenize(gpt2_tokenizer, ids) == gpt2_tokenizer.decode(ids) == text
+    check_stream(get_detokenizer(gpt2_tokenizer), ids, text)
+
+
+def test_gpt2_invalid_bytes(gpt2_tokenizer):
+    # Truncated characters, a lone continuation byte and an invalid start byte are replaced like decode does
+    for data in [b'a\xc3', b'\xe6\x97b', b'\x80abc', b'a\xff\xc3\xa9', '😀'.encode('utf_8')[:3] + b' ok']:
+        ids = byte_ids(gpt2_tokenizer, data)
+        assert detokenize(gpt2_tokenizer, ids) == gpt2_tokenizer.decode(ids)
+        check_stream(get_detokenizer(gpt2_tokenizer), ids, gpt2_tokenizer.decode(ids))
+
+
+def test_gpt2_random_ids(gpt2_tokenizer):
+    rng = random.Random(0)
+    for _ in range(200):
+        ids = [rng.randrange(len(gpt2_tokenizer.decoder)) for _ in range(rng.randrange(1, 30))]
+        assert detokenize(gpt2_tokenizer, ids) == gpt2_tokenizer.decode(ids)
+
+
+# `</w>` whole, in two and in four tokens, and on its own
+OPENAI_VOCAB = ['a', 'b', 'a</w>', 'b</w>', '</w>', '<', '/', 'w', '>', '</', 'w>', 'b<', '/w>', '.</w>', 'w</w>']
+
+
+@pytest.fixture(scope='module')
+def openai_tokenizer(tmp_path_factory):
+    directory = tmp_path_factory.mktemp('openai')
+    with open(str(directory / 'vocab.json'), 'w', encoding='utf_8') as f:
+        json.dump({token: i for i, token in enumerate(OPENAI_VOCAB)}, f)
+    with open(str(directory / 'merges.txt'), 'w', encoding='utf_8') as f:
+        f.write('#version: 0.2\n')
+    return OpenAIGPTTokenizer(str(directory / 'vocab.json'), str(directory / 'merges.txt'))
+
+
+@pytest.mark.parametrize('tokens', [['a', 'b</w>', 'a</w>'],
+                                    ['</w>', '</w>', 'a', '<', '/', 'w', '>', 'b</w>'],
+                                    ['a', '</', 'w>', 'b<', '/w>', '</w>', '</w>'],
+                                    ['a', 'w', '<', 'w>', 'w</w>', '<', '/', 'w'],
+                                    ['</w>', '<', '/', 'w>'],
+                                    ['a', '.</w>', '</w>', 'b', '<', '/']])
+def test_openai_end_of_words(openai_tokenizer, tokens):
+    ids = openai_tokenizer.convert_tokens_to_ids(tokens)
+    expected = openai_tokenizer.decode(ids, clean_up_tokenization_spaces=False)
+    assert detokenize(openai_tokenizer, ids) == expected
+    check_stream(get_detokenizer(openai_tokenizer), ids, expected)
+
+
+def test_openai_random_ids(openai_tokenizer):
+    rng = random.Random(0)
+    for _ in range(2000):
+        ids = [rng.randrange(len(OPENAI_VOCAB)) for _ in range(rng.randrange(1, 12))]
+        expected = openai_tokenizer.decode(ids, clean_up_tokenization_spaces=False)
+        check_stream(get_detokenizer(openai_tokenizer), ids, expected)
+
+
+def wikitext(symbols):
+    """ The symbols joined by spaces, `<eos>` being a new line, then `WIKITEXT_RULES` over the whole text. """
+    text = ''.join('\n' if symbol == '<eos>' else symbol + ' ' for symbol in symbols)
+    for pattern, replacement in WIKITEXT_RULES:
+        text = text.replace(pattern, replacement)
+    return text
+
+
+@pytest.mark.parametrize('symbols', ['a well @-@ known fact'.split(),
+                                     'from 1 @,@ 000 to 2 @.@ 5 .'.split(),
+                                     'he said : yes , no ; maybe . <eos>'.split(),
+                                     'the dog \'s ( big ) bone'.split(),
+                                     'a @-@ @-@ b , , . ( ) ( c'.split(),
+                                     ', . word <eos> @-@ <eos> ( <eos> ) end'.split(),
+                                     '( @-@ ) \'s : ; @,@ @.@'.split()])
+def test_wikitext_runs(symbols):
+    detokenizer = WikiTextDetokenizer()
+    check_stream(detokenizer, symbols, wikitext(symbols), detokenizer.add_symbol)
+
+
+def test_wikitext_random_symbols():
+    rng = random.Random(0)
+    alphabet = [pattern.strip() for pattern, _ in WIKITEXT_RULES] + ['word', 'other', '<eos>']
+    for _ in range(2000):
+        symbols = [rng.choice(alphabet) for _ in range(rng.randrange(1, 15))]
+        detokenizer = WikiTextDetokenizer()
+        check_stream(detokenizer, symbols, wikitext(symbols), detokenizer.add_symbol)
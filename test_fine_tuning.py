@@ -0,0 +1,92 @@
+# Copyright 2019 - UMONS
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You should have received a copy of the Apache License Version 2.0 along with this program.
+# If not, see
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" bf16 autocast, gradient checkpointing and gradient accumulation give the losses of the fp32 fine-tuning. """
+import os
+import random
+import sys
+
+import pytest
+import torch
+from pytorch_pretrained_bert import OpenAIGPTConfig, OpenAIGPTDoubleHeadsModel
+
+import fine_tuning_openai
+from conftest import TINY
+
+
+@pytest.fixture(scope='module')
+def dataset(tmp_path_factory):
+    random.seed(0)
+    path = str(tmp_path_factory.mktemp('data') / 'lines.txt')
+    with open(path, 'w', encoding='utf_8') as f:
+        for _ in range(64):
+            f.write(' '.join(''.join(random.choice('abcdefgh') for _ in range(random.randint(1, 5)))
+                             for _ in range(random.randint(3, 12))) + '\n')
+    return path
+
+
+def fine_tune(model_dirs, dataset, output_dir, *options):
+    """ Results (eval_results.txt) of an epoch of fine_tuning_openai.py on the tiny random GPT model. """
+    argv = ['fine_tuning_openai.py', '--model_name', model_dirs('openai-gpt'), '--do_train', '--do_eval',
+            '--output_dir', str(output_dir), '--train_dataset', dataset, '--eval_dataset', dataset,
+            '--num_train_epochs', '1', '--num_workers', '1', '--learning_rate', '1e-3'] + list(options)
+    old_argv, sys.argv = sys.argv, argv
+    try:
+        fine_tuning_openai.main()
+    finally:
+        sys.argv = old_argv
+    with open(os.path.join(str(output_dir), 'eval_results.txt')) as f:
+        return {key: float(value) for key, value in (line.split(' = ') for line in f)}
+
+
+@pytest.fixture(scope='module')
+def fp32(model_dirs, dataset, tmp_path_factory):
+    return fine_tune(model_dirs, dataset, tmp_path_factory.mktemp('fp32'), '--train_batch_size', '8')
+
+
+# Batches of 4 without accumulation end 8% away from the batches of 8
+@pytest.mark.parametrize('options, tolerance', [
+    (['--train_batch_size', '8', '--gradient_checkpointing'], 1e-6),
+    (['--train_batch_size', '8', '--bf16'], 1e-3),
+    (['--train_batch_size', '4', '--gradient_accumulation_steps', '2'], 2e-3),
+])
+def test_losses_match_fp32(model_dirs, dataset, tmp_path, fp32, options, tolerance):
+    results = fine_tune(model_dirs, dataset, tmp_path, *options)
+    for key in ('train_loss', 'eval_lm_loss', 'eval_loss'):
+        assert results[key] == pytest.approx(fp32[key], rel=tolerance), key
+
+
+def test_checkpointing_keeps_the_gradients():
+    config = OpenAIGPTConfig(**TINY)
+    torch.manual_seed(0)
+    model = OpenAIGPTDoubleHeadsModel(config)
+    model.set_num_special_tokens(2)
+    model.train()
+    input_ids = torch.randint(TINY['vocab_size_or_config_json_file'], (2, 1, 16))
+    mc_token_ids = torch.full((2, 1), 15, dtype=torch.long)
+    mc_labels = torch.zeros(2, dtype=torch.long)
+
+    def gradients():
+        # Same dropout masks in both runs
+        torch.manual_seed(1)
+        model.zero_grad()
+        losses = model(input_ids, mc_token_ids, input_ids, mc_labels)
+        (0.9 * losses[0] + losses[1]).backward()
+        return [parameter.grad.clone() for parameter in model.parameters()]
+
+    expected = gradients()
+    fine_tuning_openai.enable_gradient_checkpointing(model)
+    for gradient, checkpointed in zip(expected, gradients()):
+        assert torch.equal(gradient, checkpointed)
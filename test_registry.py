@@ -0,0 +1,85 @@
+# Copyright 2019 - UMONS
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You should have received a copy of the Apache License Version 2.0 along with this program.
+# If not, see
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Models are loaded once, without blocking the models already loaded. """
+import threading
+import time
+
+import pytest
+import torch.nn as nn
+
+from registry import ModelRegistry
+
+
+class SlowModel(nn.Module):
+    loads = []
+    delay = 0.
+
+    def __init__(self):
+        super(SlowModel, self).__init__()
+        self.linear = nn.Linear(4, 4)
+
+    @classmethod
+    def from_pretrained(cls, model_name_or_path):
+        cls.loads.append(model_name_or_path)
+        time.sleep(cls.delay)
+        return cls()
+
+
+def test_concurrent_loads_of_a_key_load_once(tmp_path):
+    SlowModel.loads, SlowModel.delay = [], 0.2
+    registry = ModelRegistry()
+    models = []
+    threads = [threading.Thread(target=lambda: models.append(registry.get_model(SlowModel, str(tmp_path))))
+               for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert SlowModel.loads == [str(tmp_path)]
+    assert len(models) == 4 and all(model is models[0] for model in models)
+
+
+def test_loaded_models_are_served_during_a_load(tmp_path):
+    SlowModel.loads, SlowModel.delay = [], 0.
+    registry = ModelRegistry()
+    loaded = registry.get_model(SlowModel, str(tmp_path / 'a'))
+    SlowModel.delay = 1.
+    thread = threading.Thread(target=registry.get_model, args=(SlowModel, str(tmp_path / 'b')))
+    thread.start()
+    time.sleep(0.1)
+    start = time.perf_counter()
+    assert registry.get_model(SlowModel, str(tmp_path / 'a')) is loaded
+    assert time.perf_counter() - start < 0.5
+    thread.join()
+    assert SlowModel.loads == [str(tmp_path / 'a'), str(tmp_path / 'b')]
+
+
+def test_failed_load_is_retried(tmp_path):
+    class FailingModel(SlowModel):
+        failures = 1
+
+        @classmethod
+        def from_pretrained(cls, model_name_or_path):
+            if cls.failures:
+                cls.failures -= 1
+                raise OSError("Can't load")
+            return cls()
+
+    registry = ModelRegistry()
+    with pytest.raises(OSError):
+        registry.get_model(FailingModel, str(tmp_path))
+    assert isinstance(registry.get_model(FailingModel, str(tmp_path)), FailingModel)
+    assert not registry.loading
@@ -0,0 +1,139 @@
+# Copyright 2019 - UMONS
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You should have received a copy of the Apache License Version 2.0 along with this program.
+# If not, see
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" The generation server on the tiny random models of benchmark.py, over a local socket. """
+import asyncio
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from server import BertBackend, GPT2Backend, GenerationServer, OpenAIGPTBackend, TransfoXLBackend
+
+
+class FailingBackend(GPT2Backend):
+    """ Fails after its first piece of text. """
+
+    def stream(self, request, args):
+        yield 'first'
+        raise RuntimeError("Decoding failed")
+
+
+@pytest.fixture(scope='module')
+def backends(model_dirs):
+    backends = {'gpt2': GPT2Backend(model_dirs('gpt2')), 'openai-gpt': OpenAIGPTBackend(model_dirs('openai-gpt')),
+                'transfo-xl': TransfoXLBackend(model_dirs('transfo-xl')), 'bert': BertBackend(model_dirs('bert')),
+                'failing': FailingBackend(model_dirs('gpt2'))}
+    for backend in backends.values():
+        backend.load()
+    return backends
+
+
+def call(backends, method, path, body=None):
+    """ (status, headers and body) of the answer of a fresh server to one request. """
+    async def run():
+        server = GenerationServer(backends)
+        listener = await asyncio.start_server(server.handle, '127.0.0.1', 0)
+        port = listener.sockets[0].getsockname()[1]
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            data = json.dumps(body).encode('utf_8') if body is not None else b''
+            writer.write(('%s %s HTTP/1.1\r\nContent-Length: %d\r\n\r\n' % (method, path, len(data))).encode()
+                         + data)
+            answer = (await reader.read()).decode('utf_8')
+            writer.close()
+            return answer
+        finally:
+            listener.close()
+            await listener.wait_closed()
+
+    answer = asyncio.run(run())
+    return int(answer.split(' ', 2)[1]), answer
+
+
+def json_body(answer):
+    return json.loads(answer.split('\r\n\r\n', 1)[1])
+
+
+@pytest.mark.parametrize('model', ['gpt2', 'openai-gpt'])
+def test_generate(backends, model):
+    status, answer = call(backends, 'POST', '/generate', {'model': model, 'text': 'hello', 'tokens_to_generate': 5})
+    assert status == 200
+    assert json_body(answer)['model'] == model
+
+
+def test_bert_suggestions(backends):
+    word = backends['bert'].tokenizer.ids_to_tokens[10]
+    status, answer = call(backends, 'POST', '/generate', {'model': 'bert', 'text': 'ax %s bx' % word, 'mask': word,
+                                                          'n_options': 3})
+    assert status == 200
+    assert len(json_body(answer)['tokens']) == 4
+
+
+def test_stream(backends):
+    status, answer = call(backends, 'POST', '/stream', {'model': 'gpt2', 'text': 'hello', 'tokens_to_generate': 5})
+    assert status == 200
+    assert answer.count('HTTP/1.1') == 1
+    assert answer.endswith('data: [DONE]\n\n')
+
+
+@pytest.mark.parametrize('path', ['/generate', '/stream'])
+@pytest.mark.parametrize('body', [
+    {'model': 'gpt2', 'text': 'hello', 'tokens_to_generate': 'many'},
+    {'model': 'gpt2', 'text': 'hello', 'tokens_to_generate': 0},
+    {'model': 'gpt2', 'text': 'hello', 'tokens_to_generate': -3},
+    {'model': 'gpt2', 'text': 'hello', 'tokens_to_generate': 2.5},
+    {'model': 'gpt2', 'text': 'hello', 'tokens_to_generate': True},
+    {'model': 'gpt2', 'text': 'hello', 'timeout': 'soon'},
+    {'model': 'gpt2', 'text': 'hello', 'timeout': 0},
+    {'model': 'gpt2', 'text': 'a' * 120, 'tokens_to_generate': 20},
+    {'model': 'openai-gpt', 'text': 'hello', 'tokens_to_generate': 200},
+    {'model': 'transfo-xl', 'text': 'hello', 'select_from_k': 0},
+    {'model': 'transfo-xl', 'text': 'hello', 'tokens_to_generate': None},
+    {'model': 'bert', 'text': 'hello'},
+    {'model': 'bert', 'text': 'ax bx', 'mask': 'cx'},
+    {'model': 'gpt2', 'text': ''},
+])
+def test_bad_requests(backends, path, body):
+    status, answer = call(backends, 'POST', path, body)
+    assert status == 400, answer
+    assert 'error' in json_body(answer)
+
+
+def test_unknown_model(backends):
+    assert call(backends, 'POST', '/generate', {'model': 'gpt3', 'text': 'hello'})[0] == 404
+
+
+def test_stream_error_after_headers(backends):
+    status, answer = call(backends, 'POST', '/stream', {'model': 'failing', 'text': 'hello'})
+    assert status == 200
+    assert answer.count('HTTP/1.1') == 1
+    assert answer.endswith('event: error\ndata: {"error": "Decoding failed"}\n\n')
+
+
+def test_generate_error(backends):
+    status, answer = call(backends, 'POST', '/generate', {'model': 'failing', 'text': 'hello'})
+    assert status == 500
+    assert json_body(answer) == {'error': "Decoding failed"}
+
+
+def test_models_imported_on_load():
+    # The server and the generators it runs, or that run on their own
+    code = ("import sys, server, gpt2, openai, transformer_xl, bert, batching, openai_huggingface_example; "
+            "print('pytorch_pretrained_bert' in sys.modules)")
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)))
+    assert output.strip() == b'False'
@@ -0,0 +1,156 @@
+# Copyright 2019 - UMONS
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You should have received a copy of the Apache License Version 2.0 along with this program.
+# If not, see
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Chat sessions on the tiny random GPT-2 of benchmark.py, and the store keeping them. """
+import random
+import threading
+import time
+
+import pytest
+import torch
+from pytorch_pretrained_bert import GPT2LMHeadModel
+
+from decoding import decode
+from session import ChatSession, SessionBusyError, SessionStore
+
+
+@pytest.fixture(scope='module')
+def model(model_dirs):
+    return GPT2LMHeadModel.from_pretrained(model_dirs('gpt2')).eval()
+
+
+def turn(session, token_ids, tokens_to_generate):
+    return [token.item() for token in session.generate(token_ids, tokens_to_generate)]
+
+
+def test_turns_continue_the_conversation(model):
+    session = ChatSession(model)
+    conversation = [5, 6, 7]
+    generated = turn(session, conversation, 4)
+    assert generated == decode(model, conversation, 4).tolist()
+    conversation += generated + [8, 9]
+    generated = turn(session, [8, 9], 5)
+    assert generated == decode(model, conversation, 5).tolist()
+    assert session.tokens == conversation + generated
+    assert session.stats()['slides'] == 0
+
+
+@pytest.mark.parametrize('keep_tokens', [0, 10, 100])
+def test_slide(model, keep_tokens):
+    n_ctx = model.config.n_ctx
+    session = ChatSession(model, keep_tokens)
+    rng = random.Random(0)
+    conversation = []
+    while session.slides < 3:
+        token_ids = [rng.randrange(model.config.vocab_size) for _ in range(rng.randrange(1, 40))]
+        conversation += token_ids + turn(session, token_ids, rng.randrange(1, 20))
+        assert session.length <= n_ctx
+        # The window is the end of the conversation
+        assert session.tokens == conversation[len(conversation) - session.length:]
+    assert session.stats()['tokens'] == len(conversation)
+
+    # After a slide, the cache is rebuilt from the window: the next token is that of a fresh pass over it
+    window = session.tokens
+    with torch.no_grad():
+        expected = model(torch.tensor([window]))[0][0, -1].argmax().item()
+    assert turn(session, [], 1) == [expected]
+
+
+def test_slide_during_generation(model):
+    session = ChatSession(model, keep_tokens=16)
+    prompt = list(range(100, 100 + model.config.n_ctx - 2))
+    generated = turn(session, prompt, 6)
+    assert session.slides == 1
+    conversation = prompt + generated
+    # The tokens after the slide follow the 16 kept tokens and those generated since
+    window = conversation[-session.length:]
+    assert session.tokens == window
+    assert turn(session, [], 3) == decode(model, window, 3).tolist()
+
+
+def test_long_turn_is_cut(model):
+    session = ChatSession(model, keep_tokens=8)
+    prompt = list(range(model.config.n_ctx + 30))
+    generated = turn(session, prompt, 2)
+    assert len(generated) == 2
+    assert session.tokens == (prompt + generated)[-session.length:]
+
+
+def test_busy(model):
+    session = ChatSession(model)
+    first = session.generate([1, 2, 3], 10)
+    next(first)
+    with pytest.raises(SessionBusyError):
+        next(session.generate([4], 2))
+    first.close()
+    assert len(turn(session, [4], 2)) == 2
+
+
+def test_concurrent_turns(model):
+    session = ChatSession(model)
+    turn(session, [1, 2, 3], 1)
+    barrier = threading.Barrier(4)
+    outcomes = []
+
+    def run():
+        barrier.wait()
+        try:
+            outcomes.append(len(turn(session, [4, 5], 20)))
+        except SessionBusyError:
+            outcomes.append('busy')
+    threads = [threading.Thread(target=run) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # Turns that overlap are rejected, never interleaved
+    assert 20 in outcomes and set(outcomes) <= {20, 'busy'}
+    assert session.stats()['tokens'] == 4 + 22 * outcomes.count(20)
+
+
+def test_invalid(model):
+    with pytest.raises(ValueError):
+        ChatSession(model, keep_tokens=model.config.n_ctx)
+    with pytest.raises(ValueError):
+        turn(ChatSession(model), [], 3)
+
+
+def test_store_lru():
+    made = []
+
+    def factory(name):
+        return lambda: made.append(name) or name
+    store = SessionStore(max_sessions=2)
+    assert store.get('a', factory('a')) == 'a'
+    assert store.get('b', factory('b')) == 'b'
+    assert store.get('a', factory('a2')) == 'a'
+    # b is the least recently used one
+    assert store.get('c', factory('c')) == 'c'
+    assert store.get('b', factory('b2')) == 'b2'
+    assert made == ['a', 'b', 'c', 'b2']
+    assert store.stats() == {'sessions': 2, 'created': 4, 'expired': 0, 'evictions': 2}
+    assert store.remove('c') and not store.remove('c')
+
+
+def test_store_expiry():
+    store = SessionStore(idle_timeout=0.1)
+    store.get('a', lambda: 'a')
+    time.sleep(0.05)
+    store.get('b', lambda: 'b')
+    time.sleep(0.07)
+    assert store.stats()['sessions'] == 1
+    assert store.get('b', lambda: 'b2') == 'b'
+    assert store.get('a', lambda: 'a2') == 'a2'
+    assert store.stats()['expired'] == 1
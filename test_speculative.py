@@ -0,0 +1,67 @@
+# Copyright 2019 - UMONS
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You should have received a copy of the Apache License Version 2.0 along with this program.
+# If not, see
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Speculative decoding gives the greedy output, on the tiny random models of conftest.py. """
+import random
+
+import pytest
+import torch
+from pytorch_pretrained_bert import GPT2Config, GPT2LMHeadModel
+
+from conftest import TINY
+from decoding import decode
+from speculative import ModelDrafter, NGramDrafter, speculative_decode
+
+
+def contexts():
+    rng = random.Random(0)
+    # Random, and repetitive so that the n-grams find drafts
+    yield [rng.randrange(TINY['vocab_size_or_config_json_file']) for _ in range(12)]
+    yield [7, 8, 9, 10] * 4
+    yield [3]
+
+
+@pytest.fixture
+def draft_model():
+    torch.manual_seed(1)
+    return GPT2LMHeadModel(GPT2Config(**dict(TINY, n_layer=1))).eval()
+
+
+@pytest.mark.parametrize('num_draft_tokens', [0, 1, 3, 6])
+def test_ngram_drafter(tiny_gpt2, num_draft_tokens):
+    for context in contexts():
+        tokens, stats = speculative_decode(tiny_gpt2, context, 30, NGramDrafter(3), num_draft_tokens)
+        assert tokens == decode(tiny_gpt2, context, 30).tolist()
+        assert stats['accepted_tokens'] <= stats['drafted_tokens'] <= num_draft_tokens * stats['forward_passes']
+
+
+@pytest.mark.parametrize('num_draft_tokens', [1, 3, 6])
+def test_model_drafter(tiny_gpt2, draft_model, num_draft_tokens):
+    for context in contexts():
+        tokens, _ = speculative_decode(tiny_gpt2, context, 30, ModelDrafter(draft_model), num_draft_tokens)
+        assert tokens == decode(tiny_gpt2, context, 30).tolist()
+
+
+def test_model_as_its_own_drafter(tiny_gpt2):
+    # Every draft is accepted
+    context = list(contexts())[0]
+    tokens, stats = speculative_decode(tiny_gpt2, context, 30, ModelDrafter(tiny_gpt2), 4)
+    assert tokens == decode(tiny_gpt2, context, 30).tolist()
+    assert stats['acceptance_rate'] == 1 and stats['forward_passes'] < 30
+
+
+def test_window(tiny_gpt2):
+    with pytest.raises(ValueError):
+        speculative_decode(tiny_gpt2, [1] * 40, TINY['n_positions'] - 39)
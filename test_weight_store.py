@@ -0,0 +1,103 @@
+# Copyright 2019 - UMONS
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You should have received a copy of the Apache License Version 2.0 along with this program.
+# If not, see
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Weight stores of the tiny random models of benchmark.py, and the weight initialization of everything else. """
+import threading
+
+import pytest
+import torch
+import torch.nn as nn
+from pytorch_pretrained_bert import BertForMaskedLM, GPT2LMHeadModel, OpenAIGPTLMHeadModel
+
+from registry import ModelRegistry
+from weight_store import _skip_init, load_weight_store, save_weight_store
+
+MODELS = {'gpt2': GPT2LMHeadModel, 'openai-gpt': OpenAIGPTLMHeadModel, 'bert': BertForMaskedLM}
+
+
+@pytest.fixture(scope='module')
+def stores(model_dirs, tmp_path_factory):
+    """ `stores(kind)`: weight store directory of the tiny `kind` model. """
+    directories = {}
+
+    def store(kind):
+        if kind not in directories:
+            directories[kind] = str(tmp_path_factory.mktemp(kind))
+            save_weight_store(MODELS[kind].from_pretrained(model_dirs(kind)), directories[kind])
+        return directories[kind]
+    return store
+
+
+def linear_weight():
+    """ Seeded weights of a new layer: the same as long as the layers are initialized. """
+    torch.manual_seed(0)
+    return nn.Linear(8, 8).weight.detach().clone()
+
+
+@pytest.mark.parametrize('kind', sorted(MODELS))
+def test_same_logits(model_dirs, stores, kind):
+    initialized = linear_weight()
+    expected_model = MODELS[kind].from_pretrained(model_dirs(kind)).eval()
+    model = load_weight_store(MODELS[kind], stores(kind)).eval()
+    input_ids = torch.tensor([[3, 1, 4, 1, 5, 9, 2, 6]])
+    with torch.no_grad():
+        expected, logits = expected_model(input_ids), model(input_ids)
+    expected, logits = (expected[0], logits[0]) if isinstance(expected, tuple) else (expected, logits)
+    assert torch.equal(logits, expected)
+    assert torch.equal(linear_weight(), initialized)
+
+
+def test_overlapping_blocks():
+    expected = linear_weight()
+    first, second = _skip_init(GPT2LMHeadModel), _skip_init(BertForMaskedLM)
+    first.__enter__()
+    second.__enter__()
+    first.__exit__(None, None, None)
+    second.__exit__(None, None, None)
+    assert torch.equal(linear_weight(), expected)
+
+
+def test_other_threads_initialize():
+    expected = linear_weight()
+    weights = []
+    with _skip_init(GPT2LMHeadModel):
+        thread = threading.Thread(target=lambda: weights.append(linear_weight()))
+        thread.start()
+        thread.join()
+    assert torch.equal(weights[0], expected)
+
+
+def test_concurrent_loads(stores):
+    directories = {kind: stores(kind) for kind in MODELS}
+    expected = linear_weight()
+    for _ in range(5):
+        registry = ModelRegistry()
+        barrier = threading.Barrier(len(MODELS))
+        errors = []
+
+        def load(kind):
+            try:
+                barrier.wait()
+                registry.get_model(MODELS[kind], directories[kind])
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=load, args=(kind,)) for kind in MODELS]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert not errors
+        assert len(registry.models) == len(MODELS)
+        assert torch.equal(linear_weight(), expected)
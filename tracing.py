@@ -0,0 +1,158 @@
+# Copyright 2019 - UMONS
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You should have received a copy of the Apache License Version 2.0 along with this program.
+# If not, see
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Per-step instrumentation of the generation loops.
+
+    The loops take an optional `tracer`, wrap each phase of a step (`forward`, `sample`, `transfer`,
+    `prefill`...) in `tracer.span(name)` and call `tracer.step(batch_size, sequence_length)` once the step is done.
+    The tracer then hands a record of the step to its callbacks:
+        {'step': 3, 'batch_size': 1, 'sequence_length': 12, 'time': 0.0021,
+         'phases': {'forward': 0.0017, 'sample': 0.0001, ...}, 'rss_mb': 512.3}
+    with `cuda_allocated_mb` and `cuda_max_allocated_mb` as well on GPU.
+
+    Without a tracer the loops use `NULL_TRACER`, whose span is a shared no-op context manager, so the disabled
+    instrumentation costs a method call per phase. `ChromeTrace` writes the steps as a trace for chrome://tracing
+    or Perfetto, and `ProfilerTracer` labels the phases in a `torch.profiler` profile.
+"""
+import contextlib
+import json
+import os
+import time
+
+import torch
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def memory_counters():
+    """ Current resident memory of the process and, on GPU, the memory allocated by PyTorch, in MB. """
+    counters = {}
+    try:
+        with open('/proc/self/statm') as f:
+            counters['rss_mb'] = int(f.read().split()[1]) * _PAGE_SIZE / 2 ** 20
+    except (OSError, IndexError, ValueError):
+        pass
+    if torch.cuda.is_available():
+        counters['cuda_allocated_mb'] = torch.cuda.memory_allocated() / 2 ** 20
+        counters['cuda_max_allocated_mb'] = torch.cuda.max_memory_allocated() / 2 ** 20
+    return counters
+
+
+class Tracer(object):
+    """ Times the phases of every generation step and passes a record of each step to `callbacks`.
+
+        With `synchronize`, CUDA is synchronized around every phase so that GPU time is attributed to the phase
+        that queued the work, at the cost of the overlap between host and device.
+    """
+
+    def __init__(self, callbacks=(), synchronize=True):
+        self.callbacks = list(callbacks)
+        self.synchronize = synchronize and torch.cuda.is_available()
+        self.step_index = 0
+        self.phases = {}
+        self.step_start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def span(self, name):
+        if self.synchronize:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.synchronize:
+                torch.cuda.synchronize()
+            self.on_span(name, start, time.perf_counter())
+
+    def on_span(self, name, start, end):
+        self.phases[name] = self.phases.get(name, 0.) + end - start
+
+    def step(self, batch_size, sequence_length):
+        """ End the current step, `sequence_length` being the number of tokens each row has seen. """
+        end = time.perf_counter()
+        record = {'step': self.step_index, 'batch_size': batch_size, 'sequence_length': sequence_length,
+                  'time': end - self.step_start, 'phases': self.phases}
+        record.update(memory_counters())
+        self.on_step(record, self.step_start, end)
+        for callback in self.callbacks:
+            callback(record)
+        self.step_index += 1
+        self.phases = {}
+        self.step_start = time.perf_counter()
+
+    def on_step(self, record, start, end):
+        pass
+
+
+class _NullTracer(object):
+    """ Tracer doing nothing, used when the instrumentation is disabled. """
+    _span = contextlib.nullcontext()
+
+    def span(self, name):
+        return self._span
+
+    def step(self, batch_size, sequence_length):
+        pass
+
+
+NULL_TRACER = _NullTracer()
+
+
+class ChromeTrace(Tracer):
+    """ Tracer recording the steps and their phases in the Chrome trace event format, written by `save`. """
+
+    def __init__(self, callbacks=(), synchronize=True):
+        super(ChromeTrace, self).__init__(callbacks, synchronize)
+        self.events = []
+        self.origin = time.perf_counter()
+        self.pid = os.getpid()
+
+    def _us(self, t):
+        return (t - self.origin) * 1e6
+
+    def on_span(self, name, start, end):
+        super(ChromeTrace, self).on_span(name, start, end)
+        self.events.append({'name': name, 'ph': 'X', 'ts': self._us(start), 'dur': (end - start) * 1e6,
+                            'pid': self.pid, 'tid': 1})
+
+    def on_step(self, record, start, end):
+        self.events.append({'name': 'step', 'ph': 'X', 'ts': self._us(start), 'dur': (end - start) * 1e6,
+                            'pid': self.pid, 'tid': 0,
+                            'args': {key: record[key] for key in ('step', 'batch_size', 'sequence_length')}})
+        counters = {key: value for key, value in record.items() if key.endswith('_mb')}
+        if counters:
+            self.events.append({'name': 'memory', 'ph': 'C', 'ts': self._us(end), 'pid': self.pid,
+                                'args': counters})
+
+    def save(self, path):
+        with open(path, 'w', encoding='utf_8') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+
+
+class ProfilerTracer(Tracer):
+    """ Tracer labelling every phase with `torch.profiler.record_function`, and stepping `profiler` if given. """
+
+    def __init__(self, profiler=None, callbacks=(), synchronize=False):
+        super(ProfilerTracer, self).__init__(callbacks, synchronize)
+        self.profiler = profiler
+
+    @contextlib.contextmanager
+    def span(self, name):
+        with torch.profiler.record_function(name), super(ProfilerTracer, self).span(name):
+            yield
+
+    def on_step(self, record, start, end):
+        if self.profiler is not None:
+            self.profiler.step()
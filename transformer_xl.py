@@ -17,53 +17,66 @@
 
 import torch
 import argparse
-from pytorch_pretrained_bert import TransfoXLTokenizer, TransfoXLLMHeadModel
 import logging
 
-logging.basicConfig(level=logging.INFO)
+from beam_search import beam_search
+from decoding import select_past
+from detokenizer import WikiTextDetokenizer
+from registry import get_model, get_tokenizer
+from sampling import LogitsSampler
+from tracing import NULL_TRACER
 
 
 def main():
+    logging.basicConfig(level=logging.INFO)
+
     parser = argparse.ArgumentParser()
     parser.add_argument('--model_name_or_path', type=str, default='transfo-xl-wt103',
                         help='pretrained model name or path to local checkpoint')
-    parser.add_argument("--text", type=str, default="Traditional Chinese literary",
-                        help='The sentence used to initiate generation.')
+    parser.add_argument("--text", type=str, nargs='+', default=["Traditional Chinese literary"],
+                        help='The sentences used to initiate generation, generated together in one batch.')
     parser.add_argument("--tokens_to_generate", type=int, default="40",
-                        help='Number of tokens to generate after the end of the sentence.')
+                        help='Number of tokens to generate after the end of the sentence, -1 to never stop '
+                             '(with --stream).')
     parser.add_argument("--select_from_k", type=int, default="40",
                         help='From how many top tokens at each iteration, random selection will be made')
+    parser.add_argument("--temperature", type=float, default=1.)
+    parser.add_argument("--top_p", type=float, default=1.,
+                        help='Nucleus sampling: only sample from the most likely tokens whose cumulated '
+                             'probability reaches top_p.')
+    parser.add_argument("--repetition_penalty", type=float, default=1.,
+                        help='Penalty (> 1) of the tokens already in the memory.')
+    parser.add_argument("--mem_len", type=int, default=None,
+                        help="Number of hidden states kept in memory, defaults to the model's mem_len.")
+    parser.add_argument('--stream', action='store_true', help='Print the tokens as they are generated.')
+    parser.add_argument("--num_beams", type=int, default=1, help='Beam search with this many beams if above 1.')
+    parser.add_argument("--length_penalty", type=float, default=1.,
+                        help='Exponent of the length dividing the beam scores, above 0 favours long hypotheses.')
+    parser.add_argument("--no_repeat_ngram_size", type=int, default=0,
+                        help='Forbid the beams to repeat n-grams of this size.')
     args = parser.parse_args()
 
-    transformer_xl_generation(args.model_name_or_path, args.text, args.tokens_to_generate, args.select_from_k)
+    if args.tokens_to_generate < 0:
+        if not args.stream:
+            parser.error("--tokens_to_generate -1 needs --stream")
+        args.tokens_to_generate = None
+    if args.num_beams > 1 and args.stream:
+        parser.error("--num_beams can't be used with --stream")
+
+    transformer_xl_generation(args.model_name_or_path, args.text, args.tokens_to_generate, args.select_from_k,
+                              args.mem_len, args.stream, temperature=args.temperature, top_p=args.top_p,
+                              repetition_penalty=args.repetition_penalty, num_beams=args.num_beams,
+                              length_penalty=args.length_penalty, no_repeat_ngram_size=args.no_repeat_ngram_size)
 
 
 def format_text(tokens):
-    line = ''
-    for token in tokens:
-        if token == '<eos>':
-            line += '\n'
-        else:
-            line += token
-            line += ' '
-
-    # simple rules of detokenization
-    line = line.replace(' @-@ ', '-')
-    line = line.replace(' @,@ ', ',')
-    line = line.replace(' @.@ ', '.')
-    line = line.replace(' . ', '. ')
-    line = line.replace(' , ', ', ')
-    line = line.replace(' : ', ': ')
-    line = line.replace(' ; ', '; ')
-    line = line.replace(" 's ", "'s ")
-    line = line.replace(' ( ', ' (')
-    line = line.replace(' ) ', ') ')
-
-    return line
-
-
-def transformer_xl_generation(model_name_or_path, text, tokens_to_generate, select_from_k):
-    tokenizer = TransfoXLTokenizer.from_pretrained(model_name_or_path)
+    """ Text of the symbols `tokens`, with the WikiText detokenization rules (see detokenizer.py). """
+    detokenizer = WikiTextDetokenizer()
+    return ''.join([detokenizer.add_symbol(token) for token in tokens]) + detokenizer.flush()
+
+
+def encode_context(tokenizer, text):
+    """ Token ids of `text`, with an `<eos>` symbol at the end of each line. """
     sentences = text.split("\n")
     lines = [s.strip().split() + ['<eos>'] for s in sentences]
 
@@ -73,40 +86,161 @@ def transformer_xl_generation(model_name_or_path, text, tokens_to_generate, sele
         context += lines[idx]
         idx += 1
 
-    ctx_tensor = torch.tensor([tokenizer.convert_tokens_to_ids(context)])
-
-    model = TransfoXLLMHeadModel.from_pretrained('transfo-xl-wt103')
-    model.eval()
-
-    ctx_tensor = ctx_tensor.to('cuda')
-    model.to('cuda')
-
-    unk_id = tokenizer.convert_tokens_to_ids(['<unk>'])[0]
-
+    return tokenizer.convert_tokens_to_ids(context)
+
+
+def _check_mem_len(model, mem_len):
+    """ `mem_len`, or the model's own one if None. """
+    if mem_len is None:
+        return model.transformer.mem_len
+    if not 0 < mem_len <= model.transformer.mem_len:
+        raise ValueError("mem_len should be between 1 and the model's mem_len (%d)" % model.transformer.mem_len)
+    return mem_len
+
+
+def transformer_xl_forward(model, tensor, mems, mem_len):
+    """ Log-probabilities of the token after `tensor` (batch, length), and the memories cut to `mem_len` states. """
+    hidden, mems = model.transformer(tensor, mems)
+    return model.crit(hidden[:, -1], None), [mem[-mem_len:] for mem in mems]
+
+
+def transformer_xl_prime(model, ctx_tensors, mem_len, tracer=NULL_TRACER):
+    """ Log-probabilities after each of the 1-D context id tensors `ctx_tensors` and their memories, in one batch.
+
+        Every row keeps exactly `mem_len` hidden states per layer. Since all the rows then have the same memory
+        length, prompts of different lengths are primed one by one from an empty memory.
+    """
+    param = next(model.parameters())
+    log_probs, batch_mems = [], []
+    for ctx_tensor in ctx_tensors:
+        # Same zero memory as `init_mems`, at the requested length
+        mems = [param.new_zeros(mem_len, 1, model.config.d_model) for _ in range(model.transformer.n_layer)]
+        with tracer.span('transfer'):
+            ctx_tensor = ctx_tensor.view(1, -1).to(param.device)
+        with tracer.span('forward'):
+            log_prob, mems = transformer_xl_forward(model, ctx_tensor, mems, mem_len)
+        log_probs.append(log_prob)
+        batch_mems.append(mems)
+    return torch.cat(log_probs), [torch.cat(layer_mems, dim=1) for layer_mems in zip(*batch_mems)]
+
+
+def transformer_xl_steps(model, ctx_tensors, tokens_to_generate, select_from_k, unk_id, mem_len=None,
+                         tracer=None, sampler=None):
+    """ Sample after each of the 1-D context id tensors `ctx_tensors`, yielding a LongTensor (batch,) per step.
+
+        Generation goes on forever if `tokens_to_generate` is None. Every row keeps exactly `mem_len` hidden
+        states per layer (the model's own `mem_len` by default, never more), so memory stays flat however many
+        tokens are produced. The prompts are primed one by one and then sampled together in one batch. `tracer`
+        (see tracing.py) receives the timings of the phases of every step. `sampler` (see sampling.py) defaults to
+        top-`select_from_k` sampling without `<unk>`, its repetition penalty applies to the last `mem_len` tokens.
+    """
+    tracer = tracer or NULL_TRACER
+    sampler = sampler or LogitsSampler(top_k=select_from_k, banned_tokens=[unk_id])
+    mem_len = _check_mem_len(model, mem_len)
+
+    # Not around the loop: grad mode is per thread and the server resumes the steps on any thread of its pool
     with torch.no_grad():
-        tensor = ctx_tensor
-        generation = []
-        for i in range(tokens_to_generate):
-            if i == 0:
-                log_prob, mems = model(tensor)
-            else:
-                log_prob, mems = model(tensor, mems=mems)
+        log_prob, mems = transformer_xl_prime(model, ctx_tensors, mem_len, tracer)
+
+    context_length = max(ctx_tensor.numel() for ctx_tensor in ctx_tensors)
+    window = None
+    if sampler.repetition_penalty != 1:
+        # Last `mem_len` tokens of every row, right aligned and padded with <unk>
+        window = log_prob.new_full((len(ctx_tensors), mem_len), unk_id, dtype=torch.long)
+        for row, ctx_tensor in zip(window, ctx_tensors):
+            ctx_tensor = ctx_tensor[-mem_len:]
+            row[mem_len - ctx_tensor.numel():] = ctx_tensor
+
+    i = 0
+    while tokens_to_generate is None or i < tokens_to_generate:
+        with tracer.span('sample'):
+            token = sampler(log_prob, window)
+            if window is not None:
+                window = torch.cat((window[:, 1:], token), dim=1)
+
+        tracer.step(token.size(0), context_length + i)
+        yield token.view(-1)
+        i += 1
+        if i != tokens_to_generate:
+            with tracer.span('forward'), torch.no_grad():
+                log_prob, mems = transformer_xl_forward(model, token, mems, mem_len)
+
+
+def transformer_xl_beam_search(model, ctx_tensors, tokens_to_generate, unk_id, num_beams=4, length_penalty=1.,
+                               no_repeat_ngram_size=0, eos_token_id=None, mem_len=None, tracer=None):
+    """ Beam search after each of the 1-D context id tensors `ctx_tensors`, see beam_search.py.
+
+        Returns a list of (token ids, score), best first, per context. `<unk>` is never generated.
+    """
+    mem_len = _check_mem_len(model, mem_len)
+    tracer = tracer or NULL_TRACER
+
+    def advance(tokens, mems):
+        log_probs, mems = transformer_xl_forward(model, tokens, mems, mem_len)
+        log_probs[:, unk_id] = -float('inf')
+        return log_probs, mems
 
-            prob = torch.exp(log_prob[0, -1, :])
-            prob[unk_id].data.fill_(0.)
-
-            # sample from the top-k tokens
-            top_prob, top_index = torch.topk(prob, select_from_k)
-            token = torch.multinomial(top_prob, 1)
-            token = top_index[token]
+    with torch.no_grad():
+        log_probs, mems = transformer_xl_prime(model, ctx_tensors, mem_len, tracer)
+        log_probs[:, unk_id] = -float('inf')
+        beams = torch.arange(len(ctx_tensors), device=log_probs.device).repeat_interleave(num_beams)
+        return beam_search(advance, select_past, log_probs.index_select(0, beams), select_past(mems, beams),
+                           [ctx_tensor.tolist() for ctx_tensor in ctx_tensors], tokens_to_generate, num_beams,
+                           length_penalty, no_repeat_ngram_size, eos_token_id, tracer=tracer)
 
-            tensor = token.detach().view(1, 1)
 
-            symbol = tokenizer.get_sym(token.item())
+def transformer_xl_tokens(model, tokenizer, ctx_tensor, tokens_to_generate, select_from_k, mem_len=None,
+                          sampler=None):
+    """ Sample `tokens_to_generate` symbols after the context ids `ctx_tensor`, yielding them one at a time. """
+    unk_id = tokenizer.convert_tokens_to_ids(['<unk>'])[0]
+    for token in transformer_xl_steps(model, [ctx_tensor.view(-1)], tokens_to_generate, select_from_k, unk_id,
+                                      mem_len, sampler=sampler):
+        yield tokenizer.get_sym(token.item())
 
-            generation.append(symbol)
 
-    print(format_text(generation))
+def transformer_xl_batch(model, tokenizer, texts, tokens_to_generate, select_from_k, mem_len=None, sampler=None):
+    """ Sample `tokens_to_generate` symbols after each of `texts` in one batch, returns a list of symbols per text. """
+    unk_id = tokenizer.convert_tokens_to_ids(['<unk>'])[0]
+    ctx_tensors = [torch.tensor(encode_context(tokenizer, text)) for text in texts]
+    output = torch.empty((len(texts), tokens_to_generate), dtype=torch.long, device=next(model.parameters()).device)
+    for i, token in enumerate(transformer_xl_steps(model, ctx_tensors, tokens_to_generate, select_from_k, unk_id,
+                                                   mem_len, sampler=sampler)):
+        output[:, i] = token
+    return [[tokenizer.get_sym(idx) for idx in row] for row in output.tolist()]
+
+
+def transformer_xl_generation(model_name_or_path, text, tokens_to_generate, select_from_k, mem_len=None,
+                              stream=False, temperature=1., top_p=1., repetition_penalty=1., num_beams=1,
+                              length_penalty=1., no_repeat_ngram_size=0):
+    from pytorch_pretrained_bert import TransfoXLLMHeadModel, TransfoXLTokenizer
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    tokenizer = get_tokenizer(TransfoXLTokenizer, model_name_or_path)
+    model = get_model(TransfoXLLMHeadModel, model_name_or_path, device=device)
+    unk_id = tokenizer.convert_tokens_to_ids(['<unk>'])[0]
+    sampler = LogitsSampler(temperature, select_from_k, top_p, repetition_penalty, banned_tokens=[unk_id])
+
+    texts = [text] if isinstance(text, str) else text
+    if stream:
+        # Print the symbols as they come, nothing is kept so this can run forever
+        for t in texts:
+            ctx_tensor = torch.tensor([encode_context(tokenizer, t)])
+            detokenizer = WikiTextDetokenizer()
+            for symbol in transformer_xl_tokens(model, tokenizer, ctx_tensor, tokens_to_generate, select_from_k,
+                                                mem_len, sampler):
+                print(detokenizer.add_symbol(symbol), end='', flush=True)
+            print(detokenizer.flush())
+        return
+
+    if num_beams > 1:
+        ctx_tensors = [torch.tensor(encode_context(tokenizer, t)) for t in texts]
+        for hypotheses in transformer_xl_beam_search(model, ctx_tensors, tokens_to_generate, unk_id, num_beams,
+                                                     length_penalty, no_repeat_ngram_size, mem_len=mem_len):
+            print(format_text(tokenizer.convert_ids_to_tokens(hypotheses[0][0])))
+        return
+
+    for generation in transformer_xl_batch(model, tokenizer, texts, tokens_to_generate, select_from_k, mem_len,
+                                           sampler):
+        print(format_text(generation))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,193 @@
+# Copyright 2019 - UMONS
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You should have received a copy of the Apache License Version 2.0 along with this program.
+# If not, see
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Memory-mapped weight store of the GPT, GPT-2, BERT and Transformer-XL models.
+
+    The tensors of the state dict are written back to back, uncompressed, in `weights.bin`, and `weights.json`
+    gives the name, dtype, shape and offset of each one (tied weights are written once). Loading maps the file
+    copy-on-write and makes every parameter a view of it: nothing is read or copied until a layer is first used,
+    and the pages are those of the OS page cache, so all the processes of a node that load the same store share a
+    single physical copy of the weights. The module tree is built without initializing its weights, which are
+    replaced right away: their memory is allocated but never written to.
+
+    The directory also holds the config and the tokenizer files, and is loaded through the registry in place of
+    `from_pretrained`, by any generator given it as `model_name_or_path`.
+"""
+import argparse
+import contextlib
+import functools
+import json
+import logging
+import os
+import threading
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+logger = logging.getLogger(__name__)
+
+WEIGHT_STORE_INDEX = 'weights.json'
+WEIGHT_STORE_DATA = 'weights.bin'
+ALIGNMENT = 64
+
+# Functions and model methods that initialize the weights when a model is built
+_INIT_FUNCTIONS = ('uniform_', 'normal_', 'trunc_normal_', 'constant_', 'ones_', 'zeros_', 'xavier_uniform_',
+                   'xavier_normal_', 'kaiming_uniform_', 'kaiming_normal_')
+_INIT_METHODS = ('init_weights', 'init_bert_weights')
+
+
+_skipping = threading.local()  # Depth of the `_skip_init` blocks of the thread
+_install_lock = threading.Lock()
+
+
+def _skippable(function):
+    """ `function`, doing nothing in the threads inside `_skip_init`. """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if getattr(_skipping, 'depth', 0):
+            return args[0] if args else kwargs.get('tensor')
+        return function(*args, **kwargs)
+    wrapper.skippable = True
+    return wrapper
+
+
+@contextlib.contextmanager
+def _skip_init(model_class):
+    """ Build `model_class` instances with uninitialized weights in this thread.
+
+        The init functions and methods are wrapped once and for all instead of being swapped for the time of the
+        block, so that the other threads, and the loads overlapping this one, still initialize their weights.
+    """
+    owners = [(nn.init, name) for name in _INIT_FUNCTIONS if hasattr(nn.init, name)]
+    owners += [(cls, name) for cls in model_class.__mro__ for name in _INIT_METHODS if name in cls.__dict__]
+    with _install_lock:
+        for owner, name in owners:
+            function = getattr(owner, name) if owner is nn.init else owner.__dict__[name]
+            if not getattr(function, 'skippable', False):
+                setattr(owner, name, _skippable(function))
+    _skipping.depth = getattr(_skipping, 'depth', 0) + 1
+    try:
+        yield
+    finally:
+        _skipping.depth -= 1
+
+
+def _config_class(model_class):
+    # Imported here, the registry imports this module without the model classes
+    from pytorch_pretrained_bert import modeling, modeling_gpt2, modeling_openai, modeling_transfo_xl
+    for base, config_class in ((modeling_gpt2.GPT2PreTrainedModel, modeling_gpt2.GPT2Config),
+                               (modeling_openai.OpenAIGPTPreTrainedModel, modeling_openai.OpenAIGPTConfig),
+                               (modeling.BertPreTrainedModel, modeling.BertConfig),
+                               (modeling_transfo_xl.TransfoXLPreTrainedModel, modeling_transfo_xl.TransfoXLConfig)):
+        if issubclass(model_class, base):
+            return config_class
+    raise ValueError("No weight store for model of type %s" % model_class.__name__)
+
+
+def save_weight_store(model, output_dir, tokenizer=None):
+    """ Write the weights and config of `model` to `output_dir`, with the files of `tokenizer` if given. """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    index, tensors = [], {}
+    offset = 0
+    with open(os.path.join(output_dir, WEIGHT_STORE_DATA), 'wb') as f:
+        for name, tensor in model.state_dict().items():
+            key = (tensor.data_ptr(), tuple(tensor.shape), tensor.stride(), tensor.dtype)
+            if key not in tensors:
+                array = tensor.cpu().contiguous().numpy()
+                offset = (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+                f.seek(offset)
+                f.write(array.tobytes())
+                tensors[key] = {'dtype': str(array.dtype), 'shape': list(array.shape), 'offset': offset}
+                offset += array.nbytes
+            index.append(dict(tensors[key], name=name))
+        f.truncate(offset)
+    with open(os.path.join(output_dir, 'config.json'), 'w', encoding='utf_8') as f:
+        f.write(model.config.to_json_string())
+    if tokenizer is not None:
+        tokenizer.save_vocabulary(output_dir)
+    # Written last, a directory with an index is complete
+    with open(os.path.join(output_dir, WEIGHT_STORE_INDEX), 'w', encoding='utf_8') as f:
+        json.dump({'model_class': type(model).__name__, 'tensors': index}, f)
+    logger.info("Wrote %d tensors (%.1f MB) of %s to %s", len(tensors), offset / 2 ** 20, type(model).__name__,
+                output_dir)
+
+
+def load_weight_store(model_class, directory):
+    """ `model_class` instance whose weights are copy-on-write memory maps of the store in `directory`, for
+        inference (the parameters don't require gradients).
+    """
+    config = _config_class(model_class).from_json_file(os.path.join(directory, 'config.json'))
+    with open(os.path.join(directory, WEIGHT_STORE_INDEX), encoding='utf_8') as f:
+        index = json.load(f)
+    with _skip_init(model_class):
+        model = model_class(config)
+
+    data_path = os.path.join(directory, WEIGHT_STORE_DATA)
+    data = np.memmap(data_path, dtype=np.uint8, mode='c') if os.path.getsize(data_path) else np.zeros(0, np.uint8)
+    modules = dict(model.named_modules())
+    tensors = {}  # (offset, dtype, shape) -> parameter, so tied weights stay tied
+    for entry in index['tensors']:
+        module_name, _, attribute = entry['name'].rpartition('.')
+        module = modules[module_name]
+        key = (entry['offset'], entry['dtype'], tuple(entry['shape']))
+        if key not in tensors:
+            dtype = np.dtype(entry['dtype'])
+            size = int(np.prod(entry['shape'])) * dtype.itemsize
+            array = data[entry['offset']:entry['offset'] + size].view(dtype).reshape(entry['shape'])
+            tensors[key] = torch.from_numpy(array)
+        if attribute in module._parameters:
+            if not isinstance(tensors[key], nn.Parameter):
+                tensors[key] = nn.Parameter(tensors[key], requires_grad=False)
+            module._parameters[attribute] = tensors[key]
+        else:
+            module._buffers[attribute] = tensors[key]
+
+    missing = set(model.state_dict()) - set(entry['name'] for entry in index['tensors'])
+    if missing:
+        raise ValueError("%s misses weights of %s: %s" % (directory, model_class.__name__,
+                                                          ', '.join(sorted(missing))))
+    return model
+
+
+def main():
+    from pytorch_pretrained_bert import (BertForMaskedLM, BertTokenizer, GPT2LMHeadModel, GPT2Tokenizer,
+                                         OpenAIGPTLMHeadModel, OpenAIGPTTokenizer, TransfoXLLMHeadModel,
+                                         TransfoXLTokenizer)
+    models = {'gpt2': (GPT2Tokenizer, GPT2LMHeadModel),
+              'openai-gpt': (OpenAIGPTTokenizer, OpenAIGPTLMHeadModel),
+              'bert': (BertTokenizer, BertForMaskedLM),
+              'transfo-xl': (TransfoXLTokenizer, TransfoXLLMHeadModel)}
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_type', type=str, default='gpt2', choices=sorted(models))
+    parser.add_argument('--model_name_or_path', type=str, default='gpt2',
+                        help='pretrained model name or path to local checkpoint')
+    parser.add_argument('--output_dir', type=str, required=True)
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                        datefmt='%m/%d/%Y %H:%M:%S',
+                        level=logging.INFO)
+
+    tokenizer_class, model_class = models[args.model_type]
+    tokenizer = tokenizer_class.from_pretrained(args.model_name_or_path)
+    model = model_class.from_pretrained(args.model_name_or_path)
+    save_weight_store(model, args.output_dir, tokenizer)
+
+
+if __name__ == '__main__':
+    main()